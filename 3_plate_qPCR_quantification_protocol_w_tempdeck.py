@@ -1,48 +1,1126 @@
-from opentrons import labware, instruments, modules
+import bisect
+import collections
+import itertools
+import json
+import math
+import os
+import time
+from typing import Optional
+
+from opentrons import labware, instruments, modules, robot
+
+TIP_STATE_FILE = '/data/user_storage/tiptracker_state.json'
+PROFILE_FILE = '/data/user_storage/run_profile.json'
+# Set to True after putting full tip racks on the deck, so the saved tip state of the last run is cleared
+RESET_TIPS = False
+
+
+class OutOfTipsError(Exception):
+    """
+    Raised by TipTracker.next_tip() when none of the tracked tip racks can supply the requested number of tips
+    """
+    pass
+
 
 class TipTracker:
-    def __init__(self, tiprack=None):
-        self.tiprack = tiprack
-        self.letters = list(reversed(list('ABCDEFGH')))
-        self.nums = list(range(1, 12 + 1))
-        self.num_rows = len(self.letters)
-        self.num_cols = len(self.nums)
-        self.rack = []
-
-        # Creates tip layout as nested list of lists
-        for n in self.nums:
-            col = []
-            for l in self.letters:
-                col.append('{}{}'.format(l, n))
-            self.rack.append(col)
-
-    def print_rack(self):
-        for i in range(self.num_rows):
-            row = []
-            for col in self.rack:
-                row.append(col[-i-1])
-            print(row)
-
-    def next_tip(self, n=1):
-        assert n <= 8, "Cannot pick up more than 8 tips"
-        for i in range(self.num_cols):
-            for j in list(range(self.num_rows)):
-                try:
-                    self.rack[i][j+n-1]
-                except IndexError:
-                    continue
-                tips = self.rack[i][j:j+n]
-                if any(x is None for x in tips):
+    """
+    TipTracker tracks the tips used by an 8-channel pipette so it can be used as a single channel. TipTracker.next_tip()
+    take n tips as an argument and return location of a tiprack that would result in the pipette picking up that many
+    tips
+
+    Occupancy is stored as one integer bitmask per column (bit 0 is row A). For every possible column mask a lookup
+    table holds the row the pipette has to be lowered onto to pick up exactly n tips, and each rack keeps a bitmask of
+    the columns able to supply n tips, so next_tip() never scans the racks.
+
+    Tips put back with TipTracker.return_tip() go into a reuse pool keyed by the reagent they touched. A column holding
+    returned reagent tips is not used for fresh pickups until those tips have been reused, so a fresh pickup never picks
+    up a used tip with it.
+
+    With a state_file the occupancy of each rack is loaded from and saved to a small JSON file keyed by the rack's deck
+    slot, so consecutive runs carry on from where the last one stopped. The reuse pool is saved with it, so returned
+    tips are reused by later runs for the same reagent rather than blocking their columns for good. Call reset() once
+    the racks have been replaced.
+
+    The rows and columns are read from the tip racks. On racks with more rows than the pipette has channels (384 tip
+    racks) the channels land on every other row, so each column is tracked as interleaved lanes of channels tips, the
+    lane starting in row A then the lane starting in row B.
+    """
+    rows = 'ABCDEFGHIJKLMNOP'
+    num_columns = 12
+    channels = 8
+    # Pick tables by number of rows, shared by every tracker as they are never modified
+    _pick_tables = {}
+
+    def __init__(self, tiprack=None, tipracks=None, state_file=None, autosave=True):
+        if tipracks is None:
+            tipracks = [tiprack] if tiprack is not None else []
+        self.tipracks = list(tipracks)
+        self.tiprack = self.tipracks[0] if self.tipracks else None
+        self.rows, num_columns = self._geometry(self.tipracks)
+        self.interleave = len(self.rows) // self.channels
+        # Bitmask columns are lanes of channels tips, interleave of them per rack column
+        self.num_rows = self.channels
+        self.num_cols = num_columns * self.interleave
+        self.verbose = True
+        self._schedule = collections.deque()
+        self._pool = collections.defaultdict(list)
+        self._last_pickup = None
+        self.state_file = state_file
+        self.autosave = autosave
+        self._state = {}
+
+        if self.num_rows not in self._pick_tables:
+            self._pick_tables[self.num_rows] = self._build_pick_table(self.num_rows)
+        self._pick_rows = self._pick_tables[self.num_rows]
+        full = (1 << self.num_rows) - 1
+        all_columns = (1 << self.num_cols) - 1
+        all_racks = (1 << len(self.tipracks)) - 1
+        # Per rack: one occupancy mask per column
+        self._columns = [[full] * self.num_cols for _ in self.tipracks]
+        # Per rack: mask of the tips in each column that were returned after touching a reagent
+        self._returned = [[0] * self.num_cols for _ in self.tipracks]
+        # Per rack, per n: bitmask of columns that can supply exactly n tips
+        self._fits = [[0] + [all_columns] * self.num_rows for _ in self.tipracks]
+        # Per n: bitmask of racks that have at least one column able to supply n tips
+        self._racks_fitting = [0] + [all_racks] * self.num_rows
+        if state_file is not None:
+            self.load()
+
+    @classmethod
+    def _geometry(cls, tipracks):
+        """
+        Returns
+        -------
+        tuple
+            Row names and number of columns shared by tipracks, a 96 tip rack's when there are none
+        """
+        geometries = set()
+        for tiprack in tipracks:
+            names = [well.get_name() for well in tiprack.wells()]
+            rows = ''.join(sorted({name[0] for name in names}))
+            geometries.add((rows, len({name[1:] for name in names})))
+        if not geometries:
+            return cls.rows[:cls.channels], cls.num_columns
+        assert len(geometries) == 1, "Tip racks of different sizes can not share a TipTracker"
+        rows, num_columns = geometries.pop()
+        assert len(rows) % cls.channels == 0, "Tip rack rows do not line up with {} channels".format(cls.channels)
+        return rows, num_columns
+
+    def _well_name(self, lane, row):
+        # Tip rack well of tip row of a lane
+        col, offset = divmod(lane, self.interleave)
+        return '{}{}'.format(self.rows[row * self.interleave + offset], col + 1)
+
+    @staticmethod
+    def _build_pick_table(num_rows):
+        """
+        For every column occupancy mask, find the row the first channel must be lowered onto so that the pipette picks
+        up exactly n tips (every tip at or below that row is picked up)
+
+        Returns
+        -------
+        list
+            table[mask][n] is the row index, or None if the column cannot supply exactly n tips
+        """
+        table = []
+        for mask in range(1 << num_rows):
+            picks = [None] * (num_rows + 1)
+            for row in range(num_rows):
+                if mask >> row & 1:
+                    picks[bin(mask >> row).count('1')] = row
+            table.append(picks)
+        return table
+
+    def __str__(self):
+        lines = []
+        for rack_index, columns in enumerate(self._columns):
+            lines.append('Rack {}'.format(rack_index + 1))
+            for rack_row in range(len(self.rows)):
+                row, offset = divmod(rack_row, self.interleave)
+                tips = []
+                for lane in range(offset, self.num_cols, self.interleave):
+                    has_tip = columns[lane] >> row & 1
+                    tips.append(self._well_name(lane, row) if has_tip else None)
+                lines.append(str(tips))
+        return '\n'.join(lines)
+
+    def tips_remaining(self):
+        """
+        Returns
+        -------
+        int
+            Number of tips left across all tracked tip racks
+        """
+        return sum(bin(mask).count('1') for columns in self._columns for mask in columns)
+
+    def load(self):
+        """
+        Restores the occupancy of the tracked tip racks from state_file. Racks without saved state, or a missing
+        state_file, are treated as full
+        """
+        try:
+            with open(self.state_file) as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
+            self._state = {}
+        for rack, tiprack in enumerate(self.tipracks):
+            saved = self._state.get(self._rack_key(tiprack))
+            if saved is None:
+                continue
+            self._returned[rack] = list(saved['returned'])
+            for col, mask in enumerate(saved['columns']):
+                self._set_column(rack, col, mask)
+            for reagent, col, row, n in saved.get('pool', []):
+                self._pool[reagent].append([rack, col, row, n])
+
+    def save(self):
+        """
+        Writes the occupancy of the tracked tip racks to state_file, keeping the state saved for racks in other slots
+        """
+        pools = [[] for _ in self.tipracks]
+        for reagent, entries in self._pool.items():
+            for rack, col, row, n in entries:
+                pools[rack].append([reagent, col, row, n])
+        for rack, tiprack in enumerate(self.tipracks):
+            self._state[self._rack_key(tiprack)] = {'columns': self._columns[rack], 'returned': self._returned[rack],
+                                                    'pool': pools[rack]}
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._state, f)
+        # Replace in one step so a run stopped mid-write never leaves a truncated state file
+        os.replace(tmp_file, self.state_file)
+
+    def reset(self):
+        """
+        Marks every tracked tip rack as full again, e.g. after the racks have been replaced
+        """
+        full = (1 << self.num_rows) - 1
+        for rack in range(len(self.tipracks)):
+            self._returned[rack] = [0] * self.num_cols
+            for col in range(self.num_cols):
+                self._set_column(rack, col, full)
+        self._pool.clear()
+        self._autosave()
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict
+            The occupancy of the tracked tip racks as plain lists, for restore()
+        """
+        return {'columns': [list(columns) for columns in self._columns],
+                'returned': [list(returned) for returned in self._returned]}
+
+    def restore(self, snapshot):
+        """
+        Brings the tracked tip racks back to a snapshot() taken earlier. Tips are only ever taken away, so a tip used
+        since the snapshot (e.g. by a step that was interrupted) stays used
+        """
+        for rack, (columns, returned) in enumerate(zip(snapshot['columns'], snapshot['returned'])):
+            for col, (mask, returned_mask) in enumerate(zip(columns, returned)):
+                mask &= self._columns[rack][col]
+                self._returned[rack][col] = (self._returned[rack][col] | returned_mask) & mask
+                self._set_column(rack, col, mask)
+        self._autosave()
+
+    @staticmethod
+    def _rack_key(tiprack):
+        # Deck slot the tip rack is loaded in
+        return tiprack.get_parent().get_name()
+
+    @classmethod
+    def _reagent_key(cls, reagent):
+        # A well stands for the reagent in it, named by deck slot and well so the saved pool matches the next run's
+        if hasattr(reagent, 'get_parent'):
+            return '{} {}'.format(cls._rack_key(reagent.get_parent()), reagent.get_name())
+        return reagent
+
+    def _autosave(self):
+        if self.state_file is not None and self.autosave:
+            self.save()
+
+    def _set_column(self, rack, col, mask):
+        # Keeps the per-rack and per-n availability bitmasks in step with a column's occupancy
+        self._columns[rack][col] = mask
+        picks = self._pick_rows[0 if self._returned[rack][col] else mask]
+        fits = self._fits[rack]
+        bit = 1 << col
+        rack_bit = 1 << rack
+        for n in range(1, self.num_rows + 1):
+            if picks[n] is None:
+                fits[n] &= ~bit
+            else:
+                fits[n] |= bit
+            if fits[n]:
+                self._racks_fitting[n] |= rack_bit
+            else:
+                self._racks_fitting[n] &= ~rack_bit
+
+    def next_tip(self, n=1, reagent=None):
+        """
+        Returns location on tiprack that would result in pipette picking up n tips when passed as location parameter to
+        Pipette.pick_up_tip()
+
+        Parameters
+        ----------
+        n: int
+            Number of tips to pick up
+        reagent: str or Well
+            Reagent the tips will be used for, or the well holding it. Returned tips that touched the same reagent are
+            reused first, then returned clean tips, then fresh tips
+
+        Returns
+        -------
+        location
+            Location on tiprack that would result in pipette picking up n tips
+
+        Raises
+        ------
+        OutOfTipsError
+            If no tracked tip rack has a column that can supply n tips
+        """
+        assert 0 < n <= self.num_rows, "Cannot pick up more than {} tips".format(self.num_rows)
+        if self._schedule:
+            return self._next_scheduled_tip(n)
+        reagent = self._reagent_key(reagent)
+        for key in ((reagent, None) if reagent is not None else (None,)):
+            if self._pool.get(key):
+                location = self._reuse_tip(key, n)
+                if location is not None:
+                    return location
+        racks = self._racks_fitting[n]
+        if not racks:
+            raise OutOfTipsError("No column with {} tips left in {} tip rack(s) ({} tips remaining)".format(
+                n, len(self.tipracks), self.tips_remaining()))
+        rack = (racks & -racks).bit_length() - 1
+        fits = self._fits[rack][n]
+        col = (fits & -fits).bit_length() - 1
+        return self._take(rack, col, n)
+
+    def _take(self, rack, col, n):
+        mask = self._columns[rack][col]
+        row = self._pick_rows[mask][n]
+        # Every tip at or below row is picked up, only the tips above it stay in the column
+        self._returned[rack][col] &= (1 << row) - 1
+        self._set_column(rack, col, mask & ((1 << row) - 1))
+        self._last_pickup = (rack, col, row, n)
+        self._autosave()
+        if self.verbose:
+            print("\nTaking {} tips".format(n))
+        return self.tipracks[rack].wells(self._well_name(col, row))
+
+    def _reuse_tip(self, reagent, n):
+        entries = self._pool[reagent]
+        for entry in list(entries):
+            rack, col, top, count = entry
+            mask = self._columns[rack][col]
+            if not mask >> top & ((1 << count) - 1):
+                # Clean tips can be taken by fresh pickups, drop entries with none of their tips left
+                entries.remove(entry)
+                continue
+            row = top + count - n
+            # Usable when the n lowest tips of the group are exactly the tips the pipette would pick up
+            if count >= n and self._pick_rows[mask][n] == row:
+                entry[3] -= n
+                if not entry[3]:
+                    entries.remove(entry)
+                return self._take(rack, col, n)
+        return None
+
+    def return_tip(self, reagent=None):
+        """
+        Records that the tips from the last next_tip() were put back in their slots with Pipette.return_tip() so they
+        can be picked up again by next_tip()
+
+        Parameters
+        ----------
+        reagent: str or Well
+            Reagent the tips touched or the well holding it, None if they are still clean. Tips that touched a reagent
+            are only handed out again by next_tip() for the same reagent, also in later runs sharing the state_file
+        """
+        assert self._last_pickup is not None, "No tips to return"
+        rack, col, row, n = self._last_pickup
+        self._last_pickup = None
+        tips = ((1 << n) - 1) << row
+        reagent = self._reagent_key(reagent)
+        if reagent is not None:
+            self._returned[rack][col] |= tips
+        self._set_column(rack, col, self._columns[rack][col] | tips)
+        self._pool[reagent].append([rack, col, row, n])
+        self._autosave()
+
+    def is_full(self):
+        """
+        Returns
+        -------
+        bool
+            Whether every tracked tip rack still holds all of its tips and none has been returned, as plan_tip_usage()
+            schedules assume
+        """
+        full = (1 << self.num_rows) - 1
+        return (all(mask == full for columns in self._columns for mask in columns)
+                and not any(any(returned) for returned in self._returned) and not any(self._pool.values()))
+
+    def replay(self, schedule):
+        """
+        Makes subsequent next_tip() calls follow a schedule made by plan_tip_usage() instead of taking the first
+        available column. Once the schedule is used up next_tip() goes back to taking the first available column
+
+        Parameters
+        ----------
+        schedule: list
+            (n, rack_index, well_name) tuples, one per pickup in the order they will be requested
+        """
+        self._schedule = collections.deque(schedule)
+
+    def _next_scheduled_tip(self, n):
+        planned_n, rack, well_name = self._schedule.popleft()
+        assert planned_n == n, "Tip schedule expected a pickup of {} tips, got {}".format(planned_n, n)
+        if rack >= len(self.tipracks):
+            raise OutOfTipsError("Tip schedule needs tip rack {} but only {} are tracked".format(
+                rack + 1, len(self.tipracks)))
+        row, offset = divmod(self.rows.index(well_name[0]), self.interleave)
+        col = (int(well_name[1:]) - 1) * self.interleave + offset
+        assert self._pick_rows[self._columns[rack][col]][n] == row, \
+            "Tip schedule is out of step with the rack: cannot pick up {} tips at {} on rack {}".format(
+                n, well_name, rack + 1)
+        return self._take(rack, col, n)
+
+
+def plan_tip_usage(pickups, num_rows=8, num_columns=12, interleave=1):
+    """
+    Plans ahead of time which column every tip pickup of a protocol comes from so that the pickups fit on the fewest
+    tip racks with the fewest partially used columns. Full column pickups get a column each, smaller pickups are
+    packed best-fit decreasing so single tips do not break into columns needed for 8-tip pickups
+
+    Parameters
+    ----------
+    pickups: list
+        Number of tips requested by each pickup, in the order the protocol requests them
+    num_rows: int
+        Number of tips per tip rack column
+    num_columns: int
+        Number of columns per tip rack
+    interleave: int
+        Lanes of num_rows tips per column, 2 for a 384 tip rack picked from by an 8-channel pipette
+
+    Returns
+    -------
+    list
+        One (n, rack_index, well_name) tuple per pickup, in the order they are requested, for TipTracker.replay()
+    """
+    rows = TipTracker.rows[:num_rows * interleave]
+    lanes = num_columns * interleave
+    column_of = [None] * len(pickups)
+    num_bins = 0
+    # bins_with_space[c] holds the partially filled columns with exactly c tips unassigned
+    bins_with_space = [[] for _ in range(num_rows + 1)]
+    for i in sorted(range(len(pickups)), key=lambda i: -pickups[i]):
+        n = pickups[i]
+        assert 0 < n <= num_rows, "Cannot pick up more than {} tips".format(num_rows)
+        space = next((c for c in range(n, num_rows) if bins_with_space[c]), None)
+        if space is None:
+            column, space = num_bins, num_rows
+            num_bins += 1
+        else:
+            column = bins_with_space[space].pop()
+        column_of[i] = column
+        bins_with_space[space - n].append(column)
+
+    # Number columns by first use so the first rack is emptied before the next one is touched
+    order = {}
+    for column in column_of:
+        order.setdefault(column, len(order))
+    remaining = [num_rows] * num_bins
+    schedule = []
+    for n, column in zip(pickups, column_of):
+        remaining[column] -= n
+        rack, lane = divmod(order[column], lanes)
+        col, offset = divmod(lane, interleave)
+        schedule.append((n, rack, '{}{}'.format(rows[remaining[column] * interleave + offset], col + 1)))
+    return schedule
+
+
+class LiquidLevelTracker:
+    """
+    LiquidLevelTracker keeps the liquid volume of every registered well and turns it into a location just below the
+    meniscus, so aspirates follow the liquid down instead of always going to the bottom of the tube
+
+    Wells are described by a geometry profile: (height, inner diameter) points from the bottom of the well up, with
+    the diameter changing linearly between them, so conical bottoms and cylinders are both covered. The
+    volume-to-height lookup table of each profile is computed once and shared by every tracker.
+    """
+    geometries = {
+        '2ml-eppendorf': [(0.0, 2.0), (4.0, 8.7), (38.0, 8.7)],
+        '1.5ml-eppendorf': [(0.0, 3.6), (18.0, 8.7), (38.0, 8.7)],
+        '15ml-falcon': [(0.0, 2.0), (22.0, 14.5), (117.5, 14.5)],
+        '50ml-falcon': [(0.0, 3.0), (15.0, 26.7), (113.0, 26.7)],
+        'pcr-well': [(0.0, 1.5), (10.0, 5.0), (19.5, 5.0)],
+        'flat-well': [(0.0, 6.4), (10.5, 6.4)],
+        '384-well': [(0.0, 3.0), (11.5, 3.7)],
+    }
+    step = 0.1  # mm between lookup table entries
+    _tables = {}
+
+    def __init__(self, submerge=1.0, min_height=0.5):
+        """
+        Parameters
+        ----------
+        submerge: float
+            How far below the meniscus (mm) to aspirate from
+        min_height: float
+            Lowest height above the bottom of a well (mm) to aspirate from
+        """
+        self.submerge = submerge
+        self.min_height = min_height
+        self._wells = {}
+
+    @classmethod
+    def _table(cls, geometry):
+        # Cumulative volume (uL) at every step mm of height
+        if geometry not in cls._tables:
+            profile = cls.geometries[geometry]
+            volumes = [0.0]
+            height = 0.0
+            for (h0, d0), (h1, d1) in zip(profile, profile[1:]):
+                while height + cls.step <= h1 + 1e-9:
+                    r0 = (d0 + (d1 - d0) * (height - h0) / (h1 - h0)) / 2
+                    r1 = (d0 + (d1 - d0) * (height + cls.step - h0) / (h1 - h0)) / 2
+                    volumes.append(volumes[-1] + math.pi * cls.step / 3 * (r0 * r0 + r0 * r1 + r1 * r1))
+                    height += cls.step
+            cls._tables[geometry] = volumes
+        return cls._tables[geometry]
+
+    @staticmethod
+    def _well(location):
+        well = location[0] if isinstance(location, tuple) else location
+        return well[0] if isinstance(well, list) else well
+
+    def add(self, wells, volume, geometry):
+        """
+        Registers wells holding volume uL each
+
+        Parameters
+        ----------
+        wells: well or list
+            Wells (or locations) to track
+        volume: float
+            Current volume of each well in uL
+        geometry: str
+            Key of LiquidLevelTracker.geometries describing the inside of the wells
+        """
+        if not isinstance(wells, list):
+            wells = [wells]
+        table = self._table(geometry)
+        for well in wells:
+            self._wells[self._well(well)] = [table, float(volume)]
+
+    def tracks(self, location):
+        return self._well(location) in self._wells
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        list
+            Volume of every tracked well in the order they were added, for restore()
+        """
+        return [volume for _, volume in self._wells.values()]
+
+    def restore(self, snapshot):
+        """
+        Sets the volumes of the tracked wells back to a snapshot() of the same wells
+        """
+        for entry, volume in zip(self._wells.values(), snapshot):
+            entry[1] = volume
+
+    def volume(self, location):
+        return self._wells[self._well(location)][1]
+
+    def height(self, location):
+        """
+        Returns
+        -------
+        float
+            Liquid height above the bottom of the well in mm
+        """
+        table, volume = self._wells[self._well(location)]
+        if volume >= table[-1]:
+            return (len(table) - 1) * self.step
+        i = bisect.bisect_right(table, volume)
+        if i == 0:
+            return 0.0
+        return (i - 1 + (volume - table[i - 1]) / (table[i] - table[i - 1])) * self.step
+
+    def _location(self, well, height):
+        half_depth = well.properties['depth'] / 2
+        return well, well.from_center(x=0, y=0, z=max(-1.0, min(1.0, height / half_depth - 1)))
+
+    def aspirate(self, location, volume):
+        """
+        Takes volume out of a well and returns where to aspirate it from: submerge mm below where the meniscus will be
+        once the volume is gone, so the tip stays in the liquid for the whole aspirate
+
+        Returns
+        -------
+        location
+            (well, offset) location for Pipette.aspirate()
+        """
+        well = self._well(location)
+        entry = self._wells[well]
+        assert entry[1] >= volume - 1e-6, "Aspirating {} uL from {} which only has {:.1f} uL left".format(
+            volume, well, entry[1])
+        entry[1] -= volume
+        return self._location(well, max(self.min_height, self.height(well) - self.submerge))
+
+    def dispense(self, location, volume):
+        """
+        Adds volume to a well and returns a location just above the meniscus to dispense it from
+
+        Returns
+        -------
+        location
+            (well, offset) location for Pipette.dispense()
+        """
+        well = self._well(location)
+        self._wells[well][1] += volume
+        return self._location(well, self.height(well) + self.submerge)
+
+
+MIX_TURNOVERS = 1.5  # times the liquid in a well passes through the tip for it to count as mixed
+MIX_FRACTION = 0.8  # largest share of the liquid in a well taken up per cycle, so the tip never draws air
+MIN_MIX_CYCLES = 3
+MAX_MIX_CYCLES = 50
+MAX_MIX_RATE = 6.0
+MAX_MIX_FLOW = {'aqueous': 300.0, 'viscous': 150.0}  # uL/s fastest aspirate flow that does not splash or foam
+DEFAULT_ASPIRATE_FLOW = {10: 5.0, 50: 25.0, 300: 150.0, 1000: 500.0}  # uL/s at rate 1.0, by pipette max volume
+
+
+def mix_policy(volume, max_volume, geometry=None, viscous=False, repetitions=None, rate=None):
+    """
+    Works out the fewest mix cycles and the fastest safe rate to mix volume uL of liquid with a pipette
+
+    Enough cycles are done for the liquid to pass through the tip MIX_TURNOVERS times, more when it stands taller than
+    twice the tube's width (the tip only stirs the bottom of it), and the rate is capped so the flow stays under what
+    the liquid takes without splashing or foaming, less for viscous liquid. Mixing large tubes thoroughly takes longer
+    than the fixed cycles the protocols were written with, so repetitions and rate can be set to keep those
+
+    Parameters
+    ----------
+    volume: float
+        Liquid in the well in uL
+    max_volume: float
+        Maximum volume of the pipette
+    geometry: str
+        Key of LiquidLevelTracker.geometries describing the well, None to ignore the liquid column's shape
+    viscous: bool
+        Whether the liquid is viscous, like the trehalose-heavy master mix
+    repetitions: int
+        Mix cycles to use instead of the policy's
+    rate: float
+        Rate to use instead of the policy's
+
+    Returns
+    -------
+    tuple
+        Repetitions, mix volume and rate for Pipette.mix()
+    """
+    assert volume > 0, "Cannot mix {} uL of liquid".format(volume)
+    mix_volume = min(max_volume, MIX_FRACTION * volume)
+    if repetitions is None:
+        turnovers = MIX_TURNOVERS
+        if geometry is not None:
+            tracker = LiquidLevelTracker()
+            tracker.add(['well'], volume, geometry)
+            height = tracker.height('well')
+            diameter = max(d for h, d in LiquidLevelTracker.geometries[geometry])
+            turnovers *= max(1.0, height / (2 * diameter))
+        repetitions = int(math.ceil(turnovers * volume / mix_volume))
+        repetitions = max(MIN_MIX_CYCLES, min(MAX_MIX_CYCLES, repetitions))
+    if rate is None:
+        max_flow = MAX_MIX_FLOW['viscous' if viscous else 'aqueous']
+        rate = round(min(MAX_MIX_RATE, max_flow / DEFAULT_ASPIRATE_FLOW.get(max_volume, max_volume / 2)), 2)
+    return repetitions, round(mix_volume, 1), rate
+
+
+_location_tables = {}
+
+
+def _distance(a, b):
+    return ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5
+
+
+class _Route:
+    """
+    Travel of visiting points in the order of a route, as trips that each start at the start point, visit a run of
+    consecutive route positions and end at the end point. A position shared by two trips is dispensed to in both. The
+    travel is a term per position for the trips starting and ending there plus a term per pair of neighbouring
+    positions visited one after the other, so moving points around only changes the terms next to the positions
+    involved
+    """
+    def __init__(self, points, trips, start=None, end=None):
+        n = len(points)
+        self.distances = [[_distance(a, b) for b in points] for a in points]
+        self.entry = [_distance(start, point) if start is not None else 0.0 for point in points]
+        self.exit = [_distance(point, end) if end is not None else 0.0 for point in points]
+        self.starts = [0] * n
+        self.ends = [0] * n
+        # Whether positions k and k + 1 are visited one after the other
+        self.linked = [False] * n
+        for trip in trips:
+            self.starts[trip[0]] += 1
+            self.ends[trip[-1]] += 1
+            for k in trip[:-1]:
+                self.linked[k] = True
+        # The segment from position i up to reach[i] is the longest that can be reversed with only the terms at its
+        # ends changing: a run of linked positions with no trip starting or ending inside it
+        self.reach = []
+        for i in range(n):
+            j = i + 1
+            while j < n and self.linked[j - 1] and (j == i + 1 or not (self.starts[j - 1] or self.ends[j - 1])):
+                j += 1
+            self.reach.append(j)
+
+    def cost(self, k, point):
+        return self.starts[k] * self.entry[point] + self.ends[k] * self.exit[point]
+
+    def link(self, k, a, b):
+        return self.distances[a][b] if self.linked[k] else 0.0
+
+    def length(self, route):
+        return (sum(self.cost(k, point) for k, point in enumerate(route)) +
+                sum(self.link(k, route[k], route[k + 1]) for k in range(len(route) - 1)))
+
+    def improve(self, route):
+        """
+        Shortens route in place for as long as reversing a segment inside a trip (2-opt) or swapping two points
+        shortens it, each candidate move costing only the terms at its ends
+        """
+        n = len(route)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(n - 1):
+                for j in range(i + 2, self.reach[i] + 1):
+                    a, b = route[i], route[j - 1]
+                    delta = (self.cost(i, b) + self.cost(j - 1, a) - self.cost(i, a) - self.cost(j - 1, b))
+                    if i:
+                        delta += self.link(i - 1, route[i - 1], b) - self.link(i - 1, route[i - 1], a)
+                    if j < n:
+                        delta += self.link(j - 1, a, route[j]) - self.link(j - 1, b, route[j])
+                    if delta < -1e-9:
+                        route[i:j] = route[i:j][::-1]
+                        improved = True
+            for i in range(n - 1):
+                for j in range(i + 1, n):
+                    delta = self._swap_delta(route, i, j)
+                    if delta < -1e-9:
+                        route[i], route[j] = route[j], route[i]
+                        improved = True
+        return route
+
+    def _swap_delta(self, route, i, j):
+        def at(k):
+            return route[j] if k == i else route[i] if k == j else route[k]
+        links = {k for k in (i - 1, i, j - 1, j) if 0 <= k < len(route) - 1}
+        before = (self.cost(i, route[i]) + self.cost(j, route[j]) +
+                  sum(self.link(k, route[k], route[k + 1]) for k in links))
+        after = self.cost(i, route[j]) + self.cost(j, route[i]) + sum(self.link(k, at(k), at(k + 1)) for k in links)
+        return after - before
+
+
+def order_locations(locations, start=None, trips=None, end=None):
+    """
+    Reorders dispense locations to shorten gantry travel with a nearest-neighbour route improved by 2-opt and swap
+    passes. A pass weighs each of its O(n^2) candidate moves by the few distances at the move's ends
+
+    Parameters
+    ----------
+    locations: list
+        (well, offset) location tuples
+    start: location
+        Where the pipette aspirates from before each trip
+    trips: list
+        Positions in locations dispensed to per aspirate, as lists of consecutive positions in the order they are
+        visited, a position split between two aspirates ending one list and starting the next (see order_dests()). One
+        trip over every location by default
+    end: location
+        Where the pipette goes after each trip, e.g. the trash it blows out into. No travel is counted after a trip
+        by default
+
+    Returns
+    -------
+    tuple
+        The reordered locations and the travel saved in mm (0 when the original order is already as short)
+    """
+    def point(location):
+        well = location[0] if isinstance(location, tuple) else location
+        return tuple(well.coordinates())[:2]
+
+    if len(locations) < 3:
+        return list(locations), 0.0
+    if trips is None:
+        trips = [list(range(len(locations)))]
+    route = _Route([point(location) for location in locations], trips, start=None if start is None else point(start),
+                   end=None if end is None else point(end))
+
+    # Nearest neighbour from the start of each trip
+    remaining = set(range(len(locations)))
+    order = []
+    previous = None
+    for k in range(len(locations)):
+        if route.starts[k] and start is not None:
+            nearest = min(remaining, key=lambda i: (route.entry[i], i))
+        elif previous is None:
+            nearest = 0
+        else:
+            nearest = min(remaining, key=lambda i: (route.distances[previous][i], i))
+        remaining.remove(nearest)
+        order.append(nearest)
+        previous = nearest
+    route.improve(order)
+
+    saved = route.length(list(range(len(locations)))) - route.length(order)
+    if saved <= 1e-9:
+        return list(locations), 0.0
+    return [locations[i] for i in order], saved
+
+
+def order_dests(pipette, volume, source, dests, disposal_vol=0, blow_out=False, min_dispense=None, planned=True):
+    """
+    Reorders the destinations of a distribute from source to shorten gantry travel (see order_locations()), routing a
+    trip from the source per aspirate the way the distribute will fill the pipette
+
+    Parameters
+    ----------
+    pipette: Pipette
+        Pipette distributing, whose maximum volume sets how many destinations each aspirate reaches
+    volume: float
+        Volume for every destination
+    planned: bool
+        Whether the distribute is a distribute_planned() one, which fills every aspirate and splits a destination's
+        volume between two aspirates, or a Pipette.distribute() one, which never splits a destination
+
+    See plan_distribute() for the other parameters
+
+    Returns
+    -------
+    tuple
+        The reordered destinations and the travel saved in mm
+    """
+    assert isinstance(volume, (int, float)), "Only distributes of one volume to every destination can be reordered"
+    dests = list(dests)
+    if planned:
+        trips = []
+        min_dispense = pipette.min_volume if min_dispense is None else min_dispense
+        for action, _, position in plan_distribute(volume, None, range(len(dests)), pipette.max_volume,
+                                                   disposal_vol=disposal_vol, min_dispense=min_dispense):
+            if action == 'aspirate':
+                trips.append([])
+            elif action == 'dispense':
+                trips[-1].append(position)
+    else:
+        per_aspirate = max(1, int((pipette.max_volume - disposal_vol) / volume + 1e-9))
+        trips = [list(range(first, min(first + per_aspirate, len(dests))))
+                 for first in range(0, len(dests), per_aspirate)]
+    # Each trip ends where the pipette blows out, or back at the source for the next aspirate
+    if blow_out and not isinstance(blow_out, bool):
+        end = blow_out
+    elif blow_out or disposal_vol:
+        end = pipette.trash_container[0]
+    else:
+        end = source
+    return order_locations(dests, start=source, trips=trips, end=end)
+
+
+def location_table(plate, x=0, y=0, z=0):
+    """
+    Returns the Well.from_center(x, y, z) offset of every well of plate by well name. Offsets only depend on the
+    labware definition, so each table is computed once per labware type and offset and shared by every plate of that
+    type for as long as the interpreter runs
+
+    Parameters
+    ----------
+    plate: Container
+        Plate to look the offsets up for
+    x, y, z: float
+        Offset from the centre of each well, as fractions of its half width and depth
+
+    Returns
+    -------
+    dict
+        Offset by well name
+    """
+    key = (plate.properties.get('type') or id(plate), x, y, z)
+    table = _location_tables.get(key)
+    if table is None:
+        table = {well.get_name(): well.from_center(x=x, y=y, z=z) for well in plate.wells()}
+        _location_tables[key] = table
+    return table
+
+
+def plan_distribute(volume, source, dests, max_volume, disposal_vol=0, blow_out=False, min_dispense=1.0):
+    """
+    Yields the aspirate and dispense steps that distribute volume from source to each destination with the fewest
+    aspirates, taking the destinations as they come. Unlike Pipette.distribute(), which splits a volume larger than
+    the pipette evenly and never shares a destination between aspirates, every aspirate is filled up to max_volume and
+    a destination's volume carries over into the next aspirate when both parts are at least min_dispense
+
+    Parameters
+    ----------
+    volume: float or iterable
+        Volume for every destination, or one volume per destination
+    source: location
+        Location to aspirate from
+    dests: iterable
+        Locations to dispense to, in order
+    max_volume: float
+        Maximum volume of the pipette
+    disposal_vol: float
+        Extra volume aspirated each time and blown out after the last dispense
+    blow_out: bool or location
+        Blow out after each aspirate's dispenses, into the trash if True
+    min_dispense: float
+        Smallest part a destination's volume may be split into
+
+    Yields
+    ------
+    tuple
+        ('aspirate' | 'dispense' | 'blow_out', volume, location) steps, a blow_out location of None meaning the trash
+    """
+    volumes = itertools.repeat(volume) if isinstance(volume, (int, float)) else volume
+    capacity = max_volume - disposal_vol
+    assert capacity > 0, "Disposal volume leaves no room in the tip"
+    blow_out_location = None if isinstance(blow_out, bool) else blow_out
+    trip = []
+
+    def finish_trip():
+        steps = [('aspirate', sum(part for part, _ in trip) + disposal_vol, source)]
+        steps.extend(('dispense', part, dest) for part, dest in trip)
+        if disposal_vol or blow_out:
+            steps.append(('blow_out', None, blow_out_location))
+        del trip[:]
+        return steps
+
+    for vol, dest in zip(volumes, dests):
+        remaining = vol
+        while remaining > 1e-9:
+            space = capacity - sum(part for part, _ in trip)
+            part = min(remaining, space)
+            if part < remaining and (part < min_dispense or remaining - part < min_dispense):
+                if trip:
+                    # Splitting here would leave a part too small to dispense accurately, start a new aspirate
+                    yield from finish_trip()
                     continue
-                else:
-                    for t in range(n):
-                        self.rack[i][j+t] = None
-                    tip_name = tips[-1]
-                    print("\nTaking {} tips".format(n))
-                    return self.tiprack.wells(tip_name)
+                part = remaining - min_dispense
+            trip.append((part, dest))
+            remaining -= part
+            if capacity - sum(p for p, _ in trip) < 1e-9:
+                yield from finish_trip()
+    if trip:
+        yield from finish_trip()
+
+
+def distribute_planned(pipette, volume, source, dests, disposal_vol=0, blow_out=False, new_tip='once',
+                       min_dispense=None, rate=1.0, liquid_levels=None, order=None):
+    """
+    Pipette.distribute() replacement that runs the steps of plan_distribute(), taking the fewest aspirates. dests can
+    be any iterable, e.g. iter_multiwell_locations(), and is only read as far as the current aspirate needs unless
+    they are reordered
+
+    Parameters
+    ----------
+    pipette: Pipette
+        Pipette to distribute with
+    new_tip: str
+        'once' picks up a tip first (unless one is attached) and drops it at the end, 'never' uses the attached tip
+    min_dispense: float
+        Smallest part a destination's volume may be split into, the pipette's minimum volume by default
+    liquid_levels: LiquidLevelTracker
+        When given, aspirates from and dispenses into wells it tracks follow the liquid level
+    order: str
+        None dispenses in the order of dests, 'shortest' reorders them to shorten gantry travel (see order_dests())
+
+    See plan_distribute() for the other parameters
+    """
+    if min_dispense is None:
+        min_dispense = pipette.min_volume
+    counts = collections.Counter()
+    saved = None
+    if order == 'shortest':
+        dests, saved = order_dests(pipette, volume, source, dests, disposal_vol=disposal_vol, blow_out=blow_out,
+                                   min_dispense=min_dispense)
+
+    def counted(dests):
+        for dest in dests:
+            counts['locations'] += 1
+            yield dest
+
+    steps = plan_distribute(volume, source, counted(dests), pipette.max_volume, disposal_vol=disposal_vol,
+                            blow_out=blow_out, min_dispense=min_dispense)
+    if new_tip == 'once' and not pipette.current_tip():
+        pipette.pick_up_tip()
+    for action, vol, location in steps:
+        if liquid_levels is not None and action != 'blow_out' and liquid_levels.tracks(location):
+            if action == 'aspirate':
+                location = liquid_levels.aspirate(location, vol)
+            else:
+                location = liquid_levels.dispense(location, vol)
+        if action == 'aspirate':
+            counts['aspirates'] += 1
+            pipette.aspirate(vol, location, rate=rate)
+        elif action == 'dispense':
+            pipette.dispense(vol, location, rate=rate)
+        else:
+            pipette.blow_out(pipette.trash_container if location is None else location)
+    if new_tip == 'once':
+        pipette.drop_tip()
+    print("\nDistributed to {} locations with {} aspirates".format(counts['locations'], counts['aspirates']))
+    if saved is not None:
+        print("Reordered {} locations, saving {:.0f} mm of travel".format(len(dests), saved))
+
+
+def run_clock(robot):
+    """
+    Returns the clock RunProfiler should time calls with: the simulated robot's clock under simulate.py, where calls
+    take no real time, and wall time on the robot
+    """
+    if isinstance(getattr(robot, 'time', None), float):
+        return lambda: robot.time
+    return time.monotonic
+
+
+class RunProfiler:
+    """
+    RunProfiler times the calls a protocol makes on its pipettes and the robot. Every call is kept as a compact
+    (phase, depth, name, pipette, start, end, volume, location) record in a ring buffer of the last capacity calls,
+    and per-phase totals are kept for the whole run so nothing is lost when the buffer wraps. A robot.comment() starts
+    a new phase named after its message.
+
+    Calls made from inside other calls (the pick_up_tip, aspirate and dispense steps of a transfer) are recorded one
+    level deeper and only count once towards the phase totals.
+    """
+    methods = ('pick_up_tip', 'drop_tip', 'return_tip', 'transfer', 'distribute', 'consolidate', 'mix', 'aspirate',
+               'dispense', 'blow_out')
+    # Position of the volume and location arguments of each method, None when it has none
+    arguments = {'transfer': (0, 1), 'distribute': (0, 1), 'consolidate': (0, 1), 'mix': (1, 2), 'aspirate': (0, 1),
+                 'dispense': (0, 1), 'pick_up_tip': (None, 0), 'blow_out': (None, 0)}
+
+    def __init__(self, capacity=4096, clock=time.monotonic):
+        self.records = collections.deque(maxlen=capacity)
+        self.clock = clock
+        self.phase = 'setup'
+        self.calls = 0
+        self._stack = []
+        self._robot_comment = None
+        # (phase, call path) -> [count, seconds, uL]
+        self._totals = collections.OrderedDict()
+
+    def instrument(self, *pipettes):
+        """
+        Wraps the methods of pipettes so every call is recorded
+        """
+        for pipette in pipettes:
+            name = getattr(pipette, 'name', None) or type(pipette).__name__
+            for method in self.methods:
+                if hasattr(pipette, method):
+                    setattr(pipette, method, self._wrap(getattr(pipette, method), method, name))
 
+    def instrument_robot(self, robot):
+        """
+        Wraps robot.comment() so each comment starts a new phase, until finish(). The robot outlives the protocol on
+        the robot's server, so a wrapper left behind by a run that never reached finish() is replaced, not wrapped
+        """
+        comment = getattr(robot.comment, 'unwrapped', robot.comment)
 
-def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
+        def wrapper(msg, *args, **kwargs):
+            self.phase = str(msg)
+            return comment(msg, *args, **kwargs)
+        wrapper.unwrapped = comment
+        robot.comment = wrapper
+        self._robot_comment = (robot, comment)
+
+    def finish(self):
+        """
+        Puts back the robot.comment() wrapped by instrument_robot()
+        """
+        if self._robot_comment is not None:
+            robot, robot.comment = self._robot_comment
+            self._robot_comment = None
+
+    def _wrap(self, method, name, pipette):
+        volume_arg, location_arg = self.arguments.get(name, (None, None))
+
+        def wrapper(*args, **kwargs):
+            volume = args[volume_arg] if volume_arg is not None and len(args) > volume_arg else kwargs.get('volume')
+            location = args[location_arg] if location_arg is not None and len(args) > location_arg else \
+                kwargs.get('location')
+            self._stack.append(name)
+            # Added before the call so call paths keep the order they were first entered in, parents first
+            totals = self._totals.setdefault((self.phase, tuple(self._stack)), [0, 0.0, 0.0])
+            start = self.clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                end = self.clock()
+                self._stack.pop()
+                self._record(totals, name, pipette, start, end, volume, location)
+        return wrapper
+
+    def _record(self, totals, name, pipette, start, end, volume, location):
+        self.records.append((self.phase, len(self._stack), name, pipette, start, end, volume, location))
+        self.calls += 1
+        totals[0] += 1
+        totals[1] += end - start
+        if isinstance(volume, (int, float)):
+            totals[2] += volume
+
+    def profile(self):
+        """
+        Returns
+        -------
+        dict
+            Per-phase totals: the phase duration (top level calls only) and the count, seconds and volume of every
+            call path in it, e.g. 'distribute;aspirate'
+        """
+        phases = collections.OrderedDict()
+        for (phase, path), (count, seconds, volume) in self._totals.items():
+            entry = phases.setdefault(phase, {'duration_s': 0.0, 'calls': collections.OrderedDict()})
+            if len(path) == 1:
+                entry['duration_s'] += seconds
+            entry['calls'][';'.join(path)] = {'count': count, 'duration_s': round(seconds, 3),
+                                              'volume_ul': round(volume, 2)}
+        for entry in phases.values():
+            entry['duration_s'] = round(entry['duration_s'], 3)
+        return {'calls': self.calls, 'buffered': len(self.records), 'phases': phases}
+
+    def flame(self, width=40):
+        """
+        Returns the profile as indented text with a bar per call path scaled to the longest phase
+        """
+        profile = self.profile()
+        longest = max([entry['duration_s'] for entry in profile['phases'].values()] + [1e-9])
+        lines = []
+        for phase, entry in profile['phases'].items():
+            lines.append('{:<36} {:>9.1f} s {}'.format(phase[:36], entry['duration_s'],
+                                                        '#' * int(round(width * entry['duration_s'] / longest))))
+            for path, call in entry['calls'].items():
+                depth = path.count(';') + 1
+                label = '{}{} x{}'.format('  ' * depth, path.rsplit(';', 1)[-1], call['count'])
+                lines.append('{:<36} {:>9.1f} s {}'.format(label[:36], call['duration_s'],
+                                                            '#' * int(round(width * call['duration_s'] / longest))))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """
+        Writes the profile to path as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.profile(), f, indent=1)
+
+
+def run_custom_protocol(number_of_mixing: Optional[int]=None, mix_rate: Optional[int]=None):
     # LABWARE
     tempdeck = modules.load('tempdeck', 10)
     tube_rack_2ml = labware.load('opentrons-aluminum-block-2ml-eppendorf', '7')
@@ -55,8 +1133,13 @@ def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
     tiprack1 = labware.load('opentrons-tiprack-300ul', '11')
     tiprack2 = labware.load('opentrons-tiprack-300ul', '9')
 
-    tiprack2_tracker = TipTracker(tiprack=tiprack2)
+    # Carry on from the tips left in the rack by the last run, only saved when running on the robot
+    tiprack2_tracker = TipTracker(tiprack=tiprack2, state_file=TIP_STATE_FILE, autosave=not robot.is_simulating())
+    if RESET_TIPS:
+        tiprack2_tracker.reset()
 
+    # Bench-tested reaction counts, not worked out by reagents.py, so the buffer mix made up by hand stays the same.
+    # The bundled layout specs pin the same counts
     WELLS = 370
     TOTAL_VOL = 20.0
     CDNA_VOL = 5.0
@@ -75,6 +1158,7 @@ def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
     DNTP_VOL = DNTP_PER_WELL * WELLS
     SYBR_VOL = SYBR_PER_WELL * WELLS
     TAQ_VOL = TAQ_PER_WELL * WELLS
+    BUFFER_MIX_VOL = (WATER_PER_WELL + TREH_PER_WELL + BUFFER_PER_WELL + FORM_PER_WELL + DNTP_PER_WELL + SYBR_PER_WELL + TAQ_PER_WELL) * WELLS
     MASTER_MIX_TUBE_WELLS = 38.0
     MASTER_MIX_TUBE_VOL = (WATER_PER_WELL + TREH_PER_WELL + BUFFER_PER_WELL + FORM_PER_WELL + DNTP_PER_WELL + SYBR_PER_WELL + TAQ_PER_WELL) * MASTER_MIX_TUBE_WELLS
     PRIMER_VOL = PRIMER_MIX_PER_WELL * MASTER_MIX_TUBE_WELLS
@@ -84,6 +1168,21 @@ def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
     p300_single = instruments.P300_Single(mount='right', tip_racks=[tiprack1])
     p50_multi = instruments.P50_Multi(mount='left', tip_racks=[tiprack2])
 
+    # Time every pipette call, each robot.comment() starts a new phase of the profile
+    profiler = RunProfiler(clock=run_clock(robot))
+    profiler.instrument(p300_single, p50_multi)
+    profiler.instrument_robot(robot)
+
+    # Mix cycles and rates follow the volume, viscosity and tube of what is mixed unless number_of_mixing and mix_rate
+    # set them, the buffer mix then keeping its own 15 cycles. Adaptive mixing is more thorough but takes longer
+    buffer_mix_reps, buffer_mix_vol, buffer_mix_rate = mix_policy(BUFFER_MIX_VOL, p300_single.max_volume,
+                                                                  '15ml-falcon', viscous=True,
+                                                                  repetitions=15 if number_of_mixing else None,
+                                                                  rate=mix_rate)
+    primer_mix_reps, primer_mix_vol, primer_mix_rate = mix_policy(MASTER_MIX_TUBE_VOL + PRIMER_VOL,
+                                                                  p50_multi.max_volume, '2ml-eppendorf', viscous=True,
+                                                                  repetitions=number_of_mixing, rate=mix_rate)
+
     # Define master mix reagents
     formamide = tube_rack_2ml.wells('A1')
     dntp = small_reagent_plate.wells('A1')
@@ -109,9 +1208,16 @@ def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
     sample_columns = ['1', '2', '3', '5', '6', '7', '9', '10', '11']
     standard_columns = ['4', '8', '12']
 
+    # Fresh racks follow a plan of every multi-channel pickup of the run, one tip per primer, a column per cDNA set and
+    # one tip per master mix tube, so single tips do not break into the columns the 8-tip pickups need
+    if tiprack2_tracker.is_full():
+        tiprack2_tracker.replay(plan_tip_usage([1] * len(primers) + [8, 8] + [1] * len(master_mix_tubes)))
+
     ######################## PROTOCOL ##################################################################################
+    # Start cooling the tempdeck first, it ramps down while the steps that do not use it run
     tempdeck.set_temperature(4)
 
+    robot.comment('Master mix build')
     # Make master mix
     p300_single.distribute(FORMAMIDE_VOL, formamide, high_vol_buffer_mix_tube, disposal_vol=0, blow_out=True)
     p300_single.distribute(DNTP_VOL, dntp, high_vol_buffer_mix_tube, disposal_vol=0, blow_out=True)
@@ -120,17 +1226,18 @@ def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
     # Add taq last and mix
     p300_single.pick_up_tip()
     p300_single.transfer(TAQ_VOL, taq, high_vol_buffer_mix_tube, disposal_vol=0, blow_out=True, new_tip='never')
-    p300_single.mix(15, 300, rate=mix_rate, location=high_vol_buffer_mix_tube)
+    p300_single.mix(buffer_mix_reps, buffer_mix_vol, rate=buffer_mix_rate, location=high_vol_buffer_mix_tube)
     p300_single.drop_tip()
 
     # Distribute master mix to separate master mix tubes
-    p300_single.distribute(MASTER_MIX_TUBE_VOL, buffer_mix_tube, master_mix_tubes, disposal_vol=0, blow_out=True)
+    distribute_planned(p300_single, MASTER_MIX_TUBE_VOL, buffer_mix_tube, master_mix_tubes, disposal_vol=0, blow_out=True)
 
+    robot.comment('Primer addition')
     # Add primers to master mix tubes
     for primer, mm_tube in zip(primers, master_mix_tubes):
         p50_multi.pick_up_tip(location=tiprack2_tracker.next_tip(), presses=1)
         p50_multi.transfer(PRIMER_VOL, primer, mm_tube, disposal_vol=0, blow_out=True, new_tip='never')
-        p50_multi.mix(number_of_mixing, 50, rate=mix_rate)
+        p50_multi.mix(primer_mix_reps, primer_mix_vol, rate=primer_mix_rate)
         p50_multi.drop_tip()
 
     def multiwell_location_offset(plates, x=0.0, y=0.0, z=0.0, start_column=None, end_column=None, columns=None):
@@ -138,33 +1245,59 @@ def run_custom_protocol(number_of_mixing: int=10, mix_rate: int=1):
         if isinstance(plates, Container):
             plates = list(plates)
         if columns is not None:
-            return [(col[0], col[0].from_center(x=x, y=y, z=z)) for plate in plates for col in plate.columns(columns)]
+            return [(col[0], location_table(plate, x=x, y=y, z=z)[col[0].get_name()]) for plate in plates for col in plate.columns(columns)]
         elif start_column and end_column:
-            return [(col[0], col[0].from_center(x=x, y=y, z=z)) for plate in plates for col in plate.columns(start_column, to=end_column)]
+            return [(col[0], location_table(plate, x=x, y=y, z=z)[col[0].get_name()]) for plate in plates for col in plate.columns(start_column, to=end_column)]
+
+    robot.comment('cDNA distribution')
+    # Only the plate on the tempdeck needs to be cold, so wait for it just before it is first used
+    tempdeck.wait_for_temp()
 
     # Mix cDNA samples then distribute to 96-well plates
     p50_multi.pick_up_tip(location=tiprack2_tracker.next_tip(n=8))
-    p50_multi.mix(number_of_mixing, 50, samples, rate=mix_rate)
+    # Each well holds a dispense per destination column plus the disposal and dead volume
+    reps, mix_vol, rate = mix_policy(CDNA_VOL * 3 * len(sample_columns) + 3 + 5, p50_multi.max_volume, 'pcr-well',
+                                     repetitions=number_of_mixing, rate=mix_rate)
+    p50_multi.mix(reps, mix_vol, samples, rate=rate)
     p50_multi.distribute(CDNA_VOL, samples, multiwell_location_offset(x=0, y=0.03, z=-1.5, plates=plates, columns=sample_columns), disposal_vol=3, new_tips='never')
 
     # Mix Standards then distribute to 96-well plates
     p50_multi.pick_up_tip(location=tiprack2_tracker.next_tip(n=8))
-    p50_multi.mix(number_of_mixing, 50, standards, rate=mix_rate)
+    # Each well holds a dispense per destination column plus the disposal and dead volume
+    reps, mix_vol, rate = mix_policy(CDNA_VOL * 3 * len(standard_columns) + 3 + 5, p50_multi.max_volume, 'pcr-well',
+                                     repetitions=number_of_mixing, rate=mix_rate)
+    p50_multi.mix(reps, mix_vol, standards, rate=rate)
     p50_multi.distribute(CDNA_VOL, standards, multiwell_location_offset(x=0, y=0.03, z=-1.5, plates=plates, columns=standard_columns), disposal_vol=3, new_tips='never')
 
-    plates = []
-    plates.extend([pcr_plate1]*3)
-    plates.extend([pcr_plate2]*3)
-    plates.extend([pcr_plate3]*3)
-    for master_mix, column in zip(master_mix_tubes, list(range(1, 12+1, 4))*3):
+    robot.comment('Master mix distribution')
+    def master_mix_dispense_location(plate, begin_col, end_col):
+        table = location_table(plate, x=0, y=0.1, z=0.5)
+        return ((well, table[well.get_name()]) for col in plate.columns(begin_col, to=end_col) for well in col)
+
+    # Each plate takes three master mix tubes, one per block of four columns
+    master_mix_plates = itertools.chain.from_iterable(itertools.repeat(plate, 3) for plate in plates)
+    # Track the master mix tube levels so master mix is aspirated from just below the meniscus
+    liquid_levels = LiquidLevelTracker(submerge=2.0)
+    liquid_levels.add(master_mix_tubes, MASTER_MIX_TUBE_VOL + PRIMER_VOL, '2ml-eppendorf')
+    for plate, master_mix, column in zip(master_mix_plates, master_mix_tubes, itertools.cycle(range(1, 12+1, 4))):
         first_column = str(column)
         last_column = str(column + 3)
         p50_multi.pick_up_tip(location=tiprack2_tracker.next_tip(), presses=1)
-        p50_multi.distribute(MASTER_MIX_VOL,
-                             master_mix,
-                             multiwell_location_offset(x=0, y=0.1, z=0.5, plates=plates, start_column=first_column, end_column=last_column),
-                             disposal_vol=0,
-                             blow_out=True)
+        distribute_planned(p50_multi,
+                           MASTER_MIX_VOL,
+                           master_mix,
+                           master_mix_dispense_location(plate, first_column, last_column),
+                           disposal_vol=0,
+                           blow_out=True,
+                           liquid_levels=liquid_levels,
+                           order='shortest')
+
+
+    profiler.finish()
+    if robot.is_simulating():
+        print(profiler.flame())
+    else:
+        profiler.save(PROFILE_FILE)
 
 
-run_custom_protocol(**{'number_of_mixing': 5, 'mix_rate': 6})
+run_custom_protocol()
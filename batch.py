@@ -0,0 +1,266 @@
+"""
+Batch planner that packs a queue of qPCR jobs into as few robot runs as possible. A job is one set of up to 8 cDNA
+samples (one column of the sample plate) to run against some primers, each primer in a number of replicate columns.
+Every run takes its deck, plates and primer blocks from a template layout: each block of primer_columns on each plate
+gets one primer's master mix, and the template's standards columns are kept on every plate. Jobs are placed first fit
+decreasing, the largest first into the first run with room, and a job's primers share a block with another job's
+columns of the same primer where it fits. Jobs with the same primers and replicates and no more than 8 samples between
+them share a sample plate column, one after the other down its rows, since the multi-channel moves whole columns.
+
+Usage:
+    python batch.py jobs.json --template 3_plate_qPCR_quantification [-o runs/]
+
+jobs.json is a list of {"name": ..., "primers": [...], "samples": 8, "replicates": 3}, replicates defaulting to the
+sample columns of a template block. Each run is written as a layout spec for layout.py generate, with a 'contents' entry
+saying which primer goes in which primer well and which job's samples in which rows of which sample plate column. Run
+files of the template left in the output directory by an earlier plan are removed first.
+"""
+import argparse
+import collections
+import copy
+import json
+import math
+import os
+import re
+import sys
+
+import cost
+import layout
+import validate
+from simulate import LABWARE
+
+Job = collections.namedtuple('Job', ['name', 'primers', 'samples', 'replicates'])
+
+# Rows of a sample column, one under each channel of the multi-channel pipette
+ROWS = 'ABCDEFGH'
+
+
+class Run:
+    """
+    One robot run being filled: the primer of each block opened so far in plate then block order, the sample columns
+    still free in each and the sample plate column and rows of each job placed
+    """
+    def __init__(self, template, sample_sources):
+        self.template = template
+        standards = set(template['standards']['columns']) if template['standards'] else set()
+        self.blocks = [(plate, [column for column in columns if column not in standards])
+                       for plate in template['plates'] for columns in template['primer_columns']]
+        self.blocks = self.blocks[:len(template['primers'])]
+        self.sample_sources = list(sample_sources)
+        self.primers = []
+        self.free = []
+        # (job, sample plate column, rows, [(block, columns)])
+        self.jobs = []
+
+    def place(self, job):
+        """
+        Places job in this run if it fits, in the free rows of the sample plate column of a job with the same primers
+        and replicates, otherwise in a free sample plate column and a block per primer
+
+        Returns
+        -------
+        bool
+            Whether the job was placed
+        """
+        for other, source, _, placements in self.jobs:
+            if other.primers == job.primers and other.replicates == job.replicates:
+                used = sum(len(rows) for _, shared, rows, _ in self.jobs if shared == source)
+                if used + job.samples <= len(ROWS):
+                    self.jobs.append((job, source, ROWS[used:used + job.samples], placements))
+                    return True
+        sources = list(collections.OrderedDict.fromkeys(source for _, source, _, _ in self.jobs))
+        if len(sources) == len(self.sample_sources):
+            return False
+        primers, free = list(self.primers), [list(columns) for columns in self.free]
+        placements = []
+        for primer in job.primers:
+            # Tightest open block of the same primer first, then the next unopened block
+            fitting = [i for i, columns in enumerate(free) if primers[i] == primer and len(columns) >= job.replicates]
+            if fitting:
+                block = min(fitting, key=lambda i: len(free[i]))
+            elif len(primers) < len(self.blocks) and len(self.blocks[len(primers)][1]) >= job.replicates:
+                block = len(primers)
+                primers.append(primer)
+                free.append(list(self.blocks[block][1]))
+            else:
+                return False
+            placements.append((block, free[block][:job.replicates]))
+            del free[block][:job.replicates]
+        self.primers, self.free = primers, free
+        self.jobs.append((job, self.sample_sources[len(sources)], ROWS[:job.samples], placements))
+        return True
+
+    def spec(self, name):
+        """
+        Returns the layout spec of the run, only loading the plates it uses
+        """
+        spec = copy.deepcopy(self.template)
+        plates = [plate for plate in self.template['plates']
+                  if any(self.blocks[i][0] == plate for i in range(len(self.primers)))]
+        spec['name'] = name
+        spec['labware'] = [entry for entry in spec['labware']
+                           if entry[0] not in self.template['plates'] or entry[0] in plates]
+        spec['plates'] = plates
+        spec['primers'] = self.template['primers'][:len(self.primers)]
+        spec['master_mix_tubes'] = self.template['master_mix_tubes'][:len(self.primers)]
+        spec['wells'] = spec['master_mix_tube_wells'] = None
+        samples = []
+        contents = collections.OrderedDict()
+        for job, source, rows, placements in self.jobs:
+            contents.setdefault(source, collections.OrderedDict())[rows_label(rows)] = job.name
+            if len(contents[source]) > 1:
+                # Rides along with the column's first job
+                continue
+            # One sample set per column pattern, going to every plate the job has those columns on
+            by_columns = collections.OrderedDict()
+            for block, columns in placements:
+                by_columns.setdefault(tuple(columns), []).append(self.blocks[block][0])
+            samples.extend({'source': source, 'columns': list(columns), 'plates': job_plates}
+                           for columns, job_plates in by_columns.items())
+        spec['samples'] = samples
+        spec['contents'] = {
+            'primers': collections.OrderedDict(zip(spec['primers'], self.primers)),
+            'samples': contents,
+        }
+        return spec
+
+    def filled(self):
+        """
+        Fraction of the sample wells on the plates the run uses that hold samples
+        """
+        plates = {self.blocks[i][0] for i in range(len(self.primers))}
+        total = sum(len(columns) for plate, columns in self.blocks if plate in plates) * len(ROWS)
+        placed = sum(len(rows) * len(columns) for _, _, rows, placements in self.jobs for _, columns in placements)
+        return placed / float(total)
+
+
+def rows_label(rows):
+    """
+    Rows of a sample column as 'A-D', or just 'A' for one
+    """
+    return rows[0] if len(rows) == 1 else '{}-{}'.format(rows[0], rows[-1])
+
+
+def sample_sources(template):
+    """
+    Sample plate columns free for samples in the template: the template's own sample columns first, then every column
+    without reagents, primers or standards in it
+    """
+    used = set()
+    for key, well in list(template['reagents'].values()) + [template['buffer_mix_tube']]:
+        if key == template['sample_plate']:
+            used.add(well[1:])
+    if template['primer_plate'] == template['sample_plate']:
+        used.update(well[1:] for well in template['primers'])
+    if template['standards']:
+        used.add(template['standards']['source'])
+    own = [cdna['source'] for cdna in layout.cdna_sets(template) if cdna['source'] not in used]
+    name = next(name for key, name, _ in template['labware'] if key == template['sample_plate'])
+    columns = list(collections.OrderedDict((well[1:], None) for well in LABWARE[name][1]))
+    return list(collections.OrderedDict.fromkeys(own + [column for column in columns if column not in used]))
+
+
+def load_jobs(jobs, template):
+    """
+    Returns Jobs from dicts of name, primers, samples (a full column by default) and replicates (the sample columns of a
+    template block by default)
+    """
+    standards = set(template['standards']['columns']) if template['standards'] else set()
+    block_columns = min(len([column for column in columns if column not in standards])
+                        for columns in template['primer_columns'])
+    loaded = []
+    for i, job in enumerate(jobs):
+        job = Job(job.get('name', 'job{}'.format(i + 1)), list(job['primers']), job.get('samples', len(ROWS)),
+                  job.get('replicates', block_columns))
+        assert 0 < job.samples <= len(ROWS), "Job '{}' has {} samples, a job fits in one column of {}".format(
+            job.name, job.samples, len(ROWS))
+        assert 0 < job.replicates <= block_columns, "Job '{}' needs {} columns per primer, blocks have {}".format(
+            job.name, job.replicates, block_columns)
+        assert job.primers, "Job '{}' has no primers".format(job.name)
+        loaded.append(job)
+    return loaded
+
+
+def plan_runs(jobs, template):
+    """
+    Packs jobs into runs of template first fit decreasing, by the sample wells they take
+
+    Parameters
+    ----------
+    jobs: list
+        Job tuples or dicts, see load_jobs()
+    template: dict
+        Layout spec every run copies its deck and blocks from
+
+    Returns
+    -------
+    list
+        Runs in order, each holding at least one job
+    """
+    jobs = load_jobs([job._asdict() if isinstance(job, Job) else job for job in jobs], template)
+    sources = sample_sources(template)
+    runs = []
+    for job in sorted(jobs, key=lambda job: -len(job.primers) * job.replicates * job.samples):
+        if not any(run.place(job) for run in runs):
+            runs.append(Run(template, sources))
+            assert runs[-1].place(job), "Job '{}' needs {} primer blocks, a run has {}".format(
+                job.name, len(job.primers), len(runs[-1].blocks))
+    return runs
+
+
+def fewest_runs(jobs, template):
+    """
+    Lower bound on the runs jobs need, from the sample wells and sample plate wells they take
+    """
+    jobs = load_jobs(jobs, template)
+    run = Run(template, sample_sources(template))
+    wells = sum(len(columns) for _, columns in run.blocks) * len(ROWS)
+    return max(int(math.ceil(sum(len(job.primers) * job.replicates * job.samples for job in jobs) / float(wells))),
+               int(math.ceil(sum(job.samples for job in jobs) / float(len(run.sample_sources) * len(ROWS)))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('jobs', help='JSON file of the queued jobs')
+    parser.add_argument('--template', default='3_plate_qPCR_quantification',
+                        help='Name of a spec in layout.SPECS or a JSON spec file every run is laid out like')
+    parser.add_argument('-o', '--output', help='Write the layout spec of each run into this directory')
+    args = parser.parse_args(argv)
+
+    template = layout.load_spec(args.template)
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+    runs = plan_runs(jobs, template)
+    if args.output and os.path.isdir(args.output):
+        # Runs of an earlier plan past the last of this one would otherwise be left looking current
+        stale = re.compile(re.escape(template['name']) + r'_run\d+\.json$')
+        for name in os.listdir(args.output):
+            if stale.match(name):
+                os.remove(os.path.join(args.output, name))
+    print('{} jobs in {} runs (at least {})'.format(len(jobs), len(runs), fewest_runs(jobs, template)))
+    status = 0
+    for i, run in enumerate(runs):
+        spec = run.spec('{}_run{}'.format(template['name'], i + 1))
+        errors = [violation for violation in validate.validate_plan(spec) if violation.severity == 'error']
+        print('Run {}: {} jobs, {} primers on {} plates, {:.0%} full'.format(
+            i + 1, len(run.jobs), len(run.primers), len(spec['plates']), run.filled()), end='')
+        if errors:
+            print(', {} errors'.format(len(errors)))
+        else:
+            # Only a run that validates can be dry-run to the end
+            run_cost = cost.layout_cost(spec)
+            print(', {:.0f} min, {} tips'.format(run_cost.duration / 60, sum(run_cost.tips.values())))
+        for job, source, rows, _ in run.jobs:
+            print('  column {:>2} {}: {}'.format(source, rows_label(rows), job.name))
+        for step, _, message in errors:
+            print('  Step {}: {}'.format('-' if step is None else step, message))
+        status = status or (1 if errors else 0)
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+            with open(os.path.join(args.output, spec['name'] + '.json'), 'w') as f:
+                json.dump(spec, f, indent=1)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Benchmarks the estimated robot run time of every qPCR protocol in the repo with the offline simulator and breaks it
+down by protocol phase.
+
+Usage:
+    python benchmark.py [--output report.json] [--baseline previous.json] [--tolerance 60] [--planning 1 4 16 64]
+
+With --baseline the run fails when any protocol is estimated to be more than --tolerance seconds slower than in the
+baseline report, so a change that costs minutes on the bench is caught before it gets there. --planning also times
+how long the helpers take to plan a master mix distribution over that many 384-well plates.
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+from simulate import simulate, simulated_opentrons
+
+PROTOCOLS = [
+    '1_plate_qPCR_primer_test_protocol.py',
+    '1_plate_qPCR_primer_test_protocol_w_tempdeck.py',
+    '3_plate_qPCR_primer_test_protocol.py',
+    '3_plate_qPCR_quantification_protocol.py',
+    '3_plate_qPCR_quantification_protocol_w_tempdeck.py',
+]
+PHASES = ['setup', 'master mix build', 'primer addition', 'cDNA distribution', 'master mix distribution']
+
+
+def classify_phases(commands):
+    """
+    Assigns every command to the protocol phase it ran in. As in cost.stream_cost(), each robot.comment() the protocol
+    makes starts a new phase named by the comment, and commands before the first comment are setup. Comments naming
+    one of PHASES in another case take its name
+
+    Parameters
+    ----------
+    commands: list
+        simulate.Command records in execution order
+
+    Returns
+    -------
+    list
+        Phase name for each command
+    """
+    names = {phase.lower(): phase for phase in PHASES}
+    phases = []
+    phase = 'setup'
+    for command in commands:
+        if command.name == 'comment':
+            phase = names.get(command.text.lower(), command.text)
+        phases.append(phase)
+    return phases
+
+
+def benchmark_protocol(path):
+    """
+    Simulates one protocol and totals its estimated time, tips and gantry travel per phase
+
+    Returns
+    -------
+    dict
+        Machine-readable totals for the protocol and each of its phases
+    """
+    report = simulate(path)
+    phases = collections.OrderedDict((phase, {'duration_s': 0.0, 'tips': 0, 'distance_mm': 0.0}) for phase in PHASES)
+    for command, phase in zip(report.commands, classify_phases(report.commands)):
+        totals = phases.setdefault(phase, {'duration_s': 0.0, 'tips': 0, 'distance_mm': 0.0})
+        totals['duration_s'] += command.duration
+        totals['distance_mm'] += command.distance
+        if command.name == 'pick_up_tip':
+            totals['tips'] += command.tips
+        elif command.name == 'return_tip':
+            totals['tips'] -= command.tips
+    for totals in phases.values():
+        totals['duration_s'] = round(totals['duration_s'], 1)
+        totals['distance_mm'] = round(totals['distance_mm'], 1)
+    result = report.as_dict()
+    result['phases'] = phases
+    return result
+
+
+def benchmark_planning(plate_counts, plate='384-plate', volume=5.0, max_volume=50.0):
+    """
+    Times planning a multi-channel distribution of volume into every well of growing numbers of plates: the
+    locations from helpers.iter_multiwell_locations() streamed through helpers.plan_distribute()
+
+    Returns
+    -------
+    list
+        Per plate count: the locations and steps planned, the time to the first step and to the whole plan in ms
+    """
+    results = []
+    with simulated_opentrons():
+        from opentrons import labware
+        import helpers
+        source = labware.load('PCR-strip-tall', '1')
+        for count in plate_counts:
+            plates = [labware.load(plate, '2', share=True) for _ in range(count)]
+            start = time.perf_counter()
+            steps = helpers.plan_distribute(volume, source.wells('A1'), helpers.iter_multiwell_locations(
+                plates, y=0.1, z=0.5, start_column='1', end_column=str(len(plates[0].columns()))), max_volume)
+            next(steps)
+            first = time.perf_counter()
+            planned = 1 + sum(1 for _ in steps)
+            end = time.perf_counter()
+            results.append({'plates': count, 'wells': count * len(plates[0]), 'steps': planned,
+                             'first_step_ms': round((first - start) * 1000, 3),
+                             'planning_ms': round((end - start) * 1000, 3)})
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a message for every protocol estimated to run more than tolerance seconds longer than in baseline
+    """
+    previous = {result['protocol']: result for result in baseline['protocols']}
+    regressions = []
+    for result in results['protocols']:
+        before = previous.get(result['protocol'])
+        if before is None:
+            continue
+        slower = result['duration_s'] - before['duration_s']
+        if slower > tolerance:
+            regressions.append('{} is {:.0f} s slower than the baseline ({:.0f} s -> {:.0f} s)'.format(
+                result['protocol'], slower, before['duration_s'], result['duration_s']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('protocols', nargs='*', default=PROTOCOLS)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=60.0, help='Seconds a protocol may slow down by')
+    parser.add_argument('--planning', type=int, nargs='+', metavar='PLATES',
+                        help='Also time planning a distribution over this many 384-well plates')
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {'protocols': [benchmark_protocol(os.path.join(here, path) if not os.path.exists(path) else path)
+                             for path in args.protocols]}
+    for result in results['protocols']:
+        result['protocol'] = os.path.basename(result['protocol'])
+    if args.planning:
+        results['planning'] = benchmark_planning(args.planning)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+"""
+Run-cost estimates for planning bench time and consumables. A protocol file or a layout spec is dry-run in the offline
+simulator once and its command stream is reduced to the tips taken from each tip rack, the uL taken out of each well
+that ends the run with less than it started with, and the seconds spent in each phase of the run.
+
+Usage:
+    python cost.py 3_plate_qPCR_quantification 1_plate_qPCR_primer_test_protocol.py [--json]
+
+From code, cost.cost() takes either and returns a RunCost. Phases of protocol files start at each robot.comment(),
+phases of layouts are those of their plan steps. Layout costs are cached by spec hash, candidate layouts that only
+differ in their mixing cycles and rates share one dry run, and each phase of a dry run is cached by the labware,
+pipettes and run state it depends on, so a candidate only simulates the phases its changes reach. Ranking candidates
+of the 3-plate quantification layout runs at about a thousand per second when they differ in mixing, a few hundred per
+second when they differ in primers and about 150 per second when labware moves, as every phase using moved labware is
+simulated again.
+"""
+import argparse
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import sys
+import time
+
+import helpers
+import layout
+import simulate
+
+RunCost = collections.namedtuple('RunCost', ['tips', 'reagents', 'phases', 'duration'])
+
+# Costs of the most recently evaluated layouts by spec hash, dry runs by deck and plan with mixing cut out, and runs of
+# a phase by the parts of the deck it uses, its steps and the state it started from
+CACHE_SIZE = 4096
+_layout_costs = collections.OrderedDict()
+_dry_runs = collections.OrderedDict()
+_phase_runs = collections.OrderedDict()
+
+
+class _PhaseComments:
+    """
+    Stands in for the profiler run_plan() tells the phase of each step, commenting each new phase into the command
+    stream the way the protocol files mark theirs
+    """
+    def __init__(self, robot):
+        self._robot = robot
+        self._phase = None
+
+    @property
+    def phase(self):
+        return self._phase
+
+    @phase.setter
+    def phase(self, phase):
+        if phase != self._phase:
+            self._robot.comment(phase)
+            self._phase = phase
+
+
+def stream_cost(commands, volumes):
+    """
+    Reduces a simulated command stream to its run cost
+
+    Parameters
+    ----------
+    commands: list
+        simulate.Command records in the order they ran, robot.comment() ones starting phases
+    volumes: dict
+        Net uL change of each (slot, well) over the run
+
+    Returns
+    -------
+    RunCost
+        Tips taken per tip rack slot, uL taken out of each (slot, well) left with less than it started with, seconds
+        per phase in run order and the estimated seconds of the whole run
+    """
+    tips = collections.Counter()
+    phases = collections.OrderedDict()
+    phase = 'setup'
+    for command in commands:
+        if command.name == 'comment':
+            phase = command.text
+        elif command.name == 'pick_up_tip':
+            tips[command.slot] += command.tips
+        elif command.name == 'return_tip':
+            tips[command.slot] -= command.tips
+        phases[phase] = phases.get(phase, 0.0) + command.duration
+    reagents = {well: -volume for well, volume in volumes.items() if volume < -1e-9}
+    duration = commands[-1].start + commands[-1].duration if commands else 0.0
+    return RunCost(dict(tips), reagents, phases, duration)
+
+
+def protocol_cost(protocol_file):
+    """
+    Dry-runs a protocol file and returns its RunCost
+    """
+    report = simulate.simulate(protocol_file)
+    return stream_cost(report.commands, report.volumes)
+
+
+def _mix_steps(plan):
+    """
+    Indices of the mix steps of plan a dry run can leave the mixing of out, and for each tempdeck wait step those run
+    while its tempdeck ramped, whose seconds shorten the wait
+    """
+    mixes = []
+    waits = collections.OrderedDict()
+    ramping = {}
+    for i, (_, _, action, args) in enumerate(plan):
+        if action == 'set_temperature':
+            ramping[args['module']] = []
+        elif action == 'wait_for_temp':
+            waits[i] = ramping.pop(args['module'], [])
+        elif action == 'mix' and args.get('volume') is not None:
+            mixes.append(i)
+            for during in ramping.values():
+                during.append(i)
+    return mixes, waits
+
+
+def _phases(plan):
+    """
+    Splits plan into runs of consecutive steps of the same phase
+    """
+    phases = []
+    for step in plan:
+        if phases and phases[-1][0][0] == step[0]:
+            phases[-1].append(step)
+        else:
+            phases.append([step])
+    return phases
+
+
+class _Deck:
+    """
+    Loaded deck a plan is dry-run on phase by phase. The state a phase starts from and the state it leaves are
+    captured in a form that does not refer to the loaded objects, limited to the parts of the deck the phase uses, so a
+    phase run on one deck can be replayed onto another deck that matches it in those parts
+    """
+    def __init__(self, spec, plan):
+        self.tempdeck_slot = spec['tempdeck']['slot'] if spec['tempdeck'] else None
+        self.spec = spec
+        with simulate.simulated_opentrons() as robot:
+            self.labware, self.pipettes, self.modules, self.tip_trackers = helpers.load_deck(
+                spec['labware'], spec['pipettes'], tempdeck_slot=self.tempdeck_slot, autosave=False)
+        self.robot = robot
+        self.tempdeck = self.modules.get('tempdeck')
+        self.liquid_levels = helpers.LiquidLevelTracker(submerge=2.0)
+        self.profiler = _PhaseComments(self.robot)
+        self.tips = collections.Counter()
+        self.phases = collections.OrderedDict()
+        self.waits = []
+        helpers.schedule_tips(plan, self.tip_trackers)
+
+    def uses(self, steps):
+        """
+        Key of the deck parts steps depend on and the parts of the run state they read or change
+        """
+        used = set()
+        pipettes = sorted({pipette for _, pipette, _, _ in steps if pipette in self.pipettes})
+        racks = sorted({rack for pipette in pipettes for rack in self.spec['pipettes'][pipette][2]})
+        for _, _, _, args in steps:
+            used.update(layout.labware_used(args))
+        used.update(racks)
+        labware = [entry for entry in self.spec['labware'] if entry[0] in used]
+        liquid = any(action == 'track_liquid' or args.get('liquid_levels') for _, _, action, args in steps)
+        module = self.tempdeck is not None and (
+            any(action in ('set_temperature', 'wait_for_temp') for _, _, action, _ in steps)
+            or any(slot == self.tempdeck_slot for _, _, slot in labware))
+        mounted = tuple((pipette, model, mount, tuple(tip_racks))
+                        for pipette, (model, mount, tip_racks) in sorted(self.spec['pipettes'].items())
+                        if pipette in pipettes)
+        deck = tuple(map(tuple, labware)), mounted, self.tempdeck_slot, self.robot._safe_height()
+        return deck, (pipettes, racks, liquid, module)
+
+    def capture(self, parts):
+        """
+        State of the run in the parts of the deck a phase uses, as a hashable tuple apply() can load onto any deck
+        """
+        pipettes, racks, liquid, module = parts
+        robot = self.robot
+        state = [tuple(robot.position)]
+        for key in pipettes:
+            pipette = self.pipettes[key]
+            location = pipette._location
+            if location is not None:
+                labware, well, target = location
+                location = labware.slot, None if well is None else well.name, tuple(target)
+            tip = pipette._tip_location
+            state.append((pipette.tips, pipette.current_volume, location,
+                          None if tip is None else (tip.labware.slot, tip.name)))
+            tracker = self.tip_trackers.get(key)
+            if tracker is not None:
+                pool = tuple((reagent, tuple(map(tuple, entries))) for reagent, entries in tracker._pool.items())
+                state.append((tuple(map(tuple, tracker._columns)), tuple(map(tuple, tracker._returned)),
+                              tuple(map(tuple, tracker._fits)), tuple(tracker._racks_fitting), tuple(tracker._schedule),
+                              pool, tracker._last_pickup))
+        for rack in racks:
+            state.append(frozenset(self.labware[rack].tips))
+        if liquid:
+            geometries = {id(table): geometry for geometry, table in helpers.LiquidLevelTracker._tables.items()}
+            state.append(tuple((well.labware.slot, well.name, geometries[id(table)], volume)
+                               for well, (table, volume) in self.liquid_levels._wells.items()))
+        if module:
+            # Only a ramp still going on when the phase starts makes a difference to it
+            tempdeck = self.tempdeck
+            ramp = None
+            if tempdeck._ramp_end > robot.time:
+                ramp = tempdeck._ramp_start - robot.time, tempdeck._ramp_end - robot.time
+            state.append((tempdeck.temperature, tempdeck.target, tempdeck.settled, ramp))
+        return tuple(state)
+
+    def apply(self, parts, state):
+        """
+        Loads a capture() of the same parts
+        """
+        pipettes, racks, liquid, module = parts
+        robot = self.robot
+        state = iter(state)
+        robot.position = next(state)
+        for key in pipettes:
+            pipette = self.pipettes[key]
+            pipette.tips, pipette.current_volume, location, tip = next(state)
+            if location is not None:
+                slot, well, target = location
+                labware = robot.deck[slot]
+                location = labware, None if well is None else labware.well(well), target
+            pipette._location = location
+            pipette._tip_location = None if tip is None else robot.deck[tip[0]].well(tip[1])
+            tracker = self.tip_trackers.get(key)
+            if tracker is not None:
+                columns, returned, fits, racks_fitting, schedule, pool, tracker._last_pickup = next(state)
+                tracker._columns = [list(masks) for masks in columns]
+                tracker._returned = [list(masks) for masks in returned]
+                tracker._fits = [list(masks) for masks in fits]
+                tracker._racks_fitting = list(racks_fitting)
+                tracker._schedule = collections.deque(schedule)
+                tracker._pool = collections.defaultdict(list, ((reagent, [list(entry) for entry in entries])
+                                                               for reagent, entries in pool))
+        for rack in racks:
+            self.labware[rack].tips = set(next(state))
+        if liquid:
+            self.liquid_levels._wells = collections.OrderedDict(
+                (robot.deck[slot].well(name), [helpers.LiquidLevelTracker._table(geometry), volume])
+                for slot, name, geometry, volume in next(state))
+        if module:
+            tempdeck = self.tempdeck
+            tempdeck.temperature, tempdeck.target, tempdeck.settled, ramp = next(state)
+            ramp_start, ramp_end = ramp or (0.0, 0.0)
+            tempdeck._ramp_start = robot.time + ramp_start
+            tempdeck._ramp_end = robot.time + ramp_end
+
+    def run(self, steps, digest):
+        """
+        Dry-runs the steps of one phase, or replays them from the cache when a deck matching this one in the parts they
+        use already ran them from the same state
+        """
+        phase = steps[0][0]
+        deck, parts = self.uses(steps)
+        key = (deck, digest, self.capture(parts))
+        robot = self.robot
+        if key in _phase_runs:
+            _phase_runs.move_to_end(key)
+            state, duration, tips, volumes, waits = _phase_runs[key]
+            robot.time += duration
+            self.apply(parts, state)
+            self.profiler._phase = phase
+        else:
+            start, first = robot.time, len(robot.commands)
+            totals, robot.volumes = robot.volumes, collections.defaultdict(float)
+            with contextlib.redirect_stdout(io.StringIO()):
+                helpers.run_plan(iter(steps), self.labware, self.pipettes, modules=self.modules,
+                                 tip_trackers=self.tip_trackers, liquid_levels=self.liquid_levels,
+                                 profiler=self.profiler)
+            commands = robot.commands[first:]
+            tips = collections.Counter()
+            for command in commands:
+                if command.name == 'pick_up_tip':
+                    tips[command.slot] += command.tips
+                elif command.name == 'return_tip':
+                    tips[command.slot] -= command.tips
+            volumes, robot.volumes = tuple(robot.volumes.items()), totals
+            waits = tuple(command.duration for command in commands if command.name == 'wait_for_temp')
+            duration = robot.time - start
+            _phase_runs[key] = self.capture(parts), duration, tips, volumes, waits
+            if len(_phase_runs) > CACHE_SIZE:
+                _phase_runs.popitem(last=False)
+        for well, volume in volumes:
+            robot.volumes[well] += volume
+        self.tips.update(tips)
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+        self.waits.extend(waits)
+
+
+def _dry_run(spec, phases):
+    """
+    Dry-runs the (steps, digest) phases of a plan on the deck of spec, returning its RunCost, the flow rates of its
+    pipettes and the seconds of each wait for a tempdeck
+    """
+    deck = _Deck(spec, [step for steps, _ in phases for step in steps])
+    for steps, digest in phases:
+        deck.run(steps, digest)
+    reagents = {well: -volume for well, volume in deck.robot.volumes.items() if volume < -1e-9}
+    flow_rates = {key: dict(pipette.flow_rate) for key, pipette in deck.pipettes.items()}
+    return RunCost(dict(deck.tips), reagents, deck.phases, deck.robot.time), flow_rates, deck.waits
+
+
+def layout_cost(spec, plan=None):
+    """
+    Dry-runs a plan of spec, its compiled plan by default, and returns its RunCost. Costs of compiled plans are cached
+    by spec hash and shared between callers, so they should not be modified
+
+    Candidates that only differ in how long they mix share a dry run: it is done once with no mixing cycles, then the
+    seconds of each candidate's mixing are added to the phases of its mix steps and taken off any tempdeck waits they
+    overlap. Dry runs reuse the phases an earlier dry run ran from the same state with the same labware and pipettes.
+    """
+    key = layout.spec_hash(spec) if plan is None else None
+    if key in _layout_costs:
+        _layout_costs.move_to_end(key)
+        return _layout_costs[key]
+    if plan is None:
+        plan = layout.compile_layout(spec)
+    mixes, waits = _mix_steps(plan)
+    skeleton = list(plan)
+    for i in mixes:
+        skeleton[i] = list(plan[i][:3]) + [dict(plan[i][3], repetitions=0, rate=1.0)]
+    phases = [(steps, hashlib.sha256(json.dumps(steps, sort_keys=True).encode()).digest())
+              for steps in _phases(skeleton)]
+    tempdeck_slot = spec['tempdeck']['slot'] if spec['tempdeck'] else None
+    dry_key = hashlib.sha256(json.dumps([spec['labware'], spec['pipettes'], tempdeck_slot], sort_keys=True).encode()
+                             + b''.join(digest for _, digest in phases)).hexdigest()
+    if dry_key in _dry_runs:
+        _dry_runs.move_to_end(dry_key)
+    else:
+        _dry_runs[dry_key] = _dry_run(spec, phases)
+        if len(_dry_runs) > CACHE_SIZE:
+            _dry_runs.popitem(last=False)
+    run, flow_rates, waited = _dry_runs[dry_key]
+    if mixes:
+        phases = collections.OrderedDict(run.phases)
+        mixing = {}
+        for i in mixes:
+            phase, pipette, _, args = plan[i]
+            mixing[i] = simulate.mix_duration(flow_rates[pipette], args['repetitions'], args['volume'],
+                                              args.get('rate', 1.0))
+            phases[phase] += mixing[i]
+        duration = run.duration + sum(mixing.values())
+        for (i, during), seconds in zip(waits.items(), waited):
+            # The robot mixes through the wait instead of waiting, the ramp ends when it did
+            shorter = min(seconds, sum(mixing[j] for j in during))
+            phases[plan[i][0]] -= shorter
+            duration -= shorter
+        run = RunCost(run.tips, run.reagents, phases, duration)
+    if key is not None:
+        _layout_costs[key] = run
+        if len(_layout_costs) > CACHE_SIZE:
+            _layout_costs.popitem(last=False)
+    return run
+
+
+def cost(target):
+    """
+    RunCost of a protocol file (a path ending in .py) or of a layout (a name in layout.SPECS, a JSON spec file or a
+    spec dict)
+    """
+    if isinstance(target, str) and target.endswith('.py'):
+        return protocol_cost(target)
+    return layout_cost(layout.load_spec(target) if isinstance(target, str) else target)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('targets', nargs='+', help='Protocol files, names of specs in layout.SPECS or JSON spec files')
+    parser.add_argument('--json', action='store_true', help='Print the costs as JSON')
+    args = parser.parse_args(argv)
+
+    costs = collections.OrderedDict()
+    for target in args.targets:
+        start = time.perf_counter()
+        costs[target] = cost(target), time.perf_counter() - start
+    if args.json:
+        print(json.dumps({target: {
+            'tips': run.tips,
+            'reagents_ul': {'{} {}'.format(*well): round(volume, 1) for well, volume in sorted(run.reagents.items())},
+            'phases_s': {phase: round(seconds, 1) for phase, seconds in run.phases.items()},
+            'duration_s': round(run.duration, 1),
+        } for target, (run, _) in costs.items()}, indent=1))
+        return 0
+    for target, (run, elapsed) in costs.items():
+        print('{} ({:.1f} ms to estimate)'.format(target, elapsed * 1000))
+        print('  tips:     {}'.format(', '.join('{} from slot {}'.format(n, slot)
+                                                for slot, n in sorted(run.tips.items()))))
+        for phase, seconds in run.phases.items():
+            print('  {:<24} {}'.format(phase, simulate.format_duration(seconds)))
+        print('  {:<24} {}'.format('total', simulate.format_duration(run.duration)))
+        print('  reagents: {}'.format(', '.join('{:.1f} uL from slot {} {}'.format(volume, *well)
+                                                for well, volume in sorted(run.reagents.items()))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Deck slot optimiser for layout specs. The compiled plan of a spec is simulated once to get the stream of commands and
+which labware each one uses, every move between two pieces of labware is weighted by how often it happens, and labware
+is reassigned to deck slots by local search to minimise the gantry travel those moves add up to. The best slot map is
+then simulated in full and compared with the spec's own.
+
+Usage:
+    python deck.py 3_plate_qPCR_quantification [-o optimised_layout.json]
+
+Modules stay in their slots and so does the labware loaded onto them, the fixed trash stays in slot 12.
+"""
+import argparse
+import collections
+import copy
+import json
+import random
+import sys
+
+import layout
+from simulate import SLOT_ORIGINS
+
+TRASH_SLOT = '12'
+
+
+def transitions(spec, plan=None):
+    """
+    Counts the gantry moves between labware in the simulated command stream of a spec's plan
+
+    Returns
+    -------
+    tuple
+        Counter of (labware key or None for the trash, labware key or None) moves, and the simulated robot
+    """
+    robot, _ = layout.simulate_plan(spec, plan)
+    key_of = {slot: key for key, _, slot in spec['labware']}
+    used = [None if command.slot == TRASH_SLOT else key_of[command.slot]
+            for command in robot.commands if command.slot is not None]
+    moves = collections.Counter((a, b) for a, b in zip(used, used[1:]) if a != b)
+    return moves, robot
+
+
+def _slot_distance(a, b):
+    (ax, ay), (bx, by) = SLOT_ORIGINS[a], SLOT_ORIGINS[b]
+    return ((ax - bx) ** 2 + (ay - by) ** 2) ** 0.5
+
+
+def travel(slots, moves):
+    """
+    Gantry travel in mm the moves between labware add up to with labware in slots, a dict of slot by labware key
+    """
+    return sum(count * _slot_distance(slots.get(a, TRASH_SLOT), slots.get(b, TRASH_SLOT))
+               for (a, b), count in moves.items())
+
+
+def optimise_slots(spec, moves, restarts=20, seed=0):
+    """
+    Searches slot assignments of a spec's labware for the least travel over moves, by pairwise swaps and moves into
+    free slots from the spec's own assignment and from restarts random ones
+
+    Returns
+    -------
+    dict
+        Slot by labware key of the best assignment found
+    """
+    fixed_slots = {TRASH_SLOT}
+    if spec['tempdeck']:
+        fixed_slots.add(spec['tempdeck']['slot'])
+    fixed = {key: slot for key, _, slot in spec['labware'] if slot in fixed_slots}
+    movable = [key for key, _, slot in spec['labware'] if slot not in fixed_slots]
+    free = sorted(set(SLOT_ORIGINS) - fixed_slots, key=int)
+
+    def descend(slots):
+        cost = travel(slots, moves)
+        while True:
+            best = None
+            occupied = {slot: key for key, slot in slots.items() if key in movable}
+            for key in movable:
+                for slot in free:
+                    if slot == slots[key]:
+                        continue
+                    candidate = dict(slots)
+                    other = occupied.get(slot)
+                    if other is not None:
+                        candidate[other] = slots[key]
+                    candidate[key] = slot
+                    candidate_cost = travel(candidate, moves)
+                    if candidate_cost < cost - 1e-6 and (best is None or candidate_cost < best[0]):
+                        best = (candidate_cost, candidate)
+            if best is None:
+                return cost, slots
+            cost, slots = best
+
+    current = dict(fixed, **{key: slot for key, _, slot in spec['labware'] if key in movable})
+    best_cost, best = descend(current)
+    rng = random.Random(seed)
+    for _ in range(restarts):
+        start = dict(fixed, **dict(zip(movable, rng.sample(free, len(movable)))))
+        cost, slots = descend(start)
+        if cost < best_cost - 1e-6:
+            best_cost, best = cost, slots
+    return best
+
+
+def optimise_deck(spec, plan=None):
+    """
+    Finds the slot map of a spec's labware with the least gantry travel and simulates it against the spec's own
+
+    Returns
+    -------
+    tuple
+        The spec with the optimised slots (the spec itself when they are not faster) and a report dict
+    """
+    if plan is None:
+        plan = layout.compile_layout(spec)
+    moves, robot = transitions(spec, plan)
+    slots = optimise_slots(spec, moves)
+    optimised = copy.deepcopy(spec)
+    optimised['labware'] = [[key, name, slots[key]] for key, name, _ in spec['labware']]
+    optimised_robot, _ = layout.simulate_plan(optimised, plan)
+
+    current = {key: slot for key, _, slot in spec['labware']}
+    report = {
+        'slots': [[key, name, current[key], slots[key]] for key, name, _ in spec['labware']],
+        'moves': sum(moves.values()),
+        'estimated_travel_m': [round(travel(current, moves) / 1000, 1), round(travel(slots, moves) / 1000, 1)],
+        'travel_m': [round(robot.distance / 1000, 1), round(optimised_robot.distance / 1000, 1)],
+        'duration_s': [round(robot.time, 1), round(optimised_robot.time, 1)],
+        'saved_s': round(robot.time - optimised_robot.time, 1),
+    }
+    return (optimised if report['saved_s'] > 0 else spec), report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('layout', help='Name of a spec in layout.SPECS or a JSON spec file')
+    parser.add_argument('-o', '--output', help='Write the spec with the optimised slots here as JSON')
+    args = parser.parse_args(argv)
+
+    spec = layout.load_spec(args.layout)
+    optimised, report = optimise_deck(spec)
+    print('{:<22} {:<40} {:>4} -> {}'.format('labware', 'type', 'slot', 'slot'))
+    for key, name, before, after in report['slots']:
+        print('{:<22} {:<40} {:>4} -> {}{}'.format(key, name, before, after, '' if before == after else ' *'))
+    print('Gantry travel {:.1f} m -> {:.1f} m, simulated {:.0f} s -> {:.0f} s ({:.0f} s saved)'.format(
+        report['travel_m'][0], report['travel_m'][1], report['duration_s'][0], report['duration_s'][1],
+        report['saved_s']))
+    if report['saved_s'] <= 0:
+        print('Keeping the current slots')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(optimised, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,35 +1,256 @@
 # COPY AND PASTE INTO EACH PROTOCOL FILE
+import bisect
+import collections
+import itertools
+import json
+import math
+import os
+import time
+
+
+class OutOfTipsError(Exception):
+    """
+    Raised by TipTracker.next_tip() when none of the tracked tip racks can supply the requested number of tips
+    """
+    pass
+
+
 class TipTracker:
-    # TODO: Support multiple tip_racks
-    # TODO: Support returning tips
     """
     TipTracker tracks the tips used by an 8-channel pipette so it can be used as a single channel. TipTracker.next_tip()
     take n tips as an argument and return location of a tiprack that would result in the pipette picking up that many
     tips
+
+    Occupancy is stored as one integer bitmask per column (bit 0 is row A). For every possible column mask a lookup
+    table holds the row the pipette has to be lowered onto to pick up exactly n tips, and each rack keeps a bitmask of
+    the columns able to supply n tips, so next_tip() never scans the racks.
+
+    Tips put back with TipTracker.return_tip() go into a reuse pool keyed by the reagent they touched. A column holding
+    returned reagent tips is not used for fresh pickups until those tips have been reused, so a fresh pickup never picks
+    up a used tip with it.
+
+    With a state_file the occupancy of each rack is loaded from and saved to a small JSON file keyed by the rack's deck
+    slot, so consecutive runs carry on from where the last one stopped. The reuse pool is saved with it, so returned
+    tips are reused by later runs for the same reagent rather than blocking their columns for good. Call reset() once
+    the racks have been replaced.
+
+    The rows and columns are read from the tip racks. On racks with more rows than the pipette has channels (384 tip
+    racks) the channels land on every other row, so each column is tracked as interleaved lanes of channels tips, the
+    lane starting in row A then the lane starting in row B.
     """
-    def __init__(self, tiprack):
-        self.tiprack = tiprack
-        self.letters = list(reversed(list('ABCDEFGH')))
-        self.nums = list(range(1, 12 + 1))
-        self.num_rows = len(self.letters)
-        self.num_cols = len(self.nums)
-        self.rack = []
-
-        # Creates tip layout as nested list of lists
-        for n in self.nums:
-            col = []
-            for l in self.letters:
-                col.append('{}{}'.format(l, n))
-            self.rack.append(col)
+    rows = 'ABCDEFGHIJKLMNOP'
+    num_columns = 12
+    channels = 8
+    # Pick tables by number of rows, shared by every tracker as they are never modified
+    _pick_tables = {}
+
+    def __init__(self, tiprack=None, tipracks=None, state_file=None, autosave=True):
+        if tipracks is None:
+            tipracks = [tiprack] if tiprack is not None else []
+        self.tipracks = list(tipracks)
+        self.tiprack = self.tipracks[0] if self.tipracks else None
+        self.rows, num_columns = self._geometry(self.tipracks)
+        self.interleave = len(self.rows) // self.channels
+        # Bitmask columns are lanes of channels tips, interleave of them per rack column
+        self.num_rows = self.channels
+        self.num_cols = num_columns * self.interleave
+        self.verbose = True
+        self._schedule = collections.deque()
+        self._pool = collections.defaultdict(list)
+        self._last_pickup = None
+        self.state_file = state_file
+        self.autosave = autosave
+        self._state = {}
+
+        if self.num_rows not in self._pick_tables:
+            self._pick_tables[self.num_rows] = self._build_pick_table(self.num_rows)
+        self._pick_rows = self._pick_tables[self.num_rows]
+        full = (1 << self.num_rows) - 1
+        all_columns = (1 << self.num_cols) - 1
+        all_racks = (1 << len(self.tipracks)) - 1
+        # Per rack: one occupancy mask per column
+        self._columns = [[full] * self.num_cols for _ in self.tipracks]
+        # Per rack: mask of the tips in each column that were returned after touching a reagent
+        self._returned = [[0] * self.num_cols for _ in self.tipracks]
+        # Per rack, per n: bitmask of columns that can supply exactly n tips
+        self._fits = [[0] + [all_columns] * self.num_rows for _ in self.tipracks]
+        # Per n: bitmask of racks that have at least one column able to supply n tips
+        self._racks_fitting = [0] + [all_racks] * self.num_rows
+        if state_file is not None:
+            self.load()
+
+    @classmethod
+    def _geometry(cls, tipracks):
+        """
+        Returns
+        -------
+        tuple
+            Row names and number of columns shared by tipracks, a 96 tip rack's when there are none
+        """
+        geometries = set()
+        for tiprack in tipracks:
+            names = [well.get_name() for well in tiprack.wells()]
+            rows = ''.join(sorted({name[0] for name in names}))
+            geometries.add((rows, len({name[1:] for name in names})))
+        if not geometries:
+            return cls.rows[:cls.channels], cls.num_columns
+        assert len(geometries) == 1, "Tip racks of different sizes can not share a TipTracker"
+        rows, num_columns = geometries.pop()
+        assert len(rows) % cls.channels == 0, "Tip rack rows do not line up with {} channels".format(cls.channels)
+        return rows, num_columns
+
+    def _well_name(self, lane, row):
+        # Tip rack well of tip row of a lane
+        col, offset = divmod(lane, self.interleave)
+        return '{}{}'.format(self.rows[row * self.interleave + offset], col + 1)
+
+    @staticmethod
+    def _build_pick_table(num_rows):
+        """
+        For every column occupancy mask, find the row the first channel must be lowered onto so that the pipette picks
+        up exactly n tips (every tip at or below that row is picked up)
+
+        Returns
+        -------
+        list
+            table[mask][n] is the row index, or None if the column cannot supply exactly n tips
+        """
+        table = []
+        for mask in range(1 << num_rows):
+            picks = [None] * (num_rows + 1)
+            for row in range(num_rows):
+                if mask >> row & 1:
+                    picks[bin(mask >> row).count('1')] = row
+            table.append(picks)
+        return table
 
     def __str__(self):
-        for i in range(self.num_rows):
-            row = []
-            for col in self.rack:
-                row.append(col[-i-1])
-            print(row)
+        lines = []
+        for rack_index, columns in enumerate(self._columns):
+            lines.append('Rack {}'.format(rack_index + 1))
+            for rack_row in range(len(self.rows)):
+                row, offset = divmod(rack_row, self.interleave)
+                tips = []
+                for lane in range(offset, self.num_cols, self.interleave):
+                    has_tip = columns[lane] >> row & 1
+                    tips.append(self._well_name(lane, row) if has_tip else None)
+                lines.append(str(tips))
+        return '\n'.join(lines)
+
+    def tips_remaining(self):
+        """
+        Returns
+        -------
+        int
+            Number of tips left across all tracked tip racks
+        """
+        return sum(bin(mask).count('1') for columns in self._columns for mask in columns)
+
+    def load(self):
+        """
+        Restores the occupancy of the tracked tip racks from state_file. Racks without saved state, or a missing
+        state_file, are treated as full
+        """
+        try:
+            with open(self.state_file) as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
+            self._state = {}
+        for rack, tiprack in enumerate(self.tipracks):
+            saved = self._state.get(self._rack_key(tiprack))
+            if saved is None:
+                continue
+            self._returned[rack] = list(saved['returned'])
+            for col, mask in enumerate(saved['columns']):
+                self._set_column(rack, col, mask)
+            for reagent, col, row, n in saved.get('pool', []):
+                self._pool[reagent].append([rack, col, row, n])
+
+    def save(self):
+        """
+        Writes the occupancy of the tracked tip racks to state_file, keeping the state saved for racks in other slots
+        """
+        pools = [[] for _ in self.tipracks]
+        for reagent, entries in self._pool.items():
+            for rack, col, row, n in entries:
+                pools[rack].append([reagent, col, row, n])
+        for rack, tiprack in enumerate(self.tipracks):
+            self._state[self._rack_key(tiprack)] = {'columns': self._columns[rack], 'returned': self._returned[rack],
+                                                    'pool': pools[rack]}
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._state, f)
+        # Replace in one step so a run stopped mid-write never leaves a truncated state file
+        os.replace(tmp_file, self.state_file)
 
-    def next_tip(self, n=1):
+    def reset(self):
+        """
+        Marks every tracked tip rack as full again, e.g. after the racks have been replaced
+        """
+        full = (1 << self.num_rows) - 1
+        for rack in range(len(self.tipracks)):
+            self._returned[rack] = [0] * self.num_cols
+            for col in range(self.num_cols):
+                self._set_column(rack, col, full)
+        self._pool.clear()
+        self._autosave()
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict
+            The occupancy of the tracked tip racks as plain lists, for restore()
+        """
+        return {'columns': [list(columns) for columns in self._columns],
+                'returned': [list(returned) for returned in self._returned]}
+
+    def restore(self, snapshot):
+        """
+        Brings the tracked tip racks back to a snapshot() taken earlier. Tips are only ever taken away, so a tip used
+        since the snapshot (e.g. by a step that was interrupted) stays used
+        """
+        for rack, (columns, returned) in enumerate(zip(snapshot['columns'], snapshot['returned'])):
+            for col, (mask, returned_mask) in enumerate(zip(columns, returned)):
+                mask &= self._columns[rack][col]
+                self._returned[rack][col] = (self._returned[rack][col] | returned_mask) & mask
+                self._set_column(rack, col, mask)
+        self._autosave()
+
+    @staticmethod
+    def _rack_key(tiprack):
+        # Deck slot the tip rack is loaded in
+        return tiprack.get_parent().get_name()
+
+    @classmethod
+    def _reagent_key(cls, reagent):
+        # A well stands for the reagent in it, named by deck slot and well so the saved pool matches the next run's
+        if hasattr(reagent, 'get_parent'):
+            return '{} {}'.format(cls._rack_key(reagent.get_parent()), reagent.get_name())
+        return reagent
+
+    def _autosave(self):
+        if self.state_file is not None and self.autosave:
+            self.save()
+
+    def _set_column(self, rack, col, mask):
+        # Keeps the per-rack and per-n availability bitmasks in step with a column's occupancy
+        self._columns[rack][col] = mask
+        picks = self._pick_rows[0 if self._returned[rack][col] else mask]
+        fits = self._fits[rack]
+        bit = 1 << col
+        rack_bit = 1 << rack
+        for n in range(1, self.num_rows + 1):
+            if picks[n] is None:
+                fits[n] &= ~bit
+            else:
+                fits[n] |= bit
+            if fits[n]:
+                self._racks_fitting[n] |= rack_bit
+            else:
+                self._racks_fitting[n] &= ~rack_bit
+
+    def next_tip(self, n=1, reagent=None):
         """
         Returns location on tiprack that would result in pipette picking up n tips when passed as location parameter to
         Pipette.pick_up_tip()
@@ -38,40 +259,1346 @@ class TipTracker:
         ----------
         n: int
             Number of tips to pick up
+        reagent: str or Well
+            Reagent the tips will be used for, or the well holding it. Returned tips that touched the same reagent are
+            reused first, then returned clean tips, then fresh tips
 
         Returns
         -------
         location
             Location on tiprack that would result in pipette picking up n tips
+
+        Raises
+        ------
+        OutOfTipsError
+            If no tracked tip rack has a column that can supply n tips
         """
-        assert n <= 8, "Cannot pick up more than 8 tips"
-        for i in range(self.num_cols):
-            for j in list(range(self.num_rows)):
-                # Scan up columns until n non-empty tips are found
-                try:
-                    self.rack[i][j+n-1]
-                except IndexError:
-                    continue
-                tips = self.rack[i][j:j+n]
-                # If any tips are empty (None) continue scanning up column or next column
-                if any(x is None for x in tips):
-                    continue
-                else:
-                    # When usable tips are found, set them to None and return highest tip in the column
-                    for t in range(n):
-                        self.rack[i][j+t] = None
-                    tip_name = tips[-1]
-                    print("\nTaking {} tips".format(n))
-                    return self.tiprack.wells(tip_name)
+        assert 0 < n <= self.num_rows, "Cannot pick up more than {} tips".format(self.num_rows)
+        if self._schedule:
+            return self._next_scheduled_tip(n)
+        reagent = self._reagent_key(reagent)
+        for key in ((reagent, None) if reagent is not None else (None,)):
+            if self._pool.get(key):
+                location = self._reuse_tip(key, n)
+                if location is not None:
+                    return location
+        racks = self._racks_fitting[n]
+        if not racks:
+            raise OutOfTipsError("No column with {} tips left in {} tip rack(s) ({} tips remaining)".format(
+                n, len(self.tipracks), self.tips_remaining()))
+        rack = (racks & -racks).bit_length() - 1
+        fits = self._fits[rack][n]
+        col = (fits & -fits).bit_length() - 1
+        return self._take(rack, col, n)
+
+    def _take(self, rack, col, n):
+        mask = self._columns[rack][col]
+        row = self._pick_rows[mask][n]
+        # Every tip at or below row is picked up, only the tips above it stay in the column
+        self._returned[rack][col] &= (1 << row) - 1
+        self._set_column(rack, col, mask & ((1 << row) - 1))
+        self._last_pickup = (rack, col, row, n)
+        self._autosave()
+        if self.verbose:
+            print("\nTaking {} tips".format(n))
+        return self.tipracks[rack].wells(self._well_name(col, row))
+
+    def _reuse_tip(self, reagent, n):
+        entries = self._pool[reagent]
+        for entry in list(entries):
+            rack, col, top, count = entry
+            mask = self._columns[rack][col]
+            if not mask >> top & ((1 << count) - 1):
+                # Clean tips can be taken by fresh pickups, drop entries with none of their tips left
+                entries.remove(entry)
+                continue
+            row = top + count - n
+            # Usable when the n lowest tips of the group are exactly the tips the pipette would pick up
+            if count >= n and self._pick_rows[mask][n] == row:
+                entry[3] -= n
+                if not entry[3]:
+                    entries.remove(entry)
+                return self._take(rack, col, n)
+        return None
+
+    def return_tip(self, reagent=None):
+        """
+        Records that the tips from the last next_tip() were put back in their slots with Pipette.return_tip() so they
+        can be picked up again by next_tip()
+
+        Parameters
+        ----------
+        reagent: str or Well
+            Reagent the tips touched or the well holding it, None if they are still clean. Tips that touched a reagent
+            are only handed out again by next_tip() for the same reagent, also in later runs sharing the state_file
+        """
+        assert self._last_pickup is not None, "No tips to return"
+        rack, col, row, n = self._last_pickup
+        self._last_pickup = None
+        tips = ((1 << n) - 1) << row
+        reagent = self._reagent_key(reagent)
+        if reagent is not None:
+            self._returned[rack][col] |= tips
+        self._set_column(rack, col, self._columns[rack][col] | tips)
+        self._pool[reagent].append([rack, col, row, n])
+        self._autosave()
+
+    def is_full(self):
+        """
+        Returns
+        -------
+        bool
+            Whether every tracked tip rack still holds all of its tips and none has been returned, as plan_tip_usage()
+            schedules assume
+        """
+        full = (1 << self.num_rows) - 1
+        return (all(mask == full for columns in self._columns for mask in columns)
+                and not any(any(returned) for returned in self._returned) and not any(self._pool.values()))
+
+    def replay(self, schedule):
+        """
+        Makes subsequent next_tip() calls follow a schedule made by plan_tip_usage() instead of taking the first
+        available column. Once the schedule is used up next_tip() goes back to taking the first available column
+
+        Parameters
+        ----------
+        schedule: list
+            (n, rack_index, well_name) tuples, one per pickup in the order they will be requested
+        """
+        self._schedule = collections.deque(schedule)
+
+    def _next_scheduled_tip(self, n):
+        planned_n, rack, well_name = self._schedule.popleft()
+        assert planned_n == n, "Tip schedule expected a pickup of {} tips, got {}".format(planned_n, n)
+        if rack >= len(self.tipracks):
+            raise OutOfTipsError("Tip schedule needs tip rack {} but only {} are tracked".format(
+                rack + 1, len(self.tipracks)))
+        row, offset = divmod(self.rows.index(well_name[0]), self.interleave)
+        col = (int(well_name[1:]) - 1) * self.interleave + offset
+        assert self._pick_rows[self._columns[rack][col]][n] == row, \
+            "Tip schedule is out of step with the rack: cannot pick up {} tips at {} on rack {}".format(
+                n, well_name, rack + 1)
+        return self._take(rack, col, n)
+
+
+def plan_tip_usage(pickups, num_rows=8, num_columns=12, interleave=1):
+    """
+    Plans ahead of time which column every tip pickup of a protocol comes from so that the pickups fit on the fewest
+    tip racks with the fewest partially used columns. Full column pickups get a column each, smaller pickups are
+    packed best-fit decreasing so single tips do not break into columns needed for 8-tip pickups
+
+    Parameters
+    ----------
+    pickups: list
+        Number of tips requested by each pickup, in the order the protocol requests them
+    num_rows: int
+        Number of tips per tip rack column
+    num_columns: int
+        Number of columns per tip rack
+    interleave: int
+        Lanes of num_rows tips per column, 2 for a 384 tip rack picked from by an 8-channel pipette
 
+    Returns
+    -------
+    list
+        One (n, rack_index, well_name) tuple per pickup, in the order they are requested, for TipTracker.replay()
+    """
+    rows = TipTracker.rows[:num_rows * interleave]
+    lanes = num_columns * interleave
+    column_of = [None] * len(pickups)
+    num_bins = 0
+    # bins_with_space[c] holds the partially filled columns with exactly c tips unassigned
+    bins_with_space = [[] for _ in range(num_rows + 1)]
+    for i in sorted(range(len(pickups)), key=lambda i: -pickups[i]):
+        n = pickups[i]
+        assert 0 < n <= num_rows, "Cannot pick up more than {} tips".format(num_rows)
+        space = next((c for c in range(n, num_rows) if bins_with_space[c]), None)
+        if space is None:
+            column, space = num_bins, num_rows
+            num_bins += 1
+        else:
+            column = bins_with_space[space].pop()
+        column_of[i] = column
+        bins_with_space[space - n].append(column)
+
+    # Number columns by first use so the first rack is emptied before the next one is touched
+    order = {}
+    for column in column_of:
+        order.setdefault(column, len(order))
+    remaining = [num_rows] * num_bins
+    schedule = []
+    for n, column in zip(pickups, column_of):
+        remaining[column] -= n
+        rack, lane = divmod(order[column], lanes)
+        col, offset = divmod(lane, interleave)
+        schedule.append((n, rack, '{}{}'.format(rows[remaining[column] * interleave + offset], col + 1)))
+    return schedule
+
+
+class LiquidLevelTracker:
+    """
+    LiquidLevelTracker keeps the liquid volume of every registered well and turns it into a location just below the
+    meniscus, so aspirates follow the liquid down instead of always going to the bottom of the tube
+
+    Wells are described by a geometry profile: (height, inner diameter) points from the bottom of the well up, with
+    the diameter changing linearly between them, so conical bottoms and cylinders are both covered. The
+    volume-to-height lookup table of each profile is computed once and shared by every tracker.
+    """
+    geometries = {
+        '2ml-eppendorf': [(0.0, 2.0), (4.0, 8.7), (38.0, 8.7)],
+        '1.5ml-eppendorf': [(0.0, 3.6), (18.0, 8.7), (38.0, 8.7)],
+        '15ml-falcon': [(0.0, 2.0), (22.0, 14.5), (117.5, 14.5)],
+        '50ml-falcon': [(0.0, 3.0), (15.0, 26.7), (113.0, 26.7)],
+        'pcr-well': [(0.0, 1.5), (10.0, 5.0), (19.5, 5.0)],
+        'flat-well': [(0.0, 6.4), (10.5, 6.4)],
+        '384-well': [(0.0, 3.0), (11.5, 3.7)],
+    }
+    step = 0.1  # mm between lookup table entries
+    _tables = {}
+
+    def __init__(self, submerge=1.0, min_height=0.5):
+        """
+        Parameters
+        ----------
+        submerge: float
+            How far below the meniscus (mm) to aspirate from
+        min_height: float
+            Lowest height above the bottom of a well (mm) to aspirate from
+        """
+        self.submerge = submerge
+        self.min_height = min_height
+        self._wells = {}
+
+    @classmethod
+    def _table(cls, geometry):
+        # Cumulative volume (uL) at every step mm of height
+        if geometry not in cls._tables:
+            profile = cls.geometries[geometry]
+            volumes = [0.0]
+            height = 0.0
+            for (h0, d0), (h1, d1) in zip(profile, profile[1:]):
+                while height + cls.step <= h1 + 1e-9:
+                    r0 = (d0 + (d1 - d0) * (height - h0) / (h1 - h0)) / 2
+                    r1 = (d0 + (d1 - d0) * (height + cls.step - h0) / (h1 - h0)) / 2
+                    volumes.append(volumes[-1] + math.pi * cls.step / 3 * (r0 * r0 + r0 * r1 + r1 * r1))
+                    height += cls.step
+            cls._tables[geometry] = volumes
+        return cls._tables[geometry]
+
+    @staticmethod
+    def _well(location):
+        well = location[0] if isinstance(location, tuple) else location
+        return well[0] if isinstance(well, list) else well
+
+    def add(self, wells, volume, geometry):
+        """
+        Registers wells holding volume uL each
+
+        Parameters
+        ----------
+        wells: well or list
+            Wells (or locations) to track
+        volume: float
+            Current volume of each well in uL
+        geometry: str
+            Key of LiquidLevelTracker.geometries describing the inside of the wells
+        """
+        if not isinstance(wells, list):
+            wells = [wells]
+        table = self._table(geometry)
+        for well in wells:
+            self._wells[self._well(well)] = [table, float(volume)]
+
+    def tracks(self, location):
+        return self._well(location) in self._wells
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        list
+            Volume of every tracked well in the order they were added, for restore()
+        """
+        return [volume for _, volume in self._wells.values()]
+
+    def restore(self, snapshot):
+        """
+        Sets the volumes of the tracked wells back to a snapshot() of the same wells
+        """
+        for entry, volume in zip(self._wells.values(), snapshot):
+            entry[1] = volume
+
+    def volume(self, location):
+        return self._wells[self._well(location)][1]
+
+    def height(self, location):
+        """
+        Returns
+        -------
+        float
+            Liquid height above the bottom of the well in mm
+        """
+        table, volume = self._wells[self._well(location)]
+        if volume >= table[-1]:
+            return (len(table) - 1) * self.step
+        i = bisect.bisect_right(table, volume)
+        if i == 0:
+            return 0.0
+        return (i - 1 + (volume - table[i - 1]) / (table[i] - table[i - 1])) * self.step
+
+    def _location(self, well, height):
+        half_depth = well.properties['depth'] / 2
+        return well, well.from_center(x=0, y=0, z=max(-1.0, min(1.0, height / half_depth - 1)))
+
+    def aspirate(self, location, volume):
+        """
+        Takes volume out of a well and returns where to aspirate it from: submerge mm below where the meniscus will be
+        once the volume is gone, so the tip stays in the liquid for the whole aspirate
+
+        Returns
+        -------
+        location
+            (well, offset) location for Pipette.aspirate()
+        """
+        well = self._well(location)
+        entry = self._wells[well]
+        assert entry[1] >= volume - 1e-6, "Aspirating {} uL from {} which only has {:.1f} uL left".format(
+            volume, well, entry[1])
+        entry[1] -= volume
+        return self._location(well, max(self.min_height, self.height(well) - self.submerge))
+
+    def dispense(self, location, volume):
+        """
+        Adds volume to a well and returns a location just above the meniscus to dispense it from
+
+        Returns
+        -------
+        location
+            (well, offset) location for Pipette.dispense()
+        """
+        well = self._well(location)
+        self._wells[well][1] += volume
+        return self._location(well, self.height(well) + self.submerge)
+
+
+MIX_TURNOVERS = 1.5  # times the liquid in a well passes through the tip for it to count as mixed
+MIX_FRACTION = 0.8  # largest share of the liquid in a well taken up per cycle, so the tip never draws air
+MIN_MIX_CYCLES = 3
+MAX_MIX_CYCLES = 50
+MAX_MIX_RATE = 6.0
+MAX_MIX_FLOW = {'aqueous': 300.0, 'viscous': 150.0}  # uL/s fastest aspirate flow that does not splash or foam
+DEFAULT_ASPIRATE_FLOW = {10: 5.0, 50: 25.0, 300: 150.0, 1000: 500.0}  # uL/s at rate 1.0, by pipette max volume
+
+
+def mix_policy(volume, max_volume, geometry=None, viscous=False, repetitions=None, rate=None):
+    """
+    Works out the fewest mix cycles and the fastest safe rate to mix volume uL of liquid with a pipette
+
+    Enough cycles are done for the liquid to pass through the tip MIX_TURNOVERS times, more when it stands taller than
+    twice the tube's width (the tip only stirs the bottom of it), and the rate is capped so the flow stays under what
+    the liquid takes without splashing or foaming, less for viscous liquid. Mixing large tubes thoroughly takes longer
+    than the fixed cycles the protocols were written with, so repetitions and rate can be set to keep those
+
+    Parameters
+    ----------
+    volume: float
+        Liquid in the well in uL
+    max_volume: float
+        Maximum volume of the pipette
+    geometry: str
+        Key of LiquidLevelTracker.geometries describing the well, None to ignore the liquid column's shape
+    viscous: bool
+        Whether the liquid is viscous, like the trehalose-heavy master mix
+    repetitions: int
+        Mix cycles to use instead of the policy's
+    rate: float
+        Rate to use instead of the policy's
+
+    Returns
+    -------
+    tuple
+        Repetitions, mix volume and rate for Pipette.mix()
+    """
+    assert volume > 0, "Cannot mix {} uL of liquid".format(volume)
+    mix_volume = min(max_volume, MIX_FRACTION * volume)
+    if repetitions is None:
+        turnovers = MIX_TURNOVERS
+        if geometry is not None:
+            tracker = LiquidLevelTracker()
+            tracker.add(['well'], volume, geometry)
+            height = tracker.height('well')
+            diameter = max(d for h, d in LiquidLevelTracker.geometries[geometry])
+            turnovers *= max(1.0, height / (2 * diameter))
+        repetitions = int(math.ceil(turnovers * volume / mix_volume))
+        repetitions = max(MIN_MIX_CYCLES, min(MAX_MIX_CYCLES, repetitions))
+    if rate is None:
+        max_flow = MAX_MIX_FLOW['viscous' if viscous else 'aqueous']
+        rate = round(min(MAX_MIX_RATE, max_flow / DEFAULT_ASPIRATE_FLOW.get(max_volume, max_volume / 2)), 2)
+    return repetitions, round(mix_volume, 1), rate
+
+
+def _distance(a, b):
+    return ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5
+
+
+class _Route:
+    """
+    Travel of visiting points in the order of a route, as trips that each start at the start point, visit a run of
+    consecutive route positions and end at the end point. A position shared by two trips is dispensed to in both. The
+    travel is a term per position for the trips starting and ending there plus a term per pair of neighbouring
+    positions visited one after the other, so moving points around only changes the terms next to the positions
+    involved
+    """
+    def __init__(self, points, trips, start=None, end=None):
+        n = len(points)
+        self.distances = [[_distance(a, b) for b in points] for a in points]
+        self.entry = [_distance(start, point) if start is not None else 0.0 for point in points]
+        self.exit = [_distance(point, end) if end is not None else 0.0 for point in points]
+        self.starts = [0] * n
+        self.ends = [0] * n
+        # Whether positions k and k + 1 are visited one after the other
+        self.linked = [False] * n
+        for trip in trips:
+            self.starts[trip[0]] += 1
+            self.ends[trip[-1]] += 1
+            for k in trip[:-1]:
+                self.linked[k] = True
+        # The segment from position i up to reach[i] is the longest that can be reversed with only the terms at its
+        # ends changing: a run of linked positions with no trip starting or ending inside it
+        self.reach = []
+        for i in range(n):
+            j = i + 1
+            while j < n and self.linked[j - 1] and (j == i + 1 or not (self.starts[j - 1] or self.ends[j - 1])):
+                j += 1
+            self.reach.append(j)
+
+    def cost(self, k, point):
+        return self.starts[k] * self.entry[point] + self.ends[k] * self.exit[point]
+
+    def link(self, k, a, b):
+        return self.distances[a][b] if self.linked[k] else 0.0
+
+    def length(self, route):
+        return (sum(self.cost(k, point) for k, point in enumerate(route)) +
+                sum(self.link(k, route[k], route[k + 1]) for k in range(len(route) - 1)))
+
+    def improve(self, route):
+        """
+        Shortens route in place for as long as reversing a segment inside a trip (2-opt) or swapping two points
+        shortens it, each candidate move costing only the terms at its ends
+        """
+        n = len(route)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(n - 1):
+                for j in range(i + 2, self.reach[i] + 1):
+                    a, b = route[i], route[j - 1]
+                    delta = (self.cost(i, b) + self.cost(j - 1, a) - self.cost(i, a) - self.cost(j - 1, b))
+                    if i:
+                        delta += self.link(i - 1, route[i - 1], b) - self.link(i - 1, route[i - 1], a)
+                    if j < n:
+                        delta += self.link(j - 1, a, route[j]) - self.link(j - 1, b, route[j])
+                    if delta < -1e-9:
+                        route[i:j] = route[i:j][::-1]
+                        improved = True
+            for i in range(n - 1):
+                for j in range(i + 1, n):
+                    delta = self._swap_delta(route, i, j)
+                    if delta < -1e-9:
+                        route[i], route[j] = route[j], route[i]
+                        improved = True
+        return route
+
+    def _swap_delta(self, route, i, j):
+        def at(k):
+            return route[j] if k == i else route[i] if k == j else route[k]
+        links = {k for k in (i - 1, i, j - 1, j) if 0 <= k < len(route) - 1}
+        before = (self.cost(i, route[i]) + self.cost(j, route[j]) +
+                  sum(self.link(k, route[k], route[k + 1]) for k in links))
+        after = self.cost(i, route[j]) + self.cost(j, route[i]) + sum(self.link(k, at(k), at(k + 1)) for k in links)
+        return after - before
+
+
+def order_locations(locations, start=None, trips=None, end=None):
+    """
+    Reorders dispense locations to shorten gantry travel with a nearest-neighbour route improved by 2-opt and swap
+    passes. A pass weighs each of its O(n^2) candidate moves by the few distances at the move's ends
+
+    Parameters
+    ----------
+    locations: list
+        (well, offset) location tuples
+    start: location
+        Where the pipette aspirates from before each trip
+    trips: list
+        Positions in locations dispensed to per aspirate, as lists of consecutive positions in the order they are
+        visited, a position split between two aspirates ending one list and starting the next (see order_dests()). One
+        trip over every location by default
+    end: location
+        Where the pipette goes after each trip, e.g. the trash it blows out into. No travel is counted after a trip
+        by default
+
+    Returns
+    -------
+    tuple
+        The reordered locations and the travel saved in mm (0 when the original order is already as short)
+    """
+    def point(location):
+        well = location[0] if isinstance(location, tuple) else location
+        return tuple(well.coordinates())[:2]
 
-def multiwell_location_offset(plates, x=0, y=0, z=0, start_column=None, end_column=None, columns=None):
+    if len(locations) < 3:
+        return list(locations), 0.0
+    if trips is None:
+        trips = [list(range(len(locations)))]
+    route = _Route([point(location) for location in locations], trips, start=None if start is None else point(start),
+                   end=None if end is None else point(end))
+
+    # Nearest neighbour from the start of each trip
+    remaining = set(range(len(locations)))
+    order = []
+    previous = None
+    for k in range(len(locations)):
+        if route.starts[k] and start is not None:
+            nearest = min(remaining, key=lambda i: (route.entry[i], i))
+        elif previous is None:
+            nearest = 0
+        else:
+            nearest = min(remaining, key=lambda i: (route.distances[previous][i], i))
+        remaining.remove(nearest)
+        order.append(nearest)
+        previous = nearest
+    route.improve(order)
+
+    saved = route.length(list(range(len(locations)))) - route.length(order)
+    if saved <= 1e-9:
+        return list(locations), 0.0
+    return [locations[i] for i in order], saved
+
+
+def order_dests(pipette, volume, source, dests, disposal_vol=0, blow_out=False, min_dispense=None, planned=True):
+    """
+    Reorders the destinations of a distribute from source to shorten gantry travel (see order_locations()), routing a
+    trip from the source per aspirate the way the distribute will fill the pipette
+
+    Parameters
+    ----------
+    pipette: Pipette
+        Pipette distributing, whose maximum volume sets how many destinations each aspirate reaches
+    volume: float
+        Volume for every destination
+    planned: bool
+        Whether the distribute is a distribute_planned() one, which fills every aspirate and splits a destination's
+        volume between two aspirates, or a Pipette.distribute() one, which never splits a destination
+
+    See plan_distribute() for the other parameters
+
+    Returns
+    -------
+    tuple
+        The reordered destinations and the travel saved in mm
+    """
+    assert isinstance(volume, (int, float)), "Only distributes of one volume to every destination can be reordered"
+    dests = list(dests)
+    if planned:
+        trips = []
+        min_dispense = pipette.min_volume if min_dispense is None else min_dispense
+        for action, _, position in plan_distribute(volume, None, range(len(dests)), pipette.max_volume,
+                                                   disposal_vol=disposal_vol, min_dispense=min_dispense):
+            if action == 'aspirate':
+                trips.append([])
+            elif action == 'dispense':
+                trips[-1].append(position)
+    else:
+        per_aspirate = max(1, int((pipette.max_volume - disposal_vol) / volume + 1e-9))
+        trips = [list(range(first, min(first + per_aspirate, len(dests))))
+                 for first in range(0, len(dests), per_aspirate)]
+    # Each trip ends where the pipette blows out, or back at the source for the next aspirate
+    if blow_out and not isinstance(blow_out, bool):
+        end = blow_out
+    elif blow_out or disposal_vol:
+        end = pipette.trash_container[0]
+    else:
+        end = source
+    return order_locations(dests, start=source, trips=trips, end=end)
+
+
+_location_tables = {}
+
+
+def location_table(plate, x=0, y=0, z=0):
+    """
+    Returns the Well.from_center(x, y, z) offset of every well of plate by well name. Offsets only depend on the
+    labware definition, so each table is computed once per labware type and offset and shared by every plate of that
+    type for as long as the interpreter runs
+
+    Parameters
+    ----------
+    plate: Container
+        Plate to look the offsets up for
+    x, y, z: float
+        Offset from the centre of each well, as fractions of its half width and depth
+
+    Returns
+    -------
+    dict
+        Offset by well name
+    """
+    key = (plate.properties.get('type') or id(plate), x, y, z)
+    table = _location_tables.get(key)
+    if table is None:
+        table = {well.get_name(): well.from_center(x=x, y=y, z=z) for well in plate.wells()}
+        _location_tables[key] = table
+    return table
+
+
+def iter_multiwell_locations(plates, x=0, y=0, z=0, start_column=None, end_column=None, columns=None, quadrants=None,
+                             channels=8):
+    """
+    Yields (well, offset) locations at the top well of each column of plates, for a multi-channel pipette, one plate
+    at a time so the locations of many plates are never held at once
+
+    On plates with more rows than channels (384-well plates) the channels land on every other row, so each column is
+    dispensed to from its row A then its row B well. Going column by column this covers the plate quadrant by quadrant
+    interleaved: A1, B1, A2, B2, A3...
+
+    Parameters
+    ----------
+    plates: iterable
+        Plates, or a single plate, to yield locations on
+    x, y, z: float
+        Offset from the centre of each well, as fractions of its half width and depth
+    start_column, end_column: str
+        Range of columns, used when columns is not given
+    columns: list
+        Column names
+    quadrants: container
+        Of 'A1', 'B1', 'A2', 'B2', the 384-well quadrants to yield (named by their first well), all of them by default
+    channels: int
+        Channels of the pipette
+    """
     from opentrons.legacy_api.containers.placeable import Container
     if isinstance(plates, Container):
-        plates = list(plates)
-    if columns is not None:
-        return [(col[0], col[0].from_center(x=x, y=y, z=z)) for plate in plates for col in plate.columns(columns)]
-    elif start_column and end_column:
-        return [(col[0], col[0].from_center(x=x, y=y, z=z)) for plate in plates for col in plate.columns(start_column, to=end_column)]
+        plates = [plates]
+    for plate in plates:
+        if columns is not None:
+            plate_columns = plate.columns(columns)
+        else:
+            plate_columns = plate.columns(start_column, to=end_column)
+        table = location_table(plate, x=x, y=y, z=z)
+        for col in plate_columns:
+            for well in col[:max(1, len(col) // channels)]:
+                name = well.get_name()
+                # Odd columns belong to the A1 and B1 quadrants, even columns to A2 and B2
+                if quadrants is None or '{}{}'.format(name[0], 2 - int(name[1:]) % 2) in quadrants:
+                    yield well, table[name]
+
+
+def multiwell_location_offset(plates, x=0, y=0, z=0, start_column=None, end_column=None, columns=None, order=None,
+                              pipette=None, volume=None, source=None, disposal_vol=None, quadrants=None):
+    """
+    Returns (well, offset) locations at the top well of each column of plates, for a multi-channel pipette. Use
+    iter_multiwell_locations() instead when the locations go to distribute_planned(), which takes them as they come
+
+    Parameters
+    ----------
+    plates: list
+        Plates, or a single plate, to return locations on
+    x, y, z: float
+        Offset from the centre of each well, as fractions of its half width and depth
+    start_column, end_column: str
+        Range of columns, used when columns is not given
+    columns: list
+        Column names
+    order: str
+        None keeps plate by plate column order, 'shortest' reorders the locations to shorten the gantry travel of
+        pipette.distribute() of volume from source (see order_dests())
+    pipette, volume, source, disposal_vol:
+        The distribute the locations are reordered for, disposal_vol defaulting to the pipette's minimum volume as in
+        Pipette.distribute()
+    quadrants: container
+        384-well quadrants to return locations in, see iter_multiwell_locations()
+
+    Returns
+    -------
+    list
+        (well, offset) location tuples
+    """
+    if columns is None and not (start_column and end_column):
+        return None
+    locations = list(iter_multiwell_locations(plates, x=x, y=y, z=z, start_column=start_column,
+                                              end_column=end_column, columns=columns, quadrants=quadrants))
+    if order == 'shortest':
+        disposal_vol = pipette.min_volume if disposal_vol is None else disposal_vol
+        locations, saved = order_dests(pipette, volume, source, locations, disposal_vol=disposal_vol, planned=False)
+        print("\nReordered {} locations, saving {:.0f} mm of travel".format(len(locations), saved))
+    return locations
+
+
+def plan_distribute(volume, source, dests, max_volume, disposal_vol=0, blow_out=False, min_dispense=1.0):
+    """
+    Yields the aspirate and dispense steps that distribute volume from source to each destination with the fewest
+    aspirates, taking the destinations as they come. Unlike Pipette.distribute(), which splits a volume larger than
+    the pipette evenly and never shares a destination between aspirates, every aspirate is filled up to max_volume and
+    a destination's volume carries over into the next aspirate when both parts are at least min_dispense
+
+    Parameters
+    ----------
+    volume: float or iterable
+        Volume for every destination, or one volume per destination
+    source: location
+        Location to aspirate from
+    dests: iterable
+        Locations to dispense to, in order
+    max_volume: float
+        Maximum volume of the pipette
+    disposal_vol: float
+        Extra volume aspirated each time and blown out after the last dispense
+    blow_out: bool or location
+        Blow out after each aspirate's dispenses, into the trash if True
+    min_dispense: float
+        Smallest part a destination's volume may be split into
+
+    Yields
+    ------
+    tuple
+        ('aspirate' | 'dispense' | 'blow_out', volume, location) steps, a blow_out location of None meaning the trash
+    """
+    volumes = itertools.repeat(volume) if isinstance(volume, (int, float)) else volume
+    capacity = max_volume - disposal_vol
+    assert capacity > 0, "Disposal volume leaves no room in the tip"
+    blow_out_location = None if isinstance(blow_out, bool) else blow_out
+    trip = []
+
+    def finish_trip():
+        steps = [('aspirate', sum(part for part, _ in trip) + disposal_vol, source)]
+        steps.extend(('dispense', part, dest) for part, dest in trip)
+        if disposal_vol or blow_out:
+            steps.append(('blow_out', None, blow_out_location))
+        del trip[:]
+        return steps
+
+    for vol, dest in zip(volumes, dests):
+        remaining = vol
+        while remaining > 1e-9:
+            space = capacity - sum(part for part, _ in trip)
+            part = min(remaining, space)
+            if part < remaining and (part < min_dispense or remaining - part < min_dispense):
+                if trip:
+                    # Splitting here would leave a part too small to dispense accurately, start a new aspirate
+                    yield from finish_trip()
+                    continue
+                part = remaining - min_dispense
+            trip.append((part, dest))
+            remaining -= part
+            if capacity - sum(p for p, _ in trip) < 1e-9:
+                yield from finish_trip()
+    if trip:
+        yield from finish_trip()
+
+
+def distribute_planned(pipette, volume, source, dests, disposal_vol=0, blow_out=False, new_tip='once',
+                       min_dispense=None, rate=1.0, liquid_levels=None, order=None):
+    """
+    Pipette.distribute() replacement that runs the steps of plan_distribute(), taking the fewest aspirates. dests can
+    be any iterable, e.g. iter_multiwell_locations(), and is only read as far as the current aspirate needs unless
+    they are reordered
+
+    Parameters
+    ----------
+    pipette: Pipette
+        Pipette to distribute with
+    new_tip: str
+        'once' picks up a tip first (unless one is attached) and drops it at the end, 'never' uses the attached tip
+    min_dispense: float
+        Smallest part a destination's volume may be split into, the pipette's minimum volume by default
+    liquid_levels: LiquidLevelTracker
+        When given, aspirates from and dispenses into wells it tracks follow the liquid level
+    order: str
+        None dispenses in the order of dests, 'shortest' reorders them to shorten gantry travel (see order_dests())
+
+    See plan_distribute() for the other parameters
+    """
+    if min_dispense is None:
+        min_dispense = pipette.min_volume
+    counts = collections.Counter()
+    saved = None
+    if order == 'shortest':
+        dests, saved = order_dests(pipette, volume, source, dests, disposal_vol=disposal_vol, blow_out=blow_out,
+                                   min_dispense=min_dispense)
+
+    def counted(dests):
+        for dest in dests:
+            counts['locations'] += 1
+            yield dest
+
+    steps = plan_distribute(volume, source, counted(dests), pipette.max_volume, disposal_vol=disposal_vol,
+                            blow_out=blow_out, min_dispense=min_dispense)
+    if new_tip == 'once' and not pipette.current_tip():
+        pipette.pick_up_tip()
+    for action, vol, location in steps:
+        if liquid_levels is not None and action != 'blow_out' and liquid_levels.tracks(location):
+            if action == 'aspirate':
+                location = liquid_levels.aspirate(location, vol)
+            else:
+                location = liquid_levels.dispense(location, vol)
+        if action == 'aspirate':
+            counts['aspirates'] += 1
+            pipette.aspirate(vol, location, rate=rate)
+        elif action == 'dispense':
+            pipette.dispense(vol, location, rate=rate)
+        else:
+            pipette.blow_out(pipette.trash_container if location is None else location)
+    if new_tip == 'once':
+        pipette.drop_tip()
+    print("\nDistributed to {} locations with {} aspirates".format(counts['locations'], counts['aspirates']))
+    if saved is not None:
+        print("Reordered {} locations, saving {:.0f} mm of travel".format(len(dests), saved))
+
+
+def run_clock(robot):
+    """
+    Returns the clock RunProfiler should time calls with: the simulated robot's clock under simulate.py, where calls
+    take no real time, and wall time on the robot
+    """
+    if isinstance(getattr(robot, 'time', None), float):
+        return lambda: robot.time
+    return time.monotonic
+
+
+class RunProfiler:
+    """
+    RunProfiler times the calls a protocol makes on its pipettes and the robot. Every call is kept as a compact
+    (phase, depth, name, pipette, start, end, volume, location) record in a ring buffer of the last capacity calls,
+    and per-phase totals are kept for the whole run so nothing is lost when the buffer wraps. A robot.comment() starts
+    a new phase named after its message.
+
+    Calls made from inside other calls (the pick_up_tip, aspirate and dispense steps of a transfer) are recorded one
+    level deeper and only count once towards the phase totals.
+    """
+    methods = ('pick_up_tip', 'drop_tip', 'return_tip', 'transfer', 'distribute', 'consolidate', 'mix', 'aspirate',
+               'dispense', 'blow_out')
+    # Position of the volume and location arguments of each method, None when it has none
+    arguments = {'transfer': (0, 1), 'distribute': (0, 1), 'consolidate': (0, 1), 'mix': (1, 2), 'aspirate': (0, 1),
+                 'dispense': (0, 1), 'pick_up_tip': (None, 0), 'blow_out': (None, 0)}
+
+    def __init__(self, capacity=4096, clock=time.monotonic):
+        self.records = collections.deque(maxlen=capacity)
+        self.clock = clock
+        self.phase = 'setup'
+        self.calls = 0
+        self._stack = []
+        self._robot_comment = None
+        # (phase, call path) -> [count, seconds, uL]
+        self._totals = collections.OrderedDict()
+
+    def instrument(self, *pipettes):
+        """
+        Wraps the methods of pipettes so every call is recorded
+        """
+        for pipette in pipettes:
+            name = getattr(pipette, 'name', None) or type(pipette).__name__
+            for method in self.methods:
+                if hasattr(pipette, method):
+                    setattr(pipette, method, self._wrap(getattr(pipette, method), method, name))
+
+    def instrument_robot(self, robot):
+        """
+        Wraps robot.comment() so each comment starts a new phase, until finish(). The robot outlives the protocol on
+        the robot's server, so a wrapper left behind by a run that never reached finish() is replaced, not wrapped
+        """
+        comment = getattr(robot.comment, 'unwrapped', robot.comment)
+
+        def wrapper(msg, *args, **kwargs):
+            self.phase = str(msg)
+            return comment(msg, *args, **kwargs)
+        wrapper.unwrapped = comment
+        robot.comment = wrapper
+        self._robot_comment = (robot, comment)
+
+    def finish(self):
+        """
+        Puts back the robot.comment() wrapped by instrument_robot()
+        """
+        if self._robot_comment is not None:
+            robot, robot.comment = self._robot_comment
+            self._robot_comment = None
+
+    def _wrap(self, method, name, pipette):
+        volume_arg, location_arg = self.arguments.get(name, (None, None))
+
+        def wrapper(*args, **kwargs):
+            volume = args[volume_arg] if volume_arg is not None and len(args) > volume_arg else kwargs.get('volume')
+            location = args[location_arg] if location_arg is not None and len(args) > location_arg else \
+                kwargs.get('location')
+            self._stack.append(name)
+            # Added before the call so call paths keep the order they were first entered in, parents first
+            totals = self._totals.setdefault((self.phase, tuple(self._stack)), [0, 0.0, 0.0])
+            start = self.clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                end = self.clock()
+                self._stack.pop()
+                self._record(totals, name, pipette, start, end, volume, location)
+        return wrapper
+
+    def _record(self, totals, name, pipette, start, end, volume, location):
+        self.records.append((self.phase, len(self._stack), name, pipette, start, end, volume, location))
+        self.calls += 1
+        totals[0] += 1
+        totals[1] += end - start
+        if isinstance(volume, (int, float)):
+            totals[2] += volume
+
+    def profile(self):
+        """
+        Returns
+        -------
+        dict
+            Per-phase totals: the phase duration (top level calls only) and the count, seconds and volume of every
+            call path in it, e.g. 'distribute;aspirate'
+        """
+        phases = collections.OrderedDict()
+        for (phase, path), (count, seconds, volume) in self._totals.items():
+            entry = phases.setdefault(phase, {'duration_s': 0.0, 'calls': collections.OrderedDict()})
+            if len(path) == 1:
+                entry['duration_s'] += seconds
+            entry['calls'][';'.join(path)] = {'count': count, 'duration_s': round(seconds, 3),
+                                              'volume_ul': round(volume, 2)}
+        for entry in phases.values():
+            entry['duration_s'] = round(entry['duration_s'], 3)
+        return {'calls': self.calls, 'buffered': len(self.records), 'phases': phases}
+
+    def flame(self, width=40):
+        """
+        Returns the profile as indented text with a bar per call path scaled to the longest phase
+        """
+        profile = self.profile()
+        longest = max([entry['duration_s'] for entry in profile['phases'].values()] + [1e-9])
+        lines = []
+        for phase, entry in profile['phases'].items():
+            lines.append('{:<36} {:>9.1f} s {}'.format(phase[:36], entry['duration_s'],
+                                                        '#' * int(round(width * entry['duration_s'] / longest))))
+            for path, call in entry['calls'].items():
+                depth = path.count(';') + 1
+                label = '{}{} x{}'.format('  ' * depth, path.rsplit(';', 1)[-1], call['count'])
+                lines.append('{:<36} {:>9.1f} s {}'.format(label[:36], call['duration_s'],
+                                                            '#' * int(round(width * call['duration_s'] / longest))))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """
+        Writes the profile to path as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.profile(), f, indent=1)
+
+
+class InterruptedStepError(Exception):
+    """
+    Raised by run_plan() instead of resuming a run that stopped part way through a step moving liquid, as running the
+    step again would dispense into its wells twice
+    """
+    pass
+
+
+class RunJournal:
+    """
+    RunJournal durably records the progress of a plan run by run_plan(), so a run stopped part way through (e-stop,
+    tip jam) can be resumed at the step it stopped on instead of being repeated from the start
+
+    The journal is an append-only file of JSON lines: a header naming the plan, then one line per completed step with
+    the step index, the state of every TipTracker and the tracked liquid volumes. A step moving liquid also gets a line
+    when it starts, so a run stopped part way through one is not resumed by repeating it. Each line is flushed and
+    synced to disk before the step goes on, and a line cut short by the robot stopping mid-write is ignored when the
+    journal is read back. The journal is removed once the run completes.
+    """
+    def __init__(self, path, plan_key=None, resume=True, skip_interrupted=False):
+        """
+        Parameters
+        ----------
+        path: str
+            Journal file
+        plan_key: str
+            Identifies the plan, a journal left by a run of another plan is not resumed
+        resume: bool
+            Resume an unfinished run found in the journal, False always starts from the first step
+        skip_interrupted: bool
+            Resume after the step moving liquid the run stopped part way through, once it has been finished by hand.
+            By default run_plan() raises InterruptedStepError instead of resuming such a run
+        """
+        self.path = path
+        self.plan_key = plan_key
+        self.resume = resume
+        self.skip_interrupted = skip_interrupted
+        self._entries = None
+        self._started = None
+        self._file = None
+
+    def entries(self):
+        """
+        Returns
+        -------
+        list
+            Entries of the steps completed by an unfinished run of the same plan, oldest first
+        """
+        if self._entries is None:
+            self._entries = []
+            try:
+                with open(self.path) as f:
+                    lines = f.read().split('\n')
+            except FileNotFoundError:
+                lines = []
+            for i, line in enumerate(lines):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if i == 0:
+                    if entry.get('plan') != self.plan_key:
+                        break
+                elif 'started' in entry:
+                    self._started = entry['started']
+                else:
+                    self._entries.append(entry)
+                    self._started = None
+        return self._entries
+
+    def interrupted_step(self):
+        """
+        Returns
+        -------
+        int
+            Index of the step moving liquid the unfinished run stopped part way through, None when it stopped between
+            steps or there is nothing to resume
+        """
+        self.entries()
+        return self._started if self.resume else None
+
+    def resume_step(self):
+        """
+        Returns
+        -------
+        int
+            Index of the first step the unfinished run did not complete, 0 when there is nothing to resume
+        """
+        entries = self.entries() if self.resume else []
+        return entries[-1]['step'] + 1 if entries else 0
+
+    def open(self):
+        """
+        Starts journaling a run. A run that is resumed keeps its entries, rewritten without any line cut short so the
+        entries appended after them can be read back
+        """
+        entries = self.entries() if self.resume else []
+        started = [{'started': self.interrupted_step()}] if self.interrupted_step() is not None else []
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                            for entry in [{'plan': self.plan_key}] + entries + started))
+        os.replace(tmp_file, self.path)
+        self._entries = entries
+        self._file = open(self.path, 'a')
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def begin(self, step):
+        """
+        Appends the entry of a step moving liquid that is about to start
+
+        Parameters
+        ----------
+        step: int
+            Index of the step in the plan
+        """
+        self._write({'started': step})
+        self._started = step
+
+    def record(self, step, tip_trackers=None, liquid_levels=None):
+        """
+        Appends the entry of a completed step
+
+        Parameters
+        ----------
+        step: int
+            Index of the step in the plan
+        tip_trackers: dict
+            TipTracker by pipette key
+        liquid_levels: LiquidLevelTracker
+            Tracker of the liquid volumes
+        """
+        entry = {
+            'step': step,
+            'tips': {key: tracker.snapshot() for key, tracker in (tip_trackers or {}).items()},
+            'volumes': liquid_levels.snapshot() if liquid_levels is not None else [],
+        }
+        self._write(entry)
+        self._entries.append(entry)
+        self._started = None
+
+    def finish(self):
+        """
+        Closes and removes the journal of a completed run, so the next run starts from the first step
+        """
+        self._file.close()
+        self._file = None
+        os.remove(self.path)
+
+
+def resolve_location(labware, ref):
+    """
+    Turns a location reference from a compiled layout plan into an opentrons location
+
+    Parameters
+    ----------
+    labware: dict
+        Loaded labware by key
+    ref: list
+        [labware key, well name] for the well itself, [labware key, well name, 'bottom' | 'top'], or
+        [labware key, well name, 'center', x, y, z] for Well.from_center(x, y, z)
+
+    Returns
+    -------
+    location
+        Well or (well, offset) location tuple
+    """
+    plate = labware[ref[0]]
+    well = plate.wells(ref[1])
+    if len(ref) == 2:
+        return well
+    if ref[2] == 'bottom':
+        return well.bottom()
+    if ref[2] == 'top':
+        return well.top()
+    return well, location_table(plate, x=ref[3], y=ref[4], z=ref[5])[ref[1]]
+
+
+def load_deck(labware_list, pipette_specs, tempdeck_slot=None, state_file=None, autosave=True):
+    """
+    Loads the modules, labware and pipettes of a layout spec
+
+    Parameters
+    ----------
+    labware_list: list
+        [key, labware name, slot] entries, labware in tempdeck_slot is loaded onto the tempdeck
+    pipette_specs: dict
+        [model, mount, tip rack keys] by pipette key, multi-channel pickups are tracked with a TipTracker
+    tempdeck_slot: str
+        Slot of the tempdeck, None when it is not used
+    state_file: str
+        TipTracker state file
+
+    Returns
+    -------
+    tuple
+        Labware, pipettes, modules and tip trackers, each a dict by key
+    """
+    from opentrons import labware, instruments, modules
+
+    loaded_modules = {}
+    if tempdeck_slot:
+        loaded_modules['tempdeck'] = modules.load('tempdeck', tempdeck_slot)
+    loaded = {}
+    for key, name, slot in labware_list:
+        loaded[key] = labware.load(name, slot, share=slot == tempdeck_slot)
+
+    pipettes = {}
+    tip_trackers = {}
+    for key, (model, mount, racks) in pipette_specs.items():
+        tip_racks = [loaded[rack] for rack in racks]
+        pipettes[key] = getattr(instruments, model)(mount=mount, tip_racks=tip_racks)
+        if model.endswith('Multi'):
+            tip_trackers[key] = TipTracker(tipracks=tip_racks, state_file=state_file, autosave=autosave)
+    return loaded, pipettes, loaded_modules, tip_trackers
+
+
+def schedule_tips(plan, tip_trackers):
+    """
+    Makes each TipTracker on full racks replay a plan_tip_usage() schedule of the pickups its pipette makes in plan,
+    packing them onto the fewest columns. Pipettes that re-rack tips keep taking the first column with room
+
+    Parameters
+    ----------
+    plan: list
+        [phase, pipette key, action, arguments] steps of the whole run
+    tip_trackers: dict
+        TipTracker by pipette key
+    """
+    for key, tracker in tip_trackers.items():
+        steps = [(action, args) for _, pipette_key, action, args in plan if pipette_key == key]
+        if tracker.is_full() and not any(action == 'return_tip' for action, _ in steps):
+            pickups = [args.get('n', 1) for action, args in steps if action == 'pick_up_tip']
+            tracker.replay(plan_tip_usage(pickups, num_rows=tracker.num_rows,
+                                          num_columns=tracker.num_cols // tracker.interleave,
+                                          interleave=tracker.interleave))
+
+
+def run_plan(plan, labware, pipettes, modules=None, tip_trackers=None, liquid_levels=None, start=0, profiler=None,
+             journal=None):
+    """
+    Executes the steps of a plan compiled by layout.compile_layout()
+
+    Pickups of a pipette with a TipTracker follow a plan_tip_usage() schedule when the plan is a list, the run starts
+    at the first step on full racks and the pipette never re-racks its tips. Steps before start are fast-forwarded
+    without moving the robot: only the module and liquid tracking steps are run,
+    the journaled tip and liquid state is restored, pipettes without a TipTracker skip the tips taken by those steps,
+    and a pipette that was using a tip at start picks up a fresh one. The step run at start is run again from its
+    beginning, unless the journal shows it is a step moving liquid that had already started (see RunJournal)
+
+    Parameters
+    ----------
+    plan: iterable
+        [phase, pipette key, action, arguments] steps, read one at a time so they can be generated as the run goes
+    labware: dict
+        Loaded labware by key
+    pipettes: dict
+        Pipettes by key
+    modules: dict
+        Loaded modules by key
+    tip_trackers: dict
+        TipTracker by pipette key, pickups of those pipettes go through the tracker
+    liquid_levels: LiquidLevelTracker
+        Tracker for the wells registered by 'track_liquid' steps
+    start: int
+        Index of the first step to run
+    profiler: RunProfiler
+        Profiler to tell the phase of each step
+    journal: RunJournal
+        Journal to record every completed step in, and to resume the unfinished run it holds from
+    """
+    modules = modules or {}
+    tip_trackers = tip_trackers or {}
+
+    def location(ref):
+        if ref is None:
+            return None
+        if isinstance(ref[0], list):
+            return [resolve_location(labware, r) for r in ref]
+        return resolve_location(labware, ref)
+
+    def execute(phase, pipette_key, action, args):
+        pipette = pipettes.get(pipette_key)
+        if profiler is not None:
+            profiler.phase = phase
+        if action == 'set_temperature':
+            modules[args['module']].set_temperature(args['celsius'])
+        elif action == 'wait_for_temp':
+            modules[args['module']].wait_for_temp()
+        elif action == 'track_liquid':
+            liquid_levels.add(location(args['wells']), args['volume'], args['geometry'])
+        elif action == 'pick_up_tip':
+            tracker = tip_trackers.get(pipette_key)
+            if tracker is not None:
+                tip = tracker.next_tip(args.get('n', 1), reagent=args.get('reagent'))
+                pipette.pick_up_tip(location=tip, presses=args.get('presses'))
+            else:
+                pipette.pick_up_tip()
+        elif action == 'drop_tip':
+            pipette.drop_tip()
+        elif action == 'return_tip':
+            pipette.return_tip()
+            tip_trackers[pipette_key].return_tip(reagent=args.get('reagent'))
+        elif action == 'mix':
+            pipette.mix(args['repetitions'], args['volume'], location(args.get('location')), rate=args.get('rate', 1.0))
+        elif action in ('transfer', 'distribute', 'consolidate'):
+            kwargs = {key: value for key, value in args.items() if key not in ('volume', 'source', 'dest', 'order')}
+            dest = location(args['dest'])
+            if args.get('order') == 'shortest':
+                disposal_vol = kwargs.get('disposal_vol', pipette.min_volume)
+                dest, saved = order_dests(pipette, args['volume'], location(args['source']), dest,
+                                          disposal_vol=disposal_vol, blow_out=kwargs.get('blow_out', False),
+                                          planned=False)
+                print("\nReordered {} locations, saving {:.0f} mm of travel".format(len(dest), saved))
+            getattr(pipette, action)(args['volume'], location(args['source']), dest, **kwargs)
+        elif action == 'distribute_planned':
+            kwargs = {key: value for key, value in args.items() if key not in ('volume', 'source', 'dest')}
+            if kwargs.pop('liquid_levels', False):
+                kwargs['liquid_levels'] = liquid_levels
+            distribute_planned(pipette, args['volume'], location(args['source']), location(args['dest']), **kwargs)
+        else:
+            raise ValueError("Unknown plan action '{}'".format(action))
 
+    def skip_distribute(pipette_key, args):
+        # Track the liquid moved by a distribute_planned step finished by hand
+        pipette = pipettes[pipette_key]
+        min_dispense = pipette.min_volume if args.get('min_dispense') is None else args['min_dispense']
+        for action, volume, loc in plan_distribute(args['volume'], location(args['source']), location(args['dest']),
+                                                   pipette.max_volume, disposal_vol=args.get('disposal_vol', 0),
+                                                   blow_out=args.get('blow_out', False), min_dispense=min_dispense):
+            if action != 'blow_out' and liquid_levels.tracks(loc):
+                getattr(liquid_levels, action)(loc, volume)
 
+    liquid_actions = ('transfer', 'distribute', 'consolidate', 'distribute_planned')
+    resumed = None
+    interrupted = None
+    if journal is not None:
+        resumed = journal.entries()[-1] if journal.resume_step() else None
+        start = max(start, journal.resume_step())
+        interrupted = journal.interrupted_step()
+        journal.open()
+    # Schedules start from full racks, so a run carrying on from used racks or resumed part way through takes the first
+    # column with room instead
+    if start == 0 and isinstance(plan, (list, tuple)):
+        schedule_tips(plan, tip_trackers)
+    # Step of each pipette's tip pickup while it is using a tip
+    sessions = {}
+    # Tips taken by the legacy tip iterator of each pipette without a TipTracker
+    legacy_tips = collections.Counter()
+    skipped = None
+    for i, step in enumerate(plan):
+        phase, pipette_key, action, args = step
+        if i == start and i == interrupted:
+            if not journal.skip_interrupted:
+                raise InterruptedStepError(
+                    "The run stopped part way through step {} of {} ({}), some of its wells may already have been "
+                    "filled. Finish the step by hand and resume with skip_interrupted, or start the run over"
+                    .format(i + 1, phase, action))
+            skipped = step
+            start += 1
+        if i < start:
+            if action in ('set_temperature', 'wait_for_temp', 'track_liquid'):
+                execute(*step)
+            if pipette_key not in tip_trackers and (action == 'pick_up_tip' or (
+                    action in liquid_actions and args.get('new_tip', 'once') != 'never'
+                    and pipette_key not in sessions)):
+                legacy_tips[pipette_key] += 1
+            if action == 'pick_up_tip':
+                sessions[pipette_key] = step
+            elif action in ('drop_tip', 'return_tip') or (
+                    action in liquid_actions and args.get('new_tip', 'once') != 'never'):
+                sessions.pop(pipette_key, None)
+            continue
+        if i == start and start:
+            if resumed is not None:
+                for key, snapshot in resumed['tips'].items():
+                    tip_trackers[key].restore(snapshot)
+                if liquid_levels is not None:
+                    liquid_levels.restore(resumed['volumes'])
+            if skipped is not None:
+                if skipped[2] == 'distribute_planned' and skipped[3].get('liquid_levels') and liquid_levels is not None:
+                    skip_distribute(skipped[1], skipped[3])
+                journal.record(i - 1, tip_trackers, liquid_levels)
+            # The legacy tip iterator starts over at the first tip of the first rack in a new run
+            for key, count in legacy_tips.items():
+                pipette = pipettes[key]
+                tips = [well for rack in pipette.tip_racks for well in rack.wells()
+                        if pipette.channels == 1 or well.get_name()[0] == 'A']
+                if count >= len(tips):
+                    raise OutOfTipsError('{} has used all {} of its tips'.format(key, len(tips)))
+                pipette.start_at_tip(tips[count])
+            # Tips in use when the run stopped were dropped with it
+            for session in sessions.values():
+                execute(*session)
+            print("\nResuming at step {} of {} ({})".format(i + 1, phase, action))
+        if journal is not None and action in liquid_actions:
+            journal.begin(i)
+        execute(*step)
+        if journal is not None:
+            journal.record(i, tip_trackers, liquid_levels)
+    if journal is not None:
+        journal.finish()
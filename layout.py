@@ -0,0 +1,736 @@
+"""
+Declarative plate layouts for the qPCR protocols. A layout spec says which labware goes in which slot, which primers and
+master mix tubes are used, where the samples and standards go and whether the tempdeck is used, and compile_layout()
+turns it into the command sequence the hand-written run_custom_protocol() functions spell out. generate_protocol()
+writes a self-contained protocol file for the robot from a spec with the helpers pasted in, so nothing has to be
+copied between protocol files by hand.
+
+Usage:
+    python layout.py list
+    python layout.py plan 3_plate_qPCR_quantification
+    python layout.py generate my_layout.json -o my_protocol.py
+    python layout.py mixing 3_plate_qPCR_quantification
+    python layout.py build 3_plate_qPCR_quantification
+
+A layout is either the name of one of the specs in SPECS or a JSON file holding a spec. Compiled plans are cached by the
+hash of their spec and of the compiler's sources and labware tables, in memory and in --cache-dir, so regenerating an
+unchanged layout costs nothing and a change to the compiler is never served a stale plan. generate refuses a layout
+validate.py finds errors in.
+"""
+import argparse
+import collections
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import os
+import pprint
+import sys
+
+import helpers
+import reagents
+from simulate import LABWARE, PIPETTES
+
+HELPERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'helpers.py')
+# Source files the compiled plans depend on, a change to any of them changes every spec's hash
+COMPILER_SOURCES = [os.path.abspath(__file__), HELPERS, os.path.abspath(reagents.__file__)]
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.layout_cache')
+TIP_STATE_FILE = '/data/user_storage/tiptracker_state.json'
+PROFILE_FILE = '/data/user_storage/run_profile.json'
+JOURNAL_FILE = '/data/user_storage/run_journal.jsonl'
+
+CHANNEL_PITCH = 9.0  # mm between the nozzles of a multi-channel pipette
+ALIGNMENT_TOLERANCE = 0.5  # mm a well may sit off a nozzle and still be used by it
+CDNA_OFFSET = [0, 0.03, -1.5]
+MASTER_MIX_OFFSET = [0, 0.1, 0.5]
+
+# Defaults of every spec, a spec only has to give what differs
+DEFAULTS = {
+    # {'slot': '10', 'celsius': 4} to cool the labware shared with the tempdeck. The block ramps down while the steps
+    # that do not touch it run unless 'overlap' is False, which waits for it before any pipetting
+    'tempdeck': None,
+    'pipettes': {
+        'p300_single': ['P300_Single', 'right', ['tiprack1']],
+        'p50_multi': ['P50_Multi', 'left', ['tiprack2']],
+    },
+    'reagents': {
+        'formamide': ['tube_rack_2ml', 'A1'],
+        'dntp': ['small_reagent_plate', 'A1'],
+        'sybr': ['small_reagent_plate', 'B1'],
+        'taq': ['small_reagent_plate', 'C1'],
+    },
+    'buffer_mix_tube': ['tube_rack_2ml', 'A2'],
+    'buffer_mix_z': 0.0,
+    'buffer_mix_geometry': '2ml-eppendorf',
+    'primer_plate': 'small_reagent_plate',
+    'master_mix_rack': 'tube_rack_2ml',
+    'sample_plate': 'small_reagent_plate',
+    # {'source': column, 'columns': [...]} like samples. samples may also be a list of them, and any of them may give
+    # the 'plates' it goes to instead of all of them, to put several sample sets on the plates of one run
+    'standards': None,
+    'wells': None,  # reactions of master mix to make, worked out by reagents.calculate() when None
+    'master_mix_tube_wells': None,  # reactions per master mix tube, as for wells
+    'cdna_well_vol': None,  # uL of cDNA loaded in each sample and standard well, just enough when None (validate.py)
+    'tip_per_plate': False,  # give each plate its own cDNA tips instead of distributing across plates at once
+    'reuse_primer_tips': False,  # re-rack primer tips and distribute their master mix with them
+    'primer_presses': None,
+    # Move primers in consecutive rows of a column to master mix tubes lined up the same way with one partial pickup
+    # of the multi-channel pipette. Tips re-racked by reuse_primer_tips are picked up one per tube again later, so
+    # they are always moved one at a time
+    'multichannel_primers': True,
+    # 'consolidated' adds the reagents to the buffer mix with one tip and merged aspirates, see _compile(). The
+    # reagent tubes have to be aliquots made up for this run, as the shared tip carries each reagent into the next tube
+    'master_mix_build': 'separate',
+    # 'adaptive' for helpers.mix_policy() cycles and rates, which mix the large tubes more thoroughly but add a few
+    # minutes per run, or 'fixed' for number_of_mixing and mix_rate
+    'mixing': 'adaptive',
+    'number_of_mixing': 5,
+    'mix_rate': 6,
+}
+
+SPECS = {
+    '1_plate_qPCR_primer_test': {
+        'labware': [
+            ['tube_rack_2ml', 'storeylab-2ml-coldrack1', '8'],
+            ['small_reagent_plate', 'PCR-strip-tall', '6'],
+            ['pcr_plate1', '96-flat', '5'],
+            ['tiprack1', 'opentrons-tiprack-300ul', '11'],
+            ['tiprack2', 'opentrons-tiprack-300ul', '9'],
+        ],
+        'plates': ['pcr_plate1'],
+        'wells': 130,
+        'master_mix_tube_wells': 19.0,
+        'primers': ['A3', 'A4', 'A5', 'A6', 'A7', 'A8'],
+        'master_mix_tubes': ['D1', 'D2', 'D3', 'D4', 'D5', 'C5'],
+        'primer_columns': [['1', '2'], ['3', '4'], ['5', '6'], ['7', '8'], ['9', '10'], ['11', '12']],
+        'samples': {'source': '12', 'columns': [str(column) for column in range(1, 13)]},
+        'reuse_primer_tips': True,
+    },
+    '3_plate_qPCR_primer_test': {
+        'labware': [
+            ['tube_rack_2ml', 'storeylab-2ml-coldrack1', '7'],
+            ['tube_rack_15ml', 'opentrons-tuberack-15_50ml', '10'],
+            ['small_reagent_plate', 'PCR-strip-tall', '8'],
+            ['pcr_plate1', '96-flat', '4'],
+            ['pcr_plate2', '96-flat', '5'],
+            ['pcr_plate3', '96-flat', '6'],
+            ['tiprack1', 'opentrons-tiprack-300ul', '11'],
+            ['tiprack2', 'opentrons-tiprack-300ul', '9'],
+        ],
+        'plates': ['pcr_plate1', 'pcr_plate2', 'pcr_plate3'],
+        'wells': 350,
+        'master_mix_tube_wells': 19.0,
+        'buffer_mix_tube': ['tube_rack_15ml', 'A1'],
+        'buffer_mix_z': -0.25,
+        'buffer_mix_geometry': '15ml-falcon',
+        'primers': ['A3', 'A4', 'A5', 'A6', 'A7', 'A8',
+                    'C3', 'C4', 'C5', 'C6', 'C7', 'C8',
+                    'E3', 'E4', 'E5', 'E6', 'E7', 'E8'],
+        'master_mix_tubes': ['A3', 'A4', 'A5',
+                             'B1', 'B2', 'B3', 'B4', 'B5',
+                             'C1', 'C2', 'C3', 'C4', 'C5',
+                             'D1', 'D2', 'D3', 'D4', 'D5'],
+        'primer_columns': [['1', '2'], ['3', '4'], ['5', '6'], ['7', '8'], ['9', '10'], ['11', '12']],
+        'samples': {'source': '12', 'columns': [str(column) for column in range(1, 13)]},
+        'tip_per_plate': True,
+        'primer_presses': 1,
+    },
+    '3_plate_qPCR_quantification': {
+        'labware': [
+            ['tube_rack_2ml', 'opentrons-aluminum-block-2ml-eppendorf', '7'],
+            ['tube_rack_15ml', 'opentrons-tuberack-15_50ml', '10'],
+            ['small_reagent_plate', 'PCR-strip-tall', '8'],
+            ['pcr_plate1', '96-flat', '4'],
+            ['pcr_plate2', '96-flat', '5'],
+            ['pcr_plate3', 'opentrons-aluminum-block-96-PCR-plate', '6'],
+            ['tiprack1', 'opentrons-tiprack-300ul', '11'],
+            ['tiprack2', 'opentrons-tiprack-300ul', '9'],
+        ],
+        'plates': ['pcr_plate1', 'pcr_plate2', 'pcr_plate3'],
+        'wells': 370,
+        'master_mix_tube_wells': 38.0,
+        'buffer_mix_tube': ['tube_rack_15ml', 'A1'],
+        'buffer_mix_z': -0.5,
+        'buffer_mix_geometry': '15ml-falcon',
+        'primers': ['A3', 'A4', 'A5', 'C3', 'C4', 'C5', 'E3', 'E4', 'E5'],
+        'master_mix_tubes': ['A3', 'A4', 'A5', 'B3', 'B4', 'B5', 'C3', 'C4', 'C5'],
+        'primer_columns': [['1', '2', '3', '4'], ['5', '6', '7', '8'], ['9', '10', '11', '12']],
+        'samples': {'source': '10', 'columns': ['1', '2', '3', '5', '6', '7', '9', '10', '11']},
+        'standards': {'source': '12', 'columns': ['4', '8', '12']},
+        'primer_presses': 1,
+    },
+}
+SPECS['1_plate_qPCR_primer_test_w_tempdeck'] = dict(
+    SPECS['1_plate_qPCR_primer_test'],
+    labware=[
+        ['tube_rack_2ml', 'opentrons-aluminum-block-2ml-eppendorf', '8'],
+        ['small_reagent_plate', 'PCR-strip-tall', '6'],
+        ['pcr_plate1', 'opentrons-aluminum-block-96-PCR-plate', '10'],
+        ['tiprack1', 'opentrons-tiprack-300ul', '11'],
+        ['tiprack2', 'opentrons-tiprack-300ul', '9'],
+    ],
+    tempdeck={'slot': '10', 'celsius': 4},
+)
+SPECS['3_plate_qPCR_quantification_w_tempdeck'] = dict(
+    SPECS['3_plate_qPCR_quantification'],
+    labware=[
+        ['tube_rack_2ml', 'opentrons-aluminum-block-2ml-eppendorf', '7'],
+        ['tube_rack_15ml', 'opentrons-tuberack-15_50ml', '3'],
+        ['small_reagent_plate', 'PCR-strip-tall', '8'],
+        ['pcr_plate1', '96-flat', '4'],
+        ['pcr_plate2', '96-flat', '5'],
+        ['pcr_plate3', 'opentrons-aluminum-block-96-PCR-plate', '10'],
+        ['tiprack1', 'opentrons-tiprack-300ul', '11'],
+        ['tiprack2', 'opentrons-tiprack-300ul', '9'],
+    ],
+    tempdeck={'slot': '10', 'celsius': 4},
+)
+
+_plans = {}
+_protocols = {}
+_compiler_digest = None
+_entry_digests = {}
+
+
+def load_spec(layout):
+    """
+    Returns the spec of a layout given by its name in SPECS or the path of a JSON file, with the defaults filled in
+    """
+    if layout in SPECS:
+        spec = copy.deepcopy(SPECS[layout])
+        spec.setdefault('name', layout)
+    else:
+        with open(layout) as f:
+            spec = json.load(f)
+        spec.setdefault('name', os.path.splitext(os.path.basename(layout))[0])
+    for key, value in DEFAULTS.items():
+        spec.setdefault(key, copy.deepcopy(value))
+    return spec
+
+
+def compiler_digest():
+    """
+    Hash of the sources of the compiler and the helpers and reagent tables it uses, read once per process
+    """
+    global _compiler_digest
+    if _compiler_digest is None:
+        digest = hashlib.sha256()
+        for path in COMPILER_SOURCES:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        _compiler_digest = digest.hexdigest()
+    return _compiler_digest
+
+
+def spec_hash(spec):
+    """
+    Hash identifying a spec's compiled plan, the same for equal specs whatever order their keys are in. Besides the
+    spec it covers everything the plan is compiled from: the compiler_digest() sources and the LABWARE and PIPETTES
+    entries of the labware and pipettes the spec loads
+    """
+    labware = [_entry_digest(LABWARE, name) for _, name, _ in spec.get('labware', [])]
+    pipettes = [_entry_digest(PIPETTES, model) for model, _, _ in spec.get('pipettes', {}).values()]
+    text = json.dumps([compiler_digest(), labware, pipettes, spec], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _entry_digest(table, name):
+    """
+    Hash of the entry of name in the LABWARE or PIPETTES table, computed once per entry
+    """
+    key = (id(table), name)
+    if key not in _entry_digests:
+        text = json.dumps([name, table.get(name)], sort_keys=True)
+        _entry_digests[key] = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return _entry_digests[key]
+
+
+def validate_spec(spec):
+    """
+    Checks a spec is complete and self-consistent, raising AssertionError with what is wrong
+    """
+    for key in ('labware', 'plates', 'primers', 'master_mix_tubes', 'primer_columns', 'samples'):
+        assert key in spec, "Layout spec is missing '{}'".format(key)
+    keys = [entry[0] for entry in spec['labware']]
+    assert len(keys) == len(set(keys)), "Labware keys are not unique"
+    slots = [entry[2] for entry in spec['labware']]
+    tempdeck_slot = spec['tempdeck']['slot'] if spec['tempdeck'] else None
+    assert len(slots) == len(set(slots)), "More than one labware in the same slot"
+    for key in spec['plates'] + [spec['primer_plate'], spec['master_mix_rack'], spec['sample_plate']]:
+        assert key in keys, "Labware '{}' is not loaded".format(key)
+    for _, _, racks in spec['pipettes'].values():
+        for rack in racks:
+            assert rack in keys, "Tip rack '{}' is not loaded".format(rack)
+    assert tempdeck_slot is None or tempdeck_slot in slots, "Nothing is loaded on the tempdeck"
+    assert len(spec['primers']) == len(spec['master_mix_tubes']), \
+        "{} primers but {} master mix tubes".format(len(spec['primers']), len(spec['master_mix_tubes']))
+    capacity = len(spec['plates']) * len(spec['primer_columns'])
+    assert len(spec['primers']) <= capacity, \
+        "{} primers do not fit on {} plates of {} primers".format(len(spec['primers']), len(spec['plates']),
+                                                                 len(spec['primer_columns']))
+    cdna_wells = [(plate, column) for cdna in cdna_sets(spec) for plate in cdna['plates'] for column in cdna['columns']]
+    assert len(cdna_wells) == len(set(cdna_wells)), "Samples and standards share a column"
+    assert set(plate for plate, _ in cdna_wells) <= set(spec['plates']), "cDNA goes to a plate not in plates"
+    assert spec['master_mix_build'] in ('separate', 'consolidated'), \
+        "Unknown master_mix_build '{}'".format(spec['master_mix_build'])
+
+
+def cdna_sets(spec):
+    """
+    Returns the spec's sample sets followed by its standards as {'source', 'columns', 'plates'} dicts
+    """
+    samples = spec['samples'] if isinstance(spec['samples'], list) else [spec['samples']]
+    return [dict(cdna, plates=cdna.get('plates', spec['plates']))
+            for cdna in samples + ([spec['standards']] if spec['standards'] else [])]
+
+
+def cdna_distributions(spec):
+    """
+    Returns (source column, groups) of each sample plate column the spec distributes cDNA from, in order. Sample sets
+    sharing a source are distributed together, groups being the (plate, column) destinations taken with one set of tips
+    each, a group per plate with tip_per_plate
+    """
+    distributions = collections.OrderedDict()
+    for cdna in cdna_sets(spec):
+        groups = distributions.setdefault(cdna['source'], collections.OrderedDict())
+        for plate in cdna['plates']:
+            groups.setdefault(plate if spec['tip_per_plate'] else None, []).extend(
+                (plate, column) for column in cdna['columns'])
+    return [(source, list(groups.values())) for source, groups in distributions.items()]
+
+
+def reaction_counts(spec):
+    """
+    Returns the reactions of master mix to make in total and per master mix tube, from the spec when it gives them and
+    from reagents.calculate() otherwise
+    """
+    wells, tube_wells = spec['wells'], spec['master_mix_tube_wells']
+    if wells is None or tube_wells is None:
+        reactions_per_primer = 8 * len(spec['primer_columns'][0])
+        plan, = reagents.calculate([(len(spec['primers']), reactions_per_primer)])
+        wells = plan.master_mix_reactions if wells is None else wells
+        tube_wells = plan.master_mix_tube_reactions if tube_wells is None else tube_wells
+    return wells, tube_wells
+
+
+def primer_groups(spec):
+    """
+    Splits the spec's primers into runs the multi-channel pipette can add in one trip: consecutive primers whose wells
+    and master mix tubes are both one nozzle pitch apart down a column, up to the pipette's channels. Everything else,
+    e.g. tubes in a rack wider apart than the nozzles, is a run of one
+
+    Returns
+    -------
+    list
+        Lists of indexes into the spec's primers and master mix tubes
+    """
+    labware = {key: name for key, name, _ in spec['labware']}
+    multi = next(model for model, _, _ in spec['pipettes'].values() if model.endswith('Multi'))
+    channels = PIPETTES[multi][0]
+
+    def next_nozzle(key, well, following):
+        wells = LABWARE[labware[key]][1]
+        if well not in wells or following not in wells:
+            return False
+        (x, y, _, _, _), (next_x, next_y, _, _, _) = wells[well], wells[following]
+        return abs(next_x - x) <= ALIGNMENT_TOLERANCE and abs(y - next_y - CHANNEL_PITCH) <= ALIGNMENT_TOLERANCE
+
+    groups = []
+    for i, (primer, tube) in enumerate(zip(spec['primers'], spec['master_mix_tubes'])):
+        if (groups and spec['multichannel_primers'] and not spec['reuse_primer_tips'] and len(groups[-1]) < channels
+                and next_nozzle(spec['primer_plate'], spec['primers'][i - 1], primer)
+                and next_nozzle(spec['master_mix_rack'], spec['master_mix_tubes'][i - 1], tube)):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+def mix_settings(spec, pipette, volume, geometry, viscous=False, fixed=None):
+    """
+    Returns the repetitions, volume and rate to mix volume uL with one of the spec's pipettes, from
+    helpers.mix_policy() or, for 'fixed' mixing, the spec's number_of_mixing and mix_rate (with fixed overriding the
+    repetitions and volume)
+    """
+    max_volume = int(spec['pipettes'][pipette][0][1:].split('_')[0])
+    if spec['mixing'] == 'fixed':
+        repetitions, mix_volume = fixed or (spec['number_of_mixing'], min(50, max_volume))
+        return repetitions, mix_volume, spec['mix_rate']
+    return helpers.mix_policy(volume, max_volume, geometry, viscous=viscous)
+
+
+def _compile(spec):
+    validate_spec(spec)
+    wells, tube_wells = reaction_counts(spec)
+    recipe = reagents.RECIPE
+    master_mix_per_well = reagents.TOTAL_VOL - reagents.CDNA_VOL - reagents.PRIMER_MIX_PER_WELL
+    master_mix_tube_vol = master_mix_per_well * tube_wells
+    primer_vol = reagents.PRIMER_MIX_PER_WELL * tube_wells
+    master_mix_vol = reagents.TOTAL_VOL - reagents.CDNA_VOL
+    single, multi = sorted(spec['pipettes'], key=lambda key: spec['pipettes'][key][0].endswith('Multi'))
+
+    buffer_mix_tube = spec['buffer_mix_tube']
+    high_vol_buffer_mix_tube = buffer_mix_tube + ['center', 0, 0, spec['buffer_mix_z']]
+    primers = [[spec['primer_plate'], well, 'bottom'] for well in spec['primers']]
+    master_mix_tubes = [[spec['master_mix_rack'], well, 'bottom'] for well in spec['master_mix_tubes']]
+
+    plan = []
+
+    def step(phase, pipette, action, **args):
+        plan.append([phase, pipette, action, args])
+
+    if spec['tempdeck']:
+        step('setup', None, 'set_temperature', module='tempdeck', celsius=spec['tempdeck']['celsius'])
+
+    # Make master mix
+    phase = 'master mix build'
+    additions = [(name, key, recipe[name] * wells)
+                 for name, key in (('formamide', 'formamide'), ('dNTP', 'dntp'), ('SYBR', 'sybr'), ('taq', 'taq'))]
+    repetitions, volume, rate = mix_settings(spec, single, wells * master_mix_per_well, spec['buffer_mix_geometry'],
+                                             viscous=True, fixed=(15, 300))
+    if spec['master_mix_build'] == 'consolidated':
+        # Dispensing from the top keeps the tip out of the buffer mix, so the only carry-over of the shared tip is of
+        # earlier reagents into the aliquots of later ones, all bound for this tube anyway. Thin liquids go first so
+        # viscous residue in the tip is carried the fewest times, larger volumes first among equals, and the tip
+        # only goes into the buffer mix to mix once taq is in
+        additions.sort(key=lambda addition: (reagents.VISCOSITY[addition[0]], -addition[2]))
+        step(phase, single, 'pick_up_tip')
+        step(phase, single, 'consolidate', volume=[vol for _, _, vol in additions],
+             source=[spec['reagents'][key] for _, key, _ in additions], dest=buffer_mix_tube + ['top'],
+             blow_out=True, new_tip='never')
+    else:
+        for _, key, vol in additions[:-1]:
+            step(phase, single, 'distribute', volume=vol, source=spec['reagents'][key], dest=high_vol_buffer_mix_tube,
+                 disposal_vol=0, blow_out=True)
+        # Add taq last and mix
+        step(phase, single, 'pick_up_tip')
+        step(phase, single, 'transfer', volume=additions[-1][2], source=spec['reagents']['taq'],
+             dest=high_vol_buffer_mix_tube, disposal_vol=0, blow_out=True, new_tip='never')
+    step(phase, single, 'mix', repetitions=repetitions, volume=volume, location=high_vol_buffer_mix_tube, rate=rate)
+    step(phase, single, 'drop_tip')
+    # Distribute master mix to separate master mix tubes
+    step(phase, single, 'distribute_planned', volume=master_mix_tube_vol, source=buffer_mix_tube,
+         dest=master_mix_tubes, disposal_vol=0, blow_out=True)
+
+    # Add primers to master mix tubes
+    phase = 'primer addition'
+    repetitions, volume, rate = mix_settings(spec, multi, master_mix_tube_vol + primer_vol, '2ml-eppendorf',
+                                             viscous=True)
+    for group in primer_groups(spec):
+        # The first nozzle goes to the group's first primer and tube, the others to the rows below them
+        primer, mm_tube = primers[group[0]], master_mix_tubes[group[0]]
+        step(phase, multi, 'pick_up_tip', n=len(group), presses=spec['primer_presses'])
+        step(phase, multi, 'transfer', volume=primer_vol, source=primer, dest=mm_tube, disposal_vol=0, blow_out=True,
+             new_tip='never')
+        step(phase, multi, 'mix', repetitions=repetitions, volume=volume, rate=rate)
+        if spec['reuse_primer_tips']:
+            # Re-rack the tip so it can distribute this master mix tube later
+            step(phase, multi, 'return_tip', reagent=mm_tube[1])
+        else:
+            step(phase, multi, 'drop_tip')
+
+    # Mix cDNA then distribute to the plates
+    phase = 'cDNA distribution'
+    for source_column, groups in cdna_distributions(spec):
+        source = [spec['sample_plate'], 'A' + source_column]
+        # Each well holds a dispense per destination column plus the disposal and dead volume
+        dispenses = sum(len(group) for group in groups)
+        repetitions, volume, rate = mix_settings(spec, multi, reagents.CDNA_VOL * dispenses + 3 + 5, 'pcr-well')
+        for i, group in enumerate(groups):
+            step(phase, multi, 'pick_up_tip', n=8)
+            if i == 0:
+                step(phase, multi, 'mix', repetitions=repetitions, volume=volume, location=source, rate=rate)
+            dests = [[plate, 'A' + column, 'center'] + CDNA_OFFSET for plate, column in group]
+            step(phase, multi, 'distribute', volume=reagents.CDNA_VOL, source=source, dest=dests, disposal_vol=3,
+                 blow_out=True, order='shortest')
+
+    # Distribute each master mix tube to its block of columns, following the tube's liquid level
+    phase = 'master mix distribution'
+    step(phase, None, 'track_liquid', wells=master_mix_tubes, volume=master_mix_tube_vol + primer_vol,
+         geometry='2ml-eppendorf')
+    blocks = [(plate, columns) for plate in spec['plates'] for columns in spec['primer_columns']]
+    for mm_tube, (plate, columns) in zip(master_mix_tubes, blocks):
+        dests = [[plate, row + column, 'center'] + MASTER_MIX_OFFSET for column in columns for row in 'ABCDEFGH']
+        if spec['reuse_primer_tips']:
+            step(phase, multi, 'pick_up_tip', n=1, reagent=mm_tube[1])
+        else:
+            step(phase, multi, 'pick_up_tip', n=1, presses=spec['primer_presses'])
+        step(phase, multi, 'distribute_planned', volume=master_mix_vol, source=mm_tube, dest=dests, disposal_vol=0,
+             blow_out=True, liquid_levels=True, order='shortest')
+
+    if spec['tempdeck']:
+        # Only steps using labware on the tempdeck need it cold, gate the first of them on the ramp
+        cold = {key for key, _, slot in spec['labware'] if slot == spec['tempdeck']['slot']}
+        first = 1
+        if spec['tempdeck'].get('overlap', True):
+            tip_picked_up = {}
+            for i, (_, pipette, action, args) in enumerate(plan):
+                if action == 'pick_up_tip':
+                    tip_picked_up[pipette] = i
+                if cold & labware_used(args):
+                    # Wait before picking up the tip rather than while holding it
+                    first = tip_picked_up.get(pipette, i)
+                    break
+                # Transfers drop their tip at the end unless told not to
+                if action in ('drop_tip', 'return_tip') or (
+                        action in ('transfer', 'distribute', 'consolidate', 'distribute_planned')
+                        and args.get('new_tip', 'once') != 'never'):
+                    tip_picked_up.pop(pipette, None)
+        plan.insert(first, ['setup', None, 'wait_for_temp', {'module': 'tempdeck'}])
+    return plan
+
+
+def labware_used(args):
+    """
+    Returns the keys of the labware the location references in a plan step's arguments point at
+    """
+    used = set()
+    for value in args.values():
+        if isinstance(value, list) and value:
+            for ref in (value if isinstance(value[0], list) else [value]):
+                if isinstance(ref, list) and ref and isinstance(ref[0], str):
+                    used.add(ref[0])
+    return used
+
+
+def compile_layout(spec, cache_dir=None):
+    """
+    Compiles a layout spec into the steps helpers.run_plan() executes
+
+    Parameters
+    ----------
+    spec: dict
+        Layout spec with the defaults filled in, see load_spec()
+    cache_dir: str
+        Directory to keep compiled plans in between runs, plans are only cached in memory when None
+
+    Returns
+    -------
+    list
+        [phase, pipette key, action, arguments] steps
+    """
+    key = spec_hash(spec)
+    if key in _plans:
+        return _plans[key]
+    path = os.path.join(cache_dir, key + '.json') if cache_dir else None
+    if path and os.path.exists(path):
+        with open(path) as f:
+            plan = json.load(f)
+    else:
+        plan = _compile(spec)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(plan, f)
+            os.replace(path + '.tmp', path)
+    _plans[key] = plan
+    return plan
+
+
+def _helpers_source():
+    """
+    helpers.py without its header and imports, which the generated file has its own copy of
+    """
+    with open(HELPERS) as f:
+        lines = f.read().split('\n')
+    first = next(i for i, line in enumerate(lines) if line.startswith(('class ', 'def ')))
+    return '\n'.join(lines[first:]).rstrip() + '\n'
+
+
+def generate_protocol(spec, cache_dir=None, plan=None):
+    """
+    Returns the source of a self-contained protocol file that runs the compiled plan of spec on the robot, or plan
+    when given (e.g. a plan reordered by schedule.py)
+    """
+    helpers = _helpers_source()
+    key = hashlib.sha256(json.dumps([spec_hash(spec), plan]).encode('utf-8')).hexdigest()
+    if key in _protocols:
+        return _protocols[key]
+    if plan is None:
+        plan = compile_layout(spec, cache_dir=cache_dir)
+    tempdeck_slot = spec['tempdeck']['slot'] if spec['tempdeck'] else None
+
+    lines = [
+        '"""',
+        '{}: generated by layout.py from its layout spec, change the spec and regenerate rather than editing this'
+        .format(spec['name']),
+        'file',
+        '"""',
+        'import bisect',
+        'import collections',
+        'import itertools',
+        'import json',
+        'import math',
+        'import os',
+        'import time',
+        '',
+        'from opentrons import labware, instruments, modules, robot',
+        '',
+        "TIP_STATE_FILE = '{}'".format(TIP_STATE_FILE),
+        "PROFILE_FILE = '{}'".format(PROFILE_FILE),
+        "JOURNAL_FILE = '{}'".format(JOURNAL_FILE),
+        '# Set to True after putting full tip racks on the deck, so the saved tip state of the last run is cleared',
+        'RESET_TIPS = False',
+        '# Set to False to start over instead of resuming a run that was stopped part way through',
+        'RESUME = True',
+        '# Set to True once the step moving liquid a stopped run was part way through has been finished by hand, so',
+        '# the run resumes after it instead of refusing to fill its wells twice',
+        'SKIP_INTERRUPTED_STEP = False',
+        '',
+        '',
+        helpers,
+        '',
+        'LABWARE = {}'.format(pprint.pformat(spec['labware'], width=120)),
+        'PIPETTES = {}'.format(pprint.pformat(spec['pipettes'], width=120)),
+        'PLAN = {}'.format(pprint.pformat(plan, width=120)),
+        "PLAN_KEY = '{}'".format(key),
+        '',
+        '',
+        'def run_custom_protocol():',
+        '    # Carry on from the tips left in the racks by the last run, only saved when running on the robot',
+        '    loaded, pipettes, loaded_modules, tip_trackers = load_deck(LABWARE, PIPETTES, tempdeck_slot={!r},'
+        .format(tempdeck_slot),
+        '                                                               state_file=TIP_STATE_FILE,',
+        '                                                               autosave=not robot.is_simulating())',
+        '    if RESET_TIPS:',
+        '        for tracker in tip_trackers.values():',
+        '            tracker.reset()',
+        '    # Time every pipette call, by the phase of the plan step it was made for',
+        '    profiler = RunProfiler(clock=run_clock(robot))',
+        '    profiler.instrument(*pipettes.values())',
+        '    # Journal every completed step so a stopped run can be resumed where it stopped, only on the robot',
+        '    journal = None',
+        '    if not robot.is_simulating():',
+        '        journal = RunJournal(JOURNAL_FILE, plan_key=PLAN_KEY, resume=RESUME,',
+        '                             skip_interrupted=SKIP_INTERRUPTED_STEP)',
+        '        if journal.resume_step():',
+        "            robot.pause('Resuming the stopped run at step {} of {}, check the deck and remove any '",
+        "                        'attached tips'.format(journal.resume_step() + 1, len(PLAN)))",
+        '    run_plan(PLAN, loaded, pipettes, modules=loaded_modules, tip_trackers=tip_trackers,',
+        '             liquid_levels=LiquidLevelTracker(submerge=2.0), profiler=profiler, journal=journal)',
+        '    if robot.is_simulating():',
+        '        print(profiler.flame())',
+        '    else:',
+        '        profiler.save(PROFILE_FILE)',
+        '',
+        '',
+        'run_custom_protocol()',
+        '',
+    ]
+    source = '\n'.join(lines)
+    _protocols[key] = source
+    return source
+
+
+def simulate_plan(spec, plan=None):
+    """
+    Runs a plan of spec, its compiled plan by default, step by step in the offline simulator
+
+    Returns
+    -------
+    tuple
+        The simulated robot and the estimated duration in seconds of each step
+    """
+    import helpers
+    from simulate import simulated_opentrons
+
+    if plan is None:
+        plan = compile_layout(spec)
+    tempdeck_slot = spec['tempdeck']['slot'] if spec['tempdeck'] else None
+    durations = []
+    with simulated_opentrons() as robot:
+        loaded, pipettes, modules, tip_trackers = helpers.load_deck(spec['labware'], spec['pipettes'],
+                                                                    tempdeck_slot=tempdeck_slot, autosave=False)
+        liquid_levels = helpers.LiquidLevelTracker(submerge=2.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for step in plan:
+                start = robot.time
+                helpers.run_plan([step], loaded, pipettes, modules=modules, tip_trackers=tip_trackers,
+                                 liquid_levels=liquid_levels)
+                durations.append(robot.time - start)
+    return robot, durations
+
+
+def mixing_time_saved(spec):
+    """
+    Simulates spec with fixed and with adaptive mixing and returns the seconds adaptive mixing saves per run (negative
+    when it mixes for longer)
+    """
+    durations = {}
+    for mixing in ('fixed', 'adaptive'):
+        robot, _ = simulate_plan(dict(spec, mixing=mixing))
+        durations[mixing] = robot.time
+    return durations['fixed'] - durations['adaptive']
+
+
+def master_mix_build_saved(spec):
+    """
+    Simulates spec building the master mix with separate and with consolidated reagent additions
+
+    Returns
+    -------
+    tuple
+        Seconds and tips the consolidated build saves per run (negative when it takes more)
+    """
+    durations, tips = {}, {}
+    for build in ('separate', 'consolidated'):
+        robot, _ = simulate_plan(dict(spec, master_mix_build=build))
+        durations[build] = robot.time
+        tips[build] = sum(command.tips for command in robot.commands if command.name == 'pick_up_tip')
+    return durations['separate'] - durations['consolidated'], tips['separate'] - tips['consolidated']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('command', choices=['list', 'plan', 'generate', 'mixing', 'build'])
+    parser.add_argument('layout', nargs='?', help='Name of a spec in SPECS or a JSON spec file')
+    parser.add_argument('-o', '--output', help='Write the generated protocol here instead of stdout')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Where compiled plans are cached')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for name in sorted(SPECS):
+            print(name)
+        return 0
+    if args.layout is None:
+        parser.error('{} needs a layout'.format(args.command))
+
+    spec = load_spec(args.layout)
+    if args.command == 'plan':
+        for i, (phase, pipette, action, step_args) in enumerate(compile_layout(spec, cache_dir=args.cache_dir)):
+            print('{:>4} {:<24} {:<12} {:<18} {}'.format(i, phase, pipette or '-', action, json.dumps(step_args)))
+        return 0
+
+    if args.command == 'mixing':
+        saved = mixing_time_saved(spec)
+        print('Adaptive mixing {} {:.0f} s per run compared to fixed mixing'.format(
+            'saves' if saved >= 0 else 'adds', abs(saved)))
+        return 0
+
+    if args.command == 'build':
+        saved, tips = master_mix_build_saved(spec)
+        print('Consolidated master mix build saves {:.0f} s and {} tips per run compared to separate additions'.format(
+            saved, tips))
+        return 0
+
+    # Volumes, capacities and tips that do not add up would only show part way through the run
+    import validate
+    errors = [violation for violation in validate.validate_plan(spec, compile_layout(spec, cache_dir=args.cache_dir))
+              if violation.severity == 'error']
+    for step, _, message in errors:
+        print('Step {}: {}'.format('-' if step is None else step, message), file=sys.stderr)
+    if errors:
+        return 1
+
+    source = generate_protocol(spec, cache_dir=args.cache_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
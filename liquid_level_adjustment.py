@@ -1,5 +1,155 @@
+import bisect
+import math
+
 from opentrons import labware, instruments, robot
 
+
+class LiquidLevelTracker:
+    """
+    LiquidLevelTracker keeps the liquid volume of every registered well and turns it into a location just below the
+    meniscus, so aspirates follow the liquid down instead of always going to the bottom of the tube
+
+    Wells are described by a geometry profile: (height, inner diameter) points from the bottom of the well up, with
+    the diameter changing linearly between them, so conical bottoms and cylinders are both covered. The
+    volume-to-height lookup table of each profile is computed once and shared by every tracker.
+    """
+    geometries = {
+        '2ml-eppendorf': [(0.0, 2.0), (4.0, 8.7), (38.0, 8.7)],
+        '1.5ml-eppendorf': [(0.0, 3.6), (18.0, 8.7), (38.0, 8.7)],
+        '15ml-falcon': [(0.0, 2.0), (22.0, 14.5), (117.5, 14.5)],
+        '50ml-falcon': [(0.0, 3.0), (15.0, 26.7), (113.0, 26.7)],
+        'pcr-well': [(0.0, 1.5), (10.0, 5.0), (19.5, 5.0)],
+        'flat-well': [(0.0, 6.4), (10.5, 6.4)],
+        '384-well': [(0.0, 3.0), (11.5, 3.7)],
+    }
+    step = 0.1  # mm between lookup table entries
+    _tables = {}
+
+    def __init__(self, submerge=1.0, min_height=0.5):
+        """
+        Parameters
+        ----------
+        submerge: float
+            How far below the meniscus (mm) to aspirate from
+        min_height: float
+            Lowest height above the bottom of a well (mm) to aspirate from
+        """
+        self.submerge = submerge
+        self.min_height = min_height
+        self._wells = {}
+
+    @classmethod
+    def _table(cls, geometry):
+        # Cumulative volume (uL) at every step mm of height
+        if geometry not in cls._tables:
+            profile = cls.geometries[geometry]
+            volumes = [0.0]
+            height = 0.0
+            for (h0, d0), (h1, d1) in zip(profile, profile[1:]):
+                while height + cls.step <= h1 + 1e-9:
+                    r0 = (d0 + (d1 - d0) * (height - h0) / (h1 - h0)) / 2
+                    r1 = (d0 + (d1 - d0) * (height + cls.step - h0) / (h1 - h0)) / 2
+                    volumes.append(volumes[-1] + math.pi * cls.step / 3 * (r0 * r0 + r0 * r1 + r1 * r1))
+                    height += cls.step
+            cls._tables[geometry] = volumes
+        return cls._tables[geometry]
+
+    @staticmethod
+    def _well(location):
+        well = location[0] if isinstance(location, tuple) else location
+        return well[0] if isinstance(well, list) else well
+
+    def add(self, wells, volume, geometry):
+        """
+        Registers wells holding volume uL each
+
+        Parameters
+        ----------
+        wells: well or list
+            Wells (or locations) to track
+        volume: float
+            Current volume of each well in uL
+        geometry: str
+            Key of LiquidLevelTracker.geometries describing the inside of the wells
+        """
+        if not isinstance(wells, list):
+            wells = [wells]
+        table = self._table(geometry)
+        for well in wells:
+            self._wells[self._well(well)] = [table, float(volume)]
+
+    def tracks(self, location):
+        return self._well(location) in self._wells
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        list
+            Volume of every tracked well in the order they were added, for restore()
+        """
+        return [volume for _, volume in self._wells.values()]
+
+    def restore(self, snapshot):
+        """
+        Sets the volumes of the tracked wells back to a snapshot() of the same wells
+        """
+        for entry, volume in zip(self._wells.values(), snapshot):
+            entry[1] = volume
+
+    def volume(self, location):
+        return self._wells[self._well(location)][1]
+
+    def height(self, location):
+        """
+        Returns
+        -------
+        float
+            Liquid height above the bottom of the well in mm
+        """
+        table, volume = self._wells[self._well(location)]
+        if volume >= table[-1]:
+            return (len(table) - 1) * self.step
+        i = bisect.bisect_right(table, volume)
+        if i == 0:
+            return 0.0
+        return (i - 1 + (volume - table[i - 1]) / (table[i] - table[i - 1])) * self.step
+
+    def _location(self, well, height):
+        half_depth = well.properties['depth'] / 2
+        return well, well.from_center(x=0, y=0, z=max(-1.0, min(1.0, height / half_depth - 1)))
+
+    def aspirate(self, location, volume):
+        """
+        Takes volume out of a well and returns where to aspirate it from: submerge mm below where the meniscus will be
+        once the volume is gone, so the tip stays in the liquid for the whole aspirate
+
+        Returns
+        -------
+        location
+            (well, offset) location for Pipette.aspirate()
+        """
+        well = self._well(location)
+        entry = self._wells[well]
+        assert entry[1] >= volume - 1e-6, "Aspirating {} uL from {} which only has {:.1f} uL left".format(
+            volume, well, entry[1])
+        entry[1] -= volume
+        return self._location(well, max(self.min_height, self.height(well) - self.submerge))
+
+    def dispense(self, location, volume):
+        """
+        Adds volume to a well and returns a location just above the meniscus to dispense it from
+
+        Returns
+        -------
+        location
+            (well, offset) location for Pipette.dispense()
+        """
+        well = self._well(location)
+        self._wells[well][1] += volume
+        return self._location(well, self.height(well) + self.submerge)
+
+
 tube_rack_2ml = labware.load('opentrons-tuberack-2ml-eppendorf', '2')
 tiprack = labware.load('opentrons-tiprack-300ul', '1')
 
@@ -13,33 +163,17 @@ def run_custom_protocol():
     source_tube = tube_rack_2ml.wells('D3')
     destination_tube = tube_rack_2ml.wells('D4')
 
-    remaining_vol = 2000
-    height = 1  # Initial height within source tube
-    source_height_offset = 0.5  # Offset so that pipette tip is slightly submerged in source tube, not hovering at surface
-    source_height = height - source_height_offset
-    p50_single.pick_up_tip()
-    while remaining_vol > 0:
-        robot.comment(str(source_height))  # Print out the current source_height
+    # Tracks the liquid height in both tubes so the tip stays just below the surface in the source tube and just above
+    # it in the destination tube
+    liquid_levels = LiquidLevelTracker(submerge=0.5)
+    liquid_levels.add(source_tube, initial_volume, '2ml-eppendorf')
+    liquid_levels.add(destination_tube, 0, '2ml-eppendorf')
 
-        # This transfer command will start pipetting from the top of the source tube to the bottom of the destination
-        # tube, and will continue "tracking" the height of the two volumes in each tube
-        source = (source_tube, source_tube.from_center(x=0, y=0, z=source_height))  # locations are tuples
-        destination = (destination_tube, destination_tube.from_center(x=0, y=0, z=-height))  # locations are tuples
+    p50_single.pick_up_tip()
+    while liquid_levels.volume(source_tube) >= transfer_volume:
+        source = liquid_levels.aspirate(source_tube, transfer_volume)
+        destination = liquid_levels.dispense(destination_tube, transfer_volume)
         p50_single.transfer(transfer_volume, source, destination, disposal_vol=0, blow_out=True, new_tip='never')
 
-        # Update height by subtracting ratio of transfer_vol:inital_vol, or set to bottom of tube is "below" bottom
-        if height > -1:
-            height -= (transfer_volume/initial_volume)*2  # x2 because tube size is -1 to 1 i.e. a difference of 2
-        else:
-            height = -1
-
-        # Update source_height or set to bottom of tube
-        source_height = height - source_height_offset
-        if source_height < -1:
-            source_height = -1
-
-        # Update remaining volume
-        remaining_vol -= transfer_volume
-
 
-run_custom_protocol()
\ No newline at end of file
+run_custom_protocol()
@@ -0,0 +1,162 @@
+"""
+Reagent volume calculator for the qPCR protocols: derives the reagent, master mix and primer volumes, dead volumes and
+the master mix tube split from how many primers are run and how many reactions each primer gets.
+
+Usage:
+    python reagents.py 6x16 18x16 9x32
+
+Each argument is PRIMERSxREACTIONS_PER_PRIMER. The per-reaction recipe matches the constants in the protocol files.
+The hand-written protocols keep their own bench-tested reaction counts (WELLS and MASTER_MIX_TUBE_WELLS), which are
+smaller than the ones worked out here; layout specs use these unless they pin their own.
+"""
+import collections
+import math
+import sys
+
+TOTAL_VOL = 20.0
+CDNA_VOL = 5.0
+PRIMER_MIX_PER_WELL = 1.0
+# Master mix components in uL per reaction, water makes each reaction up to TOTAL_VOL
+RECIPE = collections.OrderedDict([
+    ('trehalose', 4.0),
+    ('qPCR buffer', 2.0),
+    ('formamide', 0.5),
+    ('dNTP', 0.16),
+    ('SYBR', 0.1),
+    ('taq', 0.125),
+])
+RECIPE['water'] = TOTAL_VOL - CDNA_VOL - PRIMER_MIX_PER_WELL - sum(RECIPE.values())
+# Premixed by hand in the buffer mix tube, the robot adds the rest
+BUFFER_MIX = ('water', 'trehalose', 'qPCR buffer')
+
+# name: (capacity, dead volume) in uL
+TUBES = collections.OrderedDict([
+    ('PCR strip well', (200.0, 5.0)),
+    ('2 mL tube', (2000.0, 20.0)),
+    ('15 mL tube', (15000.0, 300.0)),
+    ('50 mL tube', (50000.0, 1000.0)),
+])
+MASTER_MIX_TUBE = '2 mL tube'
+MASTER_MIX_TUBE_FILL = 0.9  # fraction of the tube left for liquid so it can still be mixed
+SMALL_REAGENT_TUBE = {'formamide': '2 mL tube', 'dNTP': 'PCR strip well', 'SYBR': 'PCR strip well',
+                      'taq': 'PCR strip well'}
+# Approximate viscosity in cP of the reagents the robot adds, taq comes in 50 % glycerol storage buffer
+VISCOSITY = {'formamide': 3.3, 'dNTP': 1.0, 'SYBR': 1.0, 'taq': 6.0}
+
+ReagentPlan = collections.namedtuple('ReagentPlan', [
+    'primers',
+    'reactions_per_primer',
+    'tubes_per_primer',
+    'master_mix_tube_reactions',
+    'master_mix_tube_vol',
+    'primer_vol',
+    'master_mix_reactions',
+    'buffer_mix_tube',
+    'buffer_mix_tubes',
+    'buffer_mix_vol',
+    'primer_tube',
+    'reagent_vols',
+])
+
+
+def fit_tubes(volume, tubes):
+    """
+    Picks the smallest of tubes that holds volume plus its dead volume, splitting over several of the largest tube
+    when none is big enough
+
+    Returns
+    -------
+    tuple
+        Tube name, number of tubes, and the total volume including the dead volume of every tube
+    """
+    for name in tubes:
+        capacity, dead = TUBES[name]
+        if volume + dead <= capacity:
+            return name, 1, volume + dead
+    capacity, dead = TUBES[name]
+    count = int(math.ceil(volume / (capacity - dead)))
+    return name, count, volume + dead * count
+
+
+def calculate(layouts, overage=0.1875, tube_overage_reactions=0):
+    """
+    Works out the volumes for many layouts in one pass
+
+    Parameters
+    ----------
+    layouts: list
+        (primers, reactions_per_primer) pairs, one per layout
+    overage: float
+        Extra master mix made for each master mix tube as a fraction of its reactions (3 extra for 16 reactions by
+        default, as in the protocols)
+    tube_overage_reactions: int
+        Extra reactions per master mix tube on top of overage
+
+    Returns
+    -------
+    list
+        One ReagentPlan per layout
+    """
+    mix_per_reaction = TOTAL_VOL - CDNA_VOL - PRIMER_MIX_PER_WELL
+    tube_capacity, tube_dead = TUBES[MASTER_MIX_TUBE]
+    max_tube_reactions = int((tube_capacity * MASTER_MIX_TUBE_FILL) // (mix_per_reaction + PRIMER_MIX_PER_WELL))
+    buffer_per_reaction = sum(RECIPE[name] for name in BUFFER_MIX)
+
+    plans = []
+    for primers, reactions_per_primer in layouts:
+        # Reactions one tube has to hold, including what is left behind in the tube
+        needed = reactions_per_primer * (1 + overage) + tube_overage_reactions
+        needed += tube_dead / (mix_per_reaction + PRIMER_MIX_PER_WELL)
+        tubes_per_primer = max(1, int(math.ceil(needed / max_tube_reactions)))
+        tube_reactions = math.ceil(needed / tubes_per_primer)
+        tube_count = primers * tubes_per_primer
+        mm_reactions = tube_count * tube_reactions
+
+        buffer_vol = buffer_per_reaction * mm_reactions
+        buffer_tube, buffer_tubes, buffer_total = fit_tubes(buffer_vol, ['2 mL tube', '15 mL tube', '50 mL tube'])
+        # The buffer tubes' dead volume also leaves the robot-added reagents behind, so scale everything by it
+        scale = buffer_total / buffer_vol
+
+        reagent_vols = collections.OrderedDict()
+        for name, per_reaction in RECIPE.items():
+            vol = per_reaction * mm_reactions * scale
+            if name not in BUFFER_MIX:
+                vol += TUBES[SMALL_REAGENT_TUBE[name]][1]
+            reagent_vols[name] = vol
+        primer_tube, _, reagent_vols['primer mix'] = fit_tubes(PRIMER_MIX_PER_WELL * tube_reactions * tubes_per_primer,
+                                                               ['PCR strip well', '2 mL tube'])
+
+        plans.append(ReagentPlan(
+            primers=primers,
+            reactions_per_primer=reactions_per_primer,
+            tubes_per_primer=tubes_per_primer,
+            master_mix_tube_reactions=tube_reactions,
+            master_mix_tube_vol=mix_per_reaction * tube_reactions,
+            primer_vol=PRIMER_MIX_PER_WELL * tube_reactions,
+            master_mix_reactions=mm_reactions * scale,
+            buffer_mix_tube=buffer_tube,
+            buffer_mix_tubes=buffer_tubes,
+            buffer_mix_vol=buffer_total,
+            primer_tube=primer_tube,
+            reagent_vols=reagent_vols,
+        ))
+    return plans
+
+
+def summary(plan):
+    lines = [
+        '{} primers x {} reactions'.format(plan.primers, plan.reactions_per_primer),
+        '  master mix tubes:  {} per primer, {} reactions each ({:.1f} uL master mix + {:.1f} uL primer)'.format(
+            plan.tubes_per_primer, plan.master_mix_tube_reactions, plan.master_mix_tube_vol, plan.primer_vol),
+        '  buffer mix:        {:.1f} uL in {} x {}'.format(plan.buffer_mix_vol, plan.buffer_mix_tubes,
+                                                             plan.buffer_mix_tube),
+        '  primer source:     {} per primer'.format(plan.primer_tube),
+    ]
+    lines.extend('  {:<18} {:.1f} uL'.format(name + ':', vol) for name, vol in plan.reagent_vols.items())
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    layouts = [tuple(int(n) for n in arg.lower().split('x')) for arg in sys.argv[1:]]
+    for plan in calculate(layouts):
+        print(summary(plan))
@@ -0,0 +1,284 @@
+"""
+Dependency-graph scheduler for compiled layout plans. A plan is split into tasks (everything one tip is used for, or a
+single step that handles its own tips), tasks that touch the same wells in a way that does not commute are linked, and
+the tasks are list-scheduled longest remaining path first to give a reordered plan.
+
+Usage:
+    python schedule.py 3_plate_qPCR_quantification [-o plan.json] [--protocol scheduled_protocol.py]
+
+Both pipettes hang off the one gantry, so their tasks can not run at the same time: only time the gantry is free
+(modules warming up, see schedule() non_gantry) can be overlapped, and otherwise the reordered plan mainly changes
+travel. The reordered plan is only returned when the simulator estimates it is faster than the original.
+"""
+import argparse
+import collections
+import json
+import sys
+
+import layout
+
+ROWS = 'ABCDEFGH'
+
+Task = collections.namedtuple('Task', ['steps', 'phase', 'pipette', 'adds', 'exclusive', 'duration'])
+
+
+def _wells(ref, channels):
+    """
+    (labware, well) pairs a location reference touches with a pipette holding channels tips
+    """
+    if ref is None:
+        return []
+    refs = ref if isinstance(ref[0], list) else [ref]
+    wells = []
+    for labware_key, well, *_ in refs:
+        first = ROWS.index(well[0]) if well[0] in ROWS else 0
+        rows = ROWS[first:first + channels] if channels > 1 else well[0]
+        wells.extend((labware_key, row + well[1:]) for row in rows)
+    return wells
+
+
+def _task(plan, steps, durations, cold=()):
+    """
+    Builds the Task of plan steps, working out the wells it adds liquid to (which commutes with other additions) and
+    those it aspirates from or mixes (which does not commute with anything touching the same well). A tip that goes on
+    to another well or back to a source after dispensing carries what was in the well with it, so the wells it adds to
+    do not commute either. Using labware in cold counts as using the tempdeck, so it waits for the tempdeck's
+    wait_for_temp step
+    """
+    adds, exclusive = set(), set()
+    channels = 1
+    current = None
+    # Liquid handling steps done with the task's tip, and whether one of them visits several destinations on one tip
+    liquid_steps = 0
+    revisits = False
+    for i in steps:
+        _, pipette, action, args = plan[i]
+        if action == 'pick_up_tip':
+            channels = args.get('n', 1)
+            if args.get('reagent'):
+                exclusive.add(('tip', args['reagent']))
+        elif action == 'return_tip':
+            exclusive.add(('tip', args.get('reagent')))
+        elif action in ('transfer', 'distribute', 'consolidate', 'distribute_planned'):
+            exclusive.update(_wells(args['source'], channels))
+            adds.update(_wells(args['dest'], channels))
+            liquid_steps += 1
+            revisits = revisits or (isinstance(args['dest'][0], list) and len(args['dest']) > 1
+                                    and args.get('new_tip', 'once') != 'always')
+            current = args['dest'] if not isinstance(args['dest'][0], list) else args['dest'][-1]
+        elif action == 'mix':
+            exclusive.update(_wells(args.get('location') or current, channels))
+        elif action == 'track_liquid':
+            exclusive.update(_wells(args['wells'], 1))
+        elif action in ('set_temperature', 'wait_for_temp'):
+            exclusive.add(('module', args['module']))
+        if cold and set(cold) & layout.labware_used(args):
+            adds.add(('module', 'tempdeck'))
+    if revisits or liquid_steps > 1:
+        exclusive.update(well for well in adds if well[0] != 'module')
+    phase, pipette = plan[steps[0]][0], plan[steps[0]][1]
+    return Task(steps, phase, pipette, adds, exclusive, sum(durations[i] for i in steps))
+
+
+def split_tasks(plan, durations, cold=()):
+    """
+    Splits plan into tasks: the steps from a pipette picking up a tip to dropping or returning it (or to the transfer
+    that drops it), and each step that is not done with a picked up tip
+
+    Parameters
+    ----------
+    plan: list
+        [phase, pipette key, action, arguments] steps
+    durations: list
+        Estimated duration of each step
+    cold: container
+        Keys of the labware on the tempdeck
+
+    Returns
+    -------
+    list
+        Tasks in plan order
+    """
+    groups = []
+    sessions = {}
+    for i, (_, pipette, action, args) in enumerate(plan):
+        if pipette in sessions:
+            sessions[pipette].append(i)
+            # Transfers drop the tip at the end unless told not to
+            if action in ('drop_tip', 'return_tip') or (
+                    action in ('transfer', 'distribute', 'consolidate', 'distribute_planned')
+                    and args.get('new_tip', 'once') != 'never'):
+                groups.append(sessions.pop(pipette))
+        elif action == 'pick_up_tip':
+            sessions[pipette] = [i]
+        else:
+            groups.append([i])
+    groups.extend(sessions.values())
+    groups.sort(key=lambda steps: steps[0])
+    return [_task(plan, steps, durations, cold) for steps in groups]
+
+
+def dependencies(tasks):
+    """
+    Returns the set of earlier tasks each task has to wait for, by index
+    """
+    predecessors = []
+    for j, later in enumerate(tasks):
+        touched = later.adds | later.exclusive
+        predecessors.append({i for i, earlier in enumerate(tasks[:j])
+                             if earlier.exclusive & touched or earlier.adds & later.exclusive})
+    return predecessors
+
+
+def critical_path(tasks, predecessors):
+    """
+    Longest chain of dependent tasks, the shortest the plan could take if nothing had to share the gantry
+
+    Returns
+    -------
+    tuple
+        Task indexes on the path and its total duration
+    """
+    finish = []
+    previous = []
+    for task, preds in zip(tasks, predecessors):
+        before = max(preds, key=lambda i: finish[i], default=None)
+        finish.append(task.duration + (finish[before] if before is not None else 0.0))
+        previous.append(before)
+    if not tasks:
+        return [], 0.0
+    last = max(range(len(tasks)), key=lambda i: finish[i])
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    return path[::-1], finish[path[0]]
+
+
+def schedule(tasks, predecessors, non_gantry=()):
+    """
+    List-schedules tasks on the gantry, picking the ready task with the longest remaining path first
+
+    Parameters
+    ----------
+    tasks: list
+        Tasks in plan order
+    predecessors: list
+        Earlier tasks each task waits for, see dependencies()
+    non_gantry: container
+        Indexes of tasks that only take time without using the gantry, e.g. waiting for a module. Other tasks run
+        while they are in progress
+
+    Returns
+    -------
+    tuple
+        Task indexes in scheduled order and the estimated makespan in seconds. Tasks not using the gantry are placed
+        just before the first task that waits for them, so a command stream run in that order does not block on them
+        any earlier
+    """
+    successors = [[] for _ in tasks]
+    for j, preds in enumerate(predecessors):
+        for i in preds:
+            successors[i].append(j)
+    remaining = [0.0] * len(tasks)
+    for i in reversed(range(len(tasks))):
+        remaining[i] = tasks[i].duration + max((remaining[j] for j in successors[i]), default=0.0)
+
+    finish = {}
+    waiting = [len(preds) for preds in predecessors]
+    ready = [i for i, count in enumerate(waiting) if count == 0]
+    order = []
+    pending = []
+    gantry_free = 0.0
+    while ready:
+        def start(i):
+            earliest = max((finish[p] for p in predecessors[i]), default=0.0)
+            return earliest if i in non_gantry else max(earliest, gantry_free)
+        # Start whatever can start soonest, the longest remaining path first among those
+        i = min(ready, key=lambda i: (start(i), -remaining[i], i))
+        ready.remove(i)
+        finish[i] = start(i) + tasks[i].duration
+        if i in non_gantry:
+            pending.append(i)
+        else:
+            gantry_free = finish[i]
+            order.extend(p for p in pending if p in predecessors[i])
+            pending = [p for p in pending if p not in predecessors[i]]
+            order.append(i)
+        for j in successors[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                ready.append(j)
+    return order + pending, max(finish.values(), default=0.0)
+
+
+def schedule_plan(spec, plan=None):
+    """
+    Reorders a plan of spec, its compiled plan by default, along its dependency graph
+
+    Returns
+    -------
+    tuple
+        The reordered plan (the original one when reordering would not make it faster) and a report dict of the critical
+        path and the simulated durations before and after
+    """
+    if plan is None:
+        plan = layout.compile_layout(spec)
+    robot, durations = layout.simulate_plan(spec, plan)
+    cold = ()
+    if spec['tempdeck']:
+        cold = {key for key, _, slot in spec['labware'] if slot == spec['tempdeck']['slot']}
+        # Waiting for the tempdeck takes the whole ramp but leaves the gantry free for anything not using it
+        ramp = sum(tempdeck.ramp_s for tempdeck in robot.tempdecks.values())
+        durations = [ramp if action == 'wait_for_temp' else duration
+                     for (_, _, action, _), duration in zip(plan, durations)]
+    tasks = split_tasks(plan, durations, cold)
+    predecessors = dependencies(tasks)
+    path, path_duration = critical_path(tasks, predecessors)
+    non_gantry = {i for i, task in enumerate(tasks) if plan[task.steps[0]][2] == 'wait_for_temp'}
+    order, _ = schedule(tasks, predecessors, non_gantry)
+    reordered = [plan[i] for task in order for i in tasks[task].steps]
+    scheduled_robot, _ = layout.simulate_plan(spec, reordered)
+
+    report = {
+        'tasks': len(tasks),
+        'dependencies': sum(len(preds) for preds in predecessors),
+        'critical_path': [[tasks[i].phase, tasks[i].pipette, round(tasks[i].duration, 1)] for i in path],
+        'critical_path_s': round(path_duration, 1),
+        'original_s': round(robot.time, 1),
+        'scheduled_s': round(scheduled_robot.time, 1),
+        'reordered': scheduled_robot.time < robot.time and reordered != plan,
+    }
+    chosen = scheduled_robot if report['reordered'] else robot
+    report['tempdeck_ramp_hidden_s'] = round(sum(tempdeck.ramp_hidden_s for tempdeck in chosen.tempdecks.values()), 1)
+    return (reordered if report['reordered'] else plan), report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('layout', help='Name of a spec in layout.SPECS or a JSON spec file')
+    parser.add_argument('-o', '--output', help='Write the scheduled plan here as JSON')
+    parser.add_argument('--protocol', help='Write a protocol file running the scheduled plan here')
+    args = parser.parse_args(argv)
+
+    spec = layout.load_spec(args.layout)
+    plan, report = schedule_plan(spec)
+    print('{} tasks, {} dependencies'.format(report['tasks'], report['dependencies']))
+    print('Critical path {:.0f} s:'.format(report['critical_path_s']))
+    for phase, pipette, duration in report['critical_path']:
+        print('  {:<24} {:<12} {:>7.1f} s'.format(phase, pipette or '-', duration))
+    print('Simulated {:.0f} s as compiled, {:.0f} s scheduled{}'.format(
+        report['original_s'], report['scheduled_s'], '' if report['reordered'] else ', keeping the compiled order'))
+    if spec['tempdeck']:
+        print('{:.0f} s of tempdeck ramp hidden behind other steps'.format(report['tempdeck_ramp_hidden_s']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(plan, f, indent=1)
+    if args.protocol:
+        with open(args.protocol, 'w') as f:
+            f.write(layout.generate_protocol(spec, plan=plan))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
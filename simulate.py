@@ -0,0 +1,820 @@
+"""
+Offline stand-in for the opentrons legacy API (labware, instruments, robot, modules) that executes a protocol file in
+milliseconds and estimates how long it would take on the robot.
+
+Usage:
+    python simulate.py 3_plate_qPCR_quantification_protocol.py [more protocol files]
+
+Positions, speeds and flow rates are approximations of an OT-2 with the default legacy settings, good enough to compare
+protocol variants with each other rather than to predict run time to the second.
+"""
+import collections
+import contextlib
+import io
+import math
+import sys
+import types
+
+# Front left corner of each deck slot (mm)
+SLOT_ORIGINS = {
+    '1': (0.0, 0.0), '2': (132.5, 0.0), '3': (265.0, 0.0),
+    '4': (0.0, 90.5), '5': (132.5, 90.5), '6': (265.0, 90.5),
+    '7': (0.0, 181.0), '8': (132.5, 181.0), '9': (265.0, 181.0),
+    '10': (0.0, 271.5), '11': (132.5, 271.5), '12': (265.0, 271.5),
+}
+MODULE_HEIGHTS = {'tempdeck': 80.09, 'magdeck': 40.0}
+MOUNT_OFFSETS = {'left': -17.0, 'right': 17.0}
+
+XY_SPEED = 400.0  # mm/s
+Z_SPEED = 125.0  # mm/s
+MOVE_OVERHEAD = 0.05  # s, acceleration and settling per move
+ARC_CLEARANCE = 10.0  # mm above the tallest labware on the way
+PICK_UP_PRESS_TIME = 0.8  # s per press
+PICK_UP_PRESSES = 3
+DROP_TIP_TIME = 1.5  # s
+BLOW_OUT_TIME = 0.5  # s
+COMMENT_TIME = 0.0  # s
+TEMPDECK_START_TEMP = 25.0  # degrees C
+TEMPDECK_RAMP_RATE = 0.1  # degrees C/s when cooling
+
+PIPETTES = {
+    # name: (channels, min_volume, max_volume, aspirate flow rate, dispense flow rate)
+    'P10_Single': (1, 1, 10, 5, 10),
+    'P10_Multi': (8, 1, 10, 5, 10),
+    'P50_Single': (1, 5, 50, 25, 50),
+    'P50_Multi': (8, 5, 50, 25, 50),
+    'P300_Single': (1, 30, 300, 150, 300),
+    'P300_Multi': (8, 30, 300, 150, 300),
+    'P1000_Single': (1, 100, 1000, 500, 1000),
+}
+
+
+def _grid(rows, columns, a1_x, a1_y, pitch_x, pitch_y, depth, diameter, max_volume):
+    return {'{}{}'.format(row, col + 1): (a1_x + col * pitch_x, a1_y - r * pitch_y, depth, diameter, max_volume)
+            for col in range(columns) for r, row in enumerate(rows)}
+
+
+def _tuberack_15_50ml():
+    wells = _grid('ABC', 2, 14.5, 75.5, 25.0, 25.0, 117.5, 14.5, 15000)
+    wells.update({name: (71.4 + (int(name[1]) - 3) * 35.0, 60.8 - 'AB'.index(name[0]) * 35.0, 113.0, 26.7, 50000)
+                  for name in ('A3', 'B3', 'A4', 'B4')})
+    return wells
+
+
+# name: (height, {well name: (x, y, depth, diameter, max volume)}), wells listed column by column
+LABWARE = {
+    'opentrons-tiprack-300ul': (60.0, _grid('ABCDEFGH', 12, 14.38, 74.24, 9.0, 9.0, 59.3, 5.2, 300)),
+    '96-flat': (10.5, _grid('ABCDEFGH', 12, 14.38, 74.24, 9.0, 9.0, 10.5, 6.4, 400)),
+    'opentrons-aluminum-block-96-PCR-plate': (21.0, _grid('ABCDEFGH', 12, 14.38, 74.24, 9.0, 9.0, 14.8, 5.5, 200)),
+    '384-plate': (14.2, _grid('ABCDEFGHIJKLMNOP', 24, 12.13, 76.48, 4.5, 4.5, 11.5, 3.7, 112)),
+    'PCR-strip-tall': (20.0, _grid('ABCDEFGH', 12, 14.38, 74.24, 9.0, 9.0, 19.5, 5.5, 280)),
+    'opentrons-tuberack-2ml-eppendorf': (42.0, _grid('ABCD', 6, 18.21, 75.43, 19.89, 19.28, 38.0, 8.7, 2000)),
+    'opentrons-aluminum-block-2ml-eppendorf': (42.0, _grid('ABCD', 6, 20.75, 68.63, 17.25, 17.25, 38.0, 8.7, 2000)),
+    'storeylab-2ml-coldrack1': (42.0, _grid('ABCD', 6, 20.75, 68.63, 17.25, 17.25, 38.0, 8.7, 2000)),
+    'opentrons-tuberack-15_50ml': (120.0, _tuberack_15_50ml()),
+    'fixed-trash': (82.0, {'A1': (63.88, 42.74, 58.0, 100.0, float('inf'))}),
+}
+
+Command = collections.namedtuple('Command', 'name pipette volume slot labware well tips start duration distance text')
+
+
+class SimulationError(Exception):
+    """
+    Raised when a protocol asks the simulated robot for something the real robot cannot do
+    """
+    pass
+
+
+class Vector(collections.namedtuple('Vector', 'x y z')):
+    """
+    Offset from the bottom centre of a well, as returned by Well.from_center()
+    """
+    pass
+
+
+class Well:
+    __slots__ = ('labware', 'name', 'x', 'y', 'depth', 'diameter', 'max_volume', 'properties', '_bottom')
+
+    def __init__(self, labware, name, x, y, depth, diameter, max_volume, properties=None):
+        self.labware = labware
+        self.name = name
+        self.x = x
+        self.y = y
+        self.depth = depth
+        self.diameter = diameter
+        self.max_volume = max_volume
+        # Read only, so wells of the same geometry can share theirs
+        self.properties = properties or {'depth': depth, 'diameter': diameter, 'total-liquid-volume': max_volume}
+        base_x, base_y, base_z = labware.origin
+        self._bottom = (base_x + x, base_y + y, base_z + labware.height - depth)
+
+    def __repr__(self):
+        return '<Well {}>'.format(self.name)
+
+    def get_name(self):
+        return self.name
+
+    def get_parent(self):
+        return self.labware
+
+    def bottom(self, z=0):
+        return self, Vector(0.0, 0.0, z)
+
+    def top(self, z=0):
+        return self, Vector(0.0, 0.0, self.depth + z)
+
+    def from_center(self, x=0, y=0, z=0):
+        """
+        Offset from the centre of the well with x, y and z given as fractions (-1 to 1) of its half width and depth
+        """
+        radius = self.diameter / 2
+        return Vector(x * radius, y * radius, self.depth / 2 * (1 + z))
+
+    def coordinates(self, offset=None):
+        """
+        Deck coordinates of the well's bottom centre, or of an offset from it
+        """
+        if offset is None:
+            return self._bottom
+        x, y, z = self._bottom
+        return x + offset[0], y + offset[1], z + offset[2]
+
+
+class WellSeries(list):
+    """
+    Row or column of wells. Used as a location it stands for its first well, like the legacy API
+    """
+    def __getattr__(self, name):
+        return getattr(self[0], name)
+
+    def get_name(self):
+        return self[0].get_name()
+
+
+class Slot:
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+# Well arguments and column well indices of each labware name, worked out on its first load
+_well_templates = {}
+
+
+def _well_template(name):
+    """
+    Returns the Well arguments after labware of each well of labware name, in order, and the indices of the wells of
+    each column
+    """
+    if name not in _well_templates:
+        properties = {}
+        wells = []
+        columns = collections.OrderedDict()
+        for i, (well_name, definition) in enumerate(LABWARE[name][1].items()):
+            depth, diameter, max_volume = definition[2:]
+            shared = properties.setdefault(definition[2:], {
+                'depth': depth, 'diameter': diameter, 'total-liquid-volume': max_volume})
+            wells.append((well_name,) + tuple(definition) + (shared,))
+            columns.setdefault(well_name[1:], []).append(i)
+        _well_templates[name] = wells, list(columns.items())
+    return _well_templates[name]
+
+
+class Labware:
+    def __init__(self, name, slot, base_z=0.0, label=None):
+        if name not in LABWARE:
+            raise SimulationError("Unknown labware '{}', add its geometry to simulate.LABWARE".format(name))
+        self.name = name
+        self.label = label or name
+        self.slot = str(slot)
+        self.properties = {'type': name}
+        self.height = LABWARE[name][0]
+        self.origin = SLOT_ORIGINS[self.slot] + (base_z,)
+        wells, columns = _well_template(name)
+        self._wells = [Well(self, *well) for well in wells]
+        self._by_name = dict(zip((well[0] for well in wells), self._wells))
+        self._columns = collections.OrderedDict((column, WellSeries(self._wells[i] for i in indices))
+                                                for column, indices in columns)
+        self.tips = set(self._by_name) if 'tiprack' in name else set()
+
+    def __repr__(self):
+        return '<Labware {} in slot {}>'.format(self.name, self.slot)
+
+    def __iter__(self):
+        return iter(self._wells)
+
+    def __len__(self):
+        return len(self._wells)
+
+    def __getitem__(self, index):
+        return self._wells[index]
+
+    def get_name(self):
+        return self.label
+
+    def get_parent(self):
+        return Slot(self.slot)
+
+    def well(self, name):
+        return self._by_name[name] if isinstance(name, str) else self._wells[name]
+
+    def wells(self, *args, to=None, length=None):
+        """
+        Single well for one name, otherwise a WellSeries, following the legacy Container.wells() call forms
+        """
+        if not args and to is None and length is None:
+            return WellSeries(self._wells)
+        if len(args) == 1 and isinstance(args[0], (list, tuple)):
+            return WellSeries(self.well(name) for name in args[0])
+        if to is not None or length is not None:
+            names = [well.name for well in self._wells]
+            start = names.index(args[0]) if args else 0
+            end = names.index(to) + 1 if to is not None else start + length
+            return WellSeries(self._wells[start:end])
+        if len(args) == 1:
+            return self.well(args[0])
+        return WellSeries(self.well(name) for name in args)
+
+    def columns(self, *args, to=None, length=None):
+        names = list(self._columns)
+        if len(args) == 1 and isinstance(args[0], (list, tuple)):
+            args = args[0]
+        args = [str(arg) for arg in args]
+        if not args:
+            return [self._columns[name] for name in names]
+        if to is not None or length is not None:
+            start = names.index(args[0])
+            end = names.index(str(to)) + 1 if to is not None else start + length
+            return [self._columns[name] for name in names[start:end]]
+        if len(args) == 1:
+            return self._columns[args[0]]
+        return [self._columns[name] for name in args]
+
+    cols = columns
+
+
+class TempDeck:
+    def __init__(self, robot, slot):
+        self.robot = robot
+        self.slot = str(slot)
+        self.temperature = TEMPDECK_START_TEMP
+        self.target = None
+        self.settled = True
+        self.ramp_s = 0.0
+        self.ramp_hidden_s = 0.0
+        self._ramp_start = 0.0
+        self._ramp_end = 0.0
+
+    def set_temperature(self, celsius):
+        """
+        Starts ramping to celsius, like the legacy TempDeck this does not wait for the temperature to be reached
+        """
+        ramp = abs(self.temperature - celsius) / TEMPDECK_RAMP_RATE
+        self.target = celsius
+        self._ramp_start = self.robot.time
+        self._ramp_end = self.robot.time + ramp
+        self.settled = ramp == 0
+        self.ramp_s += ramp
+        self.temperature = celsius
+        self.robot._record('set_temperature', duration=0.0, slot=self.slot, volume=celsius)
+
+    def wait_for_temp(self):
+        """
+        Blocks until the ramp finishes, the part of the ramp spent doing something else counts as hidden
+        """
+        waited = max(0.0, self._ramp_end - self.robot.time)
+        if not self.settled:
+            self.ramp_hidden_s += (self._ramp_end - self._ramp_start) - waited
+            self.settled = True
+        self.robot._record('wait_for_temp', duration=waited, slot=self.slot)
+
+    def deactivate(self):
+        self.target = None
+        self.robot._record('deactivate', duration=0.0, slot=self.slot)
+
+
+class Robot:
+    """
+    Simulated robot: keeps the clock, the gantry position and the log of executed commands
+    """
+    def __init__(self):
+        self.time = 0.0
+        self.distance = 0.0
+        self.commands = []
+        self.warnings = []
+        self.volumes = collections.defaultdict(float)
+        self.fixed_trash = Labware('fixed-trash', '12')
+        self.deck = {'12': self.fixed_trash}
+        self.position = self.fixed_trash.well('A1').coordinates(Vector(0.0, 0.0, 150.0))
+        self.modules = {}
+        self.tempdecks = {}
+        # Height of the tallest labware plus clearance, worked out again when labware is loaded
+        self._clearance = None
+
+    def is_simulating(self):
+        return True
+
+    def comment(self, msg):
+        self._record('comment', duration=COMMENT_TIME, text=str(msg))
+
+    def pause(self, msg=None):
+        self._record('pause', duration=0.0, text=msg)
+
+    def home(self):
+        self._move((self.position[0], self.position[1], 150.0))
+
+    def clear_commands(self):
+        self.commands = []
+
+    def _safe_height(self):
+        if self._clearance is None:
+            self._clearance = max([labware.origin[2] + labware.height for labware in self.deck.values()] +
+                                  [0.0]) + ARC_CLEARANCE
+        return self._clearance
+
+    def _move(self, target, same_labware=False):
+        """
+        Moves the gantry in an arc to target and returns the time it took
+        """
+        x, y, z = self.position
+        target_x, target_y, target_z = target
+        if x == target_x and y == target_y:
+            z_travel = abs(target_z - z)
+            xy_travel = 0.0
+        else:
+            clearance = max(z, target_z) if same_labware else max(self._safe_height(), z, target_z)
+            z_travel = (clearance - z) + (clearance - target_z)
+            xy_travel = math.hypot(target_x - x, target_y - y)
+        self.position = target
+        self.distance += xy_travel + z_travel
+        return xy_travel + z_travel, xy_travel / XY_SPEED + z_travel / Z_SPEED + MOVE_OVERHEAD
+
+    def _record(self, name, duration, pipette=None, volume=None, slot=None, labware=None, well=None, tips=None,
+                distance=0.0, text=None):
+        self.commands.append(Command(name, pipette, volume, slot, labware, well, tips, self.time, duration, distance,
+                                     text))
+        self.time += duration
+
+
+def mix_duration(flow_rate, repetitions, volume, rate=1.0):
+    """
+    Seconds spent aspirating and dispensing volume repetitions times at rate times a pipette's flow_rate
+    """
+    return repetitions * (volume / (flow_rate['aspirate'] * rate) + volume / (flow_rate['dispense'] * rate))
+
+
+class Pipette:
+    def __init__(self, robot, model, mount, tip_racks=(), trash_container=None, **kwargs):
+        self.robot = robot
+        self.model = model
+        self.name = '{}_{}'.format(model, mount)
+        self.mount = mount
+        self.channels, self.min_volume, self.max_volume, aspirate_rate, dispense_rate = PIPETTES[model]
+        self.flow_rate = {'aspirate': aspirate_rate, 'dispense': dispense_rate}
+        self.tip_racks = list(tip_racks)
+        self.trash_container = trash_container or robot.fixed_trash
+        self.current_volume = 0.0
+        self.tips = 0
+        self._tip_location = None
+        self._location = None
+        # ids of the rack tips the tip iterator was told to skip by start_at_tip()
+        self._skipped_tips = set()
+
+    def __repr__(self):
+        return '<{}>'.format(self.name)
+
+    def set_flow_rate(self, aspirate=None, dispense=None):
+        if aspirate:
+            self.flow_rate['aspirate'] = aspirate
+        if dispense:
+            self.flow_rate['dispense'] = dispense
+        return self
+
+    def has_tip_rack(self):
+        return bool(self.tip_racks)
+
+    def current_tip(self):
+        return self._tip_location
+
+    def _resolve(self, location):
+        """
+        Returns (labware, well, deck coordinates) for any location form the protocols pass to a pipette
+        """
+        if location is None:
+            if self._location is None:
+                raise SimulationError('{} has no current location'.format(self.name))
+            return self._location
+        offset = None
+        if isinstance(location, tuple):
+            location, offset = location
+        if isinstance(location, WellSeries):
+            location = location[0]
+        if isinstance(location, Labware):
+            x, y, z = location.origin
+            return location, None, (x + 63.88, y + 42.74, z + location.height)
+        return location.labware, location, location.coordinates(offset)
+
+    def _move_to(self, location):
+        labware, well, target = self._resolve(location)
+        same_labware = labware is not None and self._location is not None and self._location[0] is labware
+        nozzle = (target[0] - MOUNT_OFFSETS[self.mount], target[1], target[2])
+        distance, duration = self.robot._move(nozzle, same_labware=same_labware)
+        self._location = (labware, well, target)
+        return labware, well, distance, duration
+
+    def _record(self, name, location, duration, volume=None, tips=None):
+        labware, well, distance, move_time = self._move_to(location)
+        robot = self.robot
+        if labware is None:
+            slot = labware_name = None
+        else:
+            slot, labware_name = labware.slot, labware.name
+            tempdeck = robot.tempdecks.get(slot) if robot.tempdecks else None
+            if tempdeck is not None and not tempdeck.settled and robot.time < tempdeck._ramp_end:
+                robot.warnings.append('{} used labware on the tempdeck in slot {} before it reached {} C'.format(
+                    self.name, slot, tempdeck.target))
+                tempdeck.settled = True
+        duration += move_time
+        # Robot._record() inlined, this runs for every simulated command
+        well_name = well.name if well is not None else None
+        robot.commands.append(Command(name, self.name, volume, slot, labware_name, well_name, tips or self.tips,
+                                      robot.time, duration, distance, None))
+        robot.time += duration
+        return well
+
+    def move_to(self, location, strategy=None):
+        self._record('move_to', location, 0.0)
+        return self
+
+    def delay(self, seconds=0, minutes=0):
+        self.robot._record('delay', seconds + minutes * 60, pipette=self.name)
+        return self
+
+    def start_at_tip(self, start_tip):
+        order = [well for rack in self.tip_racks for well in rack.wells()]
+        self._skipped_tips = set(map(id, order[:order.index(start_tip)]))
+        return self
+
+    def _next_rack_tip(self):
+        for rack in self.tip_racks:
+            for column in rack.columns():
+                present = [well for well in column if well.name in rack.tips and id(well) not in self._skipped_tips]
+                if self.channels == 1 and present:
+                    return present[0]
+                if self.channels > 1 and len(present) == len(column):
+                    return column[0]
+        raise SimulationError('{} has run out of tips'.format(self.name))
+
+    def pick_up_tip(self, location=None, presses=None, increment=None):
+        if self.tips:
+            self.robot.warnings.append('{} picked up a tip while already holding one'.format(self.name))
+        if location is None:
+            location = self._next_rack_tip()
+        labware, well, _ = self._resolve(location)
+        # A multi-channel lowered onto a row picks up every tip at and below it in that column
+        covered = self._channel_wells(well, self.channels)
+        picked = [tip for tip in covered if tip.name in labware.tips]
+        if not picked:
+            raise SimulationError('{} found no tips at {} in slot {}'.format(self.name, well.name, labware.slot))
+        labware.tips.difference_update(tip.name for tip in picked)
+        self.tips = len(picked)
+        self._tip_location = well
+        presses = PICK_UP_PRESSES if presses is None else presses
+        self._record('pick_up_tip', well, PICK_UP_PRESS_TIME * presses, tips=self.tips)
+        return self
+
+    def drop_tip(self, location=None, home_after=True):
+        if not self.tips:
+            raise SimulationError('{} has no tip to drop'.format(self.name))
+        self._record('drop_tip', self.trash_container if location is None else location, DROP_TIP_TIME)
+        self.tips = 0
+        self.current_volume = 0.0
+        self._tip_location = None
+        return self
+
+    def return_tip(self, home_after=True):
+        if self._tip_location is None:
+            raise SimulationError('{} has no tip to return'.format(self.name))
+        well = self._tip_location
+        well.labware.tips.update(tip.name for tip in self._channel_wells(well, self.tips))
+        self._record('return_tip', well, DROP_TIP_TIME)
+        self.tips = 0
+        self.current_volume = 0.0
+        self._tip_location = None
+        return self
+
+    def _check_tip(self, action):
+        if not self.tips:
+            raise SimulationError('{} cannot {} without a tip'.format(self.name, action))
+
+    def _track_volume(self, well, volume):
+        if well is not None:
+            for channel_well in self._channel_wells(well):
+                self.robot.volumes[(well.labware.slot, channel_well.name)] += volume
+
+    def _channel_wells(self, well, channels=None):
+        """
+        Wells of well's column under the first channels channels (the tips held by default), every other row on
+        labware with twice as many rows as the pipette has channels
+        """
+        channels = self.tips if channels is None else channels
+        if self.channels == 1 or channels == 1:
+            return [well]
+        column = well.labware.columns(well.name[1:])
+        start = column.index(well)
+        step = max(1, len(column) // self.channels)
+        return column[start:start + channels * step:step]
+
+    def aspirate(self, volume=None, location=None, rate=1.0):
+        self._check_tip('aspirate')
+        if volume is None:
+            volume = self.max_volume - self.current_volume
+        if self.current_volume + volume > self.max_volume + 1e-9:
+            self.robot.warnings.append('{} aspirated {:.2f} uL over its {} uL maximum'.format(
+                self.name, self.current_volume + volume - self.max_volume, self.max_volume))
+        if 0 < volume < self.min_volume:
+            self.robot.warnings.append('{} aspirated {:.2f} uL, below its {} uL minimum'.format(
+                self.name, volume, self.min_volume))
+        well = self._record('aspirate', location, volume / (self.flow_rate['aspirate'] * rate), volume=volume)
+        self._track_volume(well, -volume)
+        self.current_volume += volume
+        return self
+
+    def dispense(self, volume=None, location=None, rate=1.0):
+        self._check_tip('dispense')
+        if volume is None:
+            volume = self.current_volume
+        well = self._record('dispense', location, volume / (self.flow_rate['dispense'] * rate), volume=volume)
+        self._track_volume(well, volume)
+        self.current_volume = max(0.0, self.current_volume - volume)
+        return self
+
+    def mix(self, repetitions=1, volume=None, location=None, rate=1.0):
+        self._check_tip('mix')
+        volume = self.max_volume if volume is None else volume
+        self._record('mix', location, mix_duration(self.flow_rate, repetitions, volume, rate), volume=volume)
+        return self
+
+    def blow_out(self, location=None):
+        self._check_tip('blow_out')
+        if location is None and self._location is None:
+            location = self.trash_container
+        self._record('blow_out', location, BLOW_OUT_TIME)
+        self.current_volume = 0.0
+        return self
+
+    def touch_tip(self, location=None, radius=1.0, v_offset=-1.0, speed=60.0):
+        self._record('touch_tip', location, 1.0)
+        return self
+
+    def transfer(self, volume, source, dest, **kwargs):
+        """
+        Breaks a transfer into aspirate and dispense steps the way the legacy Pipette.transfer() does and executes them
+        """
+        kwargs.setdefault('mode', 'transfer')
+        new_tip = kwargs.get('new_tip', 'once')
+        for step in self.plan_transfer(volume, source, dest, **kwargs):
+            if step[0] == 'aspirate':
+                if new_tip != 'never' and not self.tips:
+                    self.pick_up_tip()
+                if kwargs.get('mix_before'):
+                    self.mix(*kwargs['mix_before'], location=step[2])
+                self.aspirate(step[1], step[2])
+            elif step[0] == 'dispense':
+                self.dispense(step[1], step[2])
+                if kwargs.get('mix_after') and kwargs['mix_after'][0]:
+                    self.mix(*kwargs['mix_after'], location=step[2])
+            elif step[0] == 'blow_out':
+                self.blow_out(self.trash_container if step[2] is None else step[2])
+            elif step[0] == 'drop_tip' and new_tip != 'never':
+                self.drop_tip()
+        return self
+
+    def distribute(self, volume, source, dest, **kwargs):
+        kwargs['mode'] = 'distribute'
+        kwargs['mix_after'] = (0, 0)
+        kwargs.setdefault('disposal_vol', self.min_volume)
+        return self.transfer(volume, source, dest, **kwargs)
+
+    def consolidate(self, volume, source, dest, **kwargs):
+        kwargs['mode'] = 'consolidate'
+        kwargs['mix_before'] = (0, 0)
+        kwargs.setdefault('disposal_vol', 0)
+        return self.transfer(volume, source, dest, **kwargs)
+
+    def plan_transfer(self, volume, source, dest, **kwargs):
+        """
+        Returns the ('aspirate' | 'dispense' | 'blow_out' | 'drop_tip', volume, location) steps of a transfer, chunked
+        like the legacy API: volumes over the usable maximum are split evenly, distribute merges dispenses from one
+        source into a single aspirate and consolidate merges aspirates into one dispense
+        """
+        mode = kwargs.get('mode', 'transfer')
+        disposal = kwargs.get('disposal_vol', 0) if mode == 'distribute' else 0
+        max_volume = self.max_volume - kwargs.get('air_gap', 0) - disposal
+        sources = source if isinstance(source, list) and not isinstance(source, WellSeries) else [source]
+        dests = dest if isinstance(dest, list) and not isinstance(dest, WellSeries) else [dest]
+        count = max(len(sources), len(dests))
+        sources = sources * count if len(sources) == 1 else sources
+        dests = dests * count if len(dests) == 1 else dests
+        volumes = volume if isinstance(volume, (list, tuple)) else [volume] * count
+
+        pairs = []
+        for vol, src, dst in zip(volumes, sources, dests):
+            parts = max(1, int(math.ceil(vol / max_volume - 1e-9)))
+            pairs.extend([(vol / parts, src, dst)] * parts)
+
+        blow_out = kwargs.get('blow_out', False)
+        blow_out_location = None if isinstance(blow_out, bool) else blow_out
+        steps = []
+        if mode == 'distribute':
+            group = []
+            for vol, src, dst in pairs + [(None, None, None)]:
+                if group and (vol is None or src is not group[0][1] or
+                              sum(v for v, _, _ in group) + vol > max_volume + 1e-9):
+                    steps.append(('aspirate', sum(v for v, _, _ in group) + disposal, group[0][1]))
+                    steps.extend(('dispense', v, d) for v, _, d in group)
+                    if disposal or blow_out:
+                        steps.append(('blow_out', None, blow_out_location))
+                    group = []
+                group.append((vol, src, dst))
+        elif mode == 'consolidate':
+            group = []
+            for vol, src, dst in pairs + [(None, None, None)]:
+                if group and (vol is None or dst is not group[0][2] or
+                              sum(v for v, _, _ in group) + vol > max_volume + 1e-9):
+                    steps.extend(('aspirate', v, s) for v, s, _ in group)
+                    steps.append(('dispense', sum(v for v, _, _ in group), group[0][2]))
+                    if blow_out:
+                        steps.append(('blow_out', None, blow_out_location))
+                    group = []
+                group.append((vol, src, dst))
+        else:
+            for vol, src, dst in pairs:
+                steps.append(('aspirate', vol, src))
+                steps.append(('dispense', vol, dst))
+                if blow_out:
+                    steps.append(('blow_out', None, blow_out_location))
+                if kwargs.get('new_tip') == 'always':
+                    steps.append(('drop_tip', None, None))
+        if kwargs.get('new_tip', 'once') == 'once':
+            steps.append(('drop_tip', None, None))
+        return steps
+
+
+class SimulationReport:
+    """
+    Result of simulating one protocol file: the executed commands and the counts, travel and time derived from them
+    """
+    def __init__(self, protocol, robot, output=''):
+        self.protocol = protocol
+        self.commands = robot.commands
+        self.warnings = robot.warnings
+        self.volumes = dict(robot.volumes)
+        self.output = output
+        self.duration = robot.time
+        self.distance = robot.distance
+        self.tempdeck_ramp = sum(tempdeck.ramp_s for tempdeck in robot.tempdecks.values())
+        self.tempdeck_ramp_hidden = sum(tempdeck.ramp_hidden_s for tempdeck in robot.tempdecks.values())
+        self.counts = collections.Counter(command.name for command in self.commands)
+        self.mix_time = sum(command.duration for command in self.commands if command.name == 'mix')
+        self.tips = collections.Counter()
+        for command in self.commands:
+            if command.name == 'pick_up_tip':
+                self.tips[command.slot] += command.tips
+            elif command.name == 'return_tip':
+                self.tips[command.slot] -= command.tips
+
+    def as_dict(self):
+        return {
+            'protocol': self.protocol,
+            'duration_s': round(self.duration, 1),
+            'distance_mm': round(self.distance, 1),
+            'commands': dict(self.counts),
+            'tips': dict(self.tips),
+            'mix_s': round(self.mix_time, 1),
+            'tempdeck_ramp_s': round(self.tempdeck_ramp, 1),
+            'tempdeck_ramp_hidden_s': round(self.tempdeck_ramp_hidden, 1),
+            'warnings': list(self.warnings),
+        }
+
+    def summary(self):
+        counts = ', '.join('{} {}'.format(self.counts[name], name) for name in
+                           ('pick_up_tip', 'aspirate', 'dispense', 'mix', 'blow_out', 'drop_tip', 'return_tip')
+                           if self.counts[name])
+        lines = [
+            self.protocol,
+            '  estimated time:   {}'.format(format_duration(self.duration)),
+            '  gantry travel:    {:.1f} m'.format(self.distance / 1000),
+            '  mixing:           {}'.format(format_duration(self.mix_time)),
+            '  commands:         {}'.format(counts),
+            '  tips used:        {}'.format(', '.join('{} from slot {}'.format(n, slot)
+                                                      for slot, n in sorted(self.tips.items()))),
+        ]
+        if self.tempdeck_ramp:
+            lines.append('  tempdeck ramp:    {} of {} hidden behind other steps'.format(
+                format_duration(self.tempdeck_ramp_hidden), format_duration(self.tempdeck_ramp)))
+        lines.extend('  warning: {}'.format(warning) for warning in self.warnings)
+        return '\n'.join(lines)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h {:02d}m {:02d}s'.format(hours, minutes, seconds) if hours else '{}m {:02d}s'.format(minutes, seconds)
+
+
+def opentrons_modules(robot):
+    """
+    Builds stand-ins for the opentrons modules the protocols import, all bound to robot
+    """
+    def load_labware(name, slot, label=None, share=False):
+        slot = str(slot)
+        if slot in robot.deck and not share:
+            raise SimulationError("Slot {} already holds {}, pass share=True to stack labware".format(
+                slot, robot.deck[slot].name))
+        module = robot.modules.get(slot)
+        labware = Labware(name, slot, base_z=MODULE_HEIGHTS[module] if module else 0.0, label=label)
+        robot.deck[slot] = labware
+        robot._clearance = None
+        return labware
+
+    def load_module(name, slot):
+        slot = str(slot)
+        robot.modules[slot] = name
+        robot.tempdecks[slot] = TempDeck(robot, slot)
+        return robot.tempdecks[slot]
+
+    opentrons = types.ModuleType('opentrons')
+    opentrons.robot = robot
+    opentrons.labware = opentrons.containers = types.SimpleNamespace(load=load_labware)
+    opentrons.modules = types.SimpleNamespace(load=load_module)
+    opentrons.instruments = types.SimpleNamespace(**{
+        model: (lambda model: lambda mount, tip_racks=(), **kwargs: Pipette(robot, model, mount, tip_racks, **kwargs))(
+            model) for model in PIPETTES})
+    legacy_api = types.ModuleType('opentrons.legacy_api')
+    containers = types.ModuleType('opentrons.legacy_api.containers')
+    placeable = types.ModuleType('opentrons.legacy_api.containers.placeable')
+    placeable.Container = Labware
+    placeable.Well = Well
+    placeable.WellSeries = WellSeries
+    opentrons.legacy_api = legacy_api
+    legacy_api.containers = containers
+    containers.placeable = placeable
+    return {'opentrons': opentrons, 'opentrons.legacy_api': legacy_api,
+            'opentrons.legacy_api.containers': containers, 'opentrons.legacy_api.containers.placeable': placeable}
+
+
+@contextlib.contextmanager
+def simulated_opentrons(robot=None):
+    """
+    Makes `import opentrons` resolve to the stand-ins for the duration of the block
+
+    Yields
+    ------
+    Robot
+        The simulated robot the stand-ins record into
+    """
+    robot = robot or Robot()
+    fakes = opentrons_modules(robot)
+    saved = {name: sys.modules.get(name) for name in fakes}
+    sys.modules.update(fakes)
+    try:
+        yield robot
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+
+def simulate(protocol_file, quiet=True):
+    """
+    Executes a protocol file against the simulated robot
+
+    Parameters
+    ----------
+    protocol_file: str
+        Path of the protocol to run
+    quiet: bool
+        Capture what the protocol prints instead of passing it through
+
+    Returns
+    -------
+    SimulationReport
+        Commands executed with their estimated times and gantry travel
+    """
+    with open(protocol_file) as f:
+        code = compile(f.read(), protocol_file, 'exec')
+    output = io.StringIO()
+    with simulated_opentrons() as robot:
+        with contextlib.redirect_stdout(output) if quiet else contextlib.suppress():
+            exec(code, {'__name__': '__main__', '__file__': protocol_file})
+    return SimulationReport(protocol_file, robot, output.getvalue())
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        print(simulate(path).summary())
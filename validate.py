@@ -0,0 +1,335 @@
+"""
+Pre-run resource check for layout specs and protocol files. One pass over the compiled plan follows the liquid in every
+well from what is loaded on the deck, through every aspirate and dispense, and counts the tips each pipette takes, so
+volumes that do not add up are found before the robot moves instead of part way through a run.
+
+Usage:
+    python validate.py [3_plate_qPCR_quantification ... 3_plate_qPCR_quantification_protocol.py ...]
+
+Errors are wells that run dry or overflow, tips running out and negative recipe volumes; warnings are pipette volumes
+outside the pipette's range, mixes of more than the well holds and liquid level tracking starting from the wrong
+volume. The exit status is 1 when there are errors. Tip racks are assumed to start full.
+
+Hand-written protocol files (every spec and every file in benchmark.PROTOCOLS by default) are checked by
+validate_protocol() over the commands they give the simulated robot instead. They do not say what is loaded on the
+deck, so every well is taken to start with just what the run takes out of it: a well that runs dry cannot be told from
+one the user fills, but wells that overflow or need more loaded than they hold, negative volumes, asserts that fail
+and tips that run out are all found.
+"""
+import argparse
+import collections
+import contextlib
+import io
+import math
+import os
+import sys
+import time
+import traceback
+
+import helpers
+import layout
+import reagents
+import simulate
+from benchmark import PROTOCOLS
+from simulate import LABWARE, PIPETTES
+
+CDNA_DISPOSAL_VOL = 3.0  # uL, disposal_vol of the cDNA distributes
+CDNA_DEAD_VOL = 5.0  # uL left in a sample well
+
+Violation = collections.namedtuple('Violation', ['step', 'severity', 'message'])
+
+
+def _distribute_trips(volume, dispenses, max_volume, disposal):
+    # Pipette.distribute() fits as many whole dispenses as it can into each aspirate on top of the disposal volume
+    per_trip = max(1, int((max_volume - disposal) // volume))
+    return [min(per_trip, dispenses - start) for start in range(0, dispenses, per_trip)]
+
+
+def loaded_volumes(spec):
+    """
+    Volumes in uL put on the deck before the run, by (labware key, well): the buffer mix, the reagents the robot adds
+    (with the dead volume of their tube), the primer mixes and the sample and standard columns. The sample and
+    standard wells hold the spec's cdna_well_vol, or just enough for their dispenses and disposal volumes when None
+    """
+    wells, tube_wells = layout.reaction_counts(spec)
+    recipe = reagents.RECIPE
+    volumes = collections.defaultdict(float)
+    buffer_mix_tube = tuple(spec['buffer_mix_tube'])
+    volumes[buffer_mix_tube] = sum(recipe[name] for name in reagents.BUFFER_MIX) * wells
+    for name, key in (('formamide', 'formamide'), ('dNTP', 'dntp'), ('SYBR', 'sybr'), ('taq', 'taq')):
+        dead = reagents.TUBES[reagents.SMALL_REAGENT_TUBE[name]][1]
+        volumes[tuple(spec['reagents'][key])] += recipe[name] * wells + dead
+    _, _, primer_vol = reagents.fit_tubes(reagents.PRIMER_MIX_PER_WELL * tube_wells, ['PCR strip well', '2 mL tube'])
+    for well in spec['primers']:
+        volumes[spec['primer_plate'], well] = primer_vol
+    multi = next(model for model, _, _ in spec['pipettes'].values() if model.endswith('Multi'))
+    for source, groups in layout.cdna_distributions(spec):
+        cdna_vol = spec['cdna_well_vol']
+        if cdna_vol is None:
+            trips = [trip for group in groups for trip in _distribute_trips(
+                reagents.CDNA_VOL, len(group), PIPETTES[multi][2], CDNA_DISPOSAL_VOL)]
+            cdna_vol = sum(reagents.CDNA_VOL * trip + CDNA_DISPOSAL_VOL for trip in trips) + CDNA_DEAD_VOL
+        for row in 'ABCDEFGH':
+            volumes[spec['sample_plate'], row + source] = cdna_vol
+    return volumes
+
+
+def _refs(ref):
+    if ref is None:
+        return []
+    return [tuple(r[:2]) for r in ref] if isinstance(ref[0], list) else [tuple(ref[:2])]
+
+
+def _channel_wells(name, well, n):
+    # Wells of labware name under n channels from well down its column, every other row on 384-well plates
+    if n == 1:
+        return [well]
+    rows = [other[0] for other in LABWARE[name][1] if other[1:] == well[1:]]
+    step = max(1, len(rows) // 8)
+    first = rows.index(well[0])
+    return [row + well[1:] for row in rows[first:first + n * step:step]]
+
+
+def _split(volume, max_volume):
+    # Pipette.transfer() splits a volume larger than the pipette into equal parts
+    parts = max(1, int(math.ceil(volume / max_volume - 1e-9)))
+    return parts, volume / parts
+
+
+def validate_plan(spec, plan=None):
+    """
+    Checks a spec's plan, its compiled plan by default, in one sweep over its steps
+
+    Returns
+    -------
+    list
+        Violation(step index or None, 'error' | 'warning', message) tuples, in plan order
+    """
+    if plan is None:
+        plan = layout.compile_layout(spec)
+    violations = []
+    for name, volume in reagents.RECIPE.items():
+        if volume < 0:
+            violations.append(Violation(None, 'error', '{} is {:.2f} uL per well'.format(name, volume)))
+
+    labware = {key: name for key, name, _ in spec['labware']}
+    volumes = loaded_volumes(spec)
+    # Worst overflow and shortfall of each well and the step it first happened at
+    overflows, shortfalls = {}, {}
+    tips_held = {}
+    pickups = collections.defaultdict(list)
+    returned = collections.Counter()
+    last_dest = {}
+
+    def capacity(ref):
+        return LABWARE[labware[ref[0]]][1][ref[1]][4]
+
+    def change(i, ref, n, volume):
+        for well in ((ref[0], name) for name in _channel_wells(labware[ref[0]], ref[1], n)):
+            volumes[well] += volume
+            if volumes[well] < -1e-6:
+                worst = shortfalls.setdefault(well, [i, 0.0])
+                worst[1] = max(worst[1], -volumes[well])
+            elif volumes[well] > capacity(well) + 1e-6:
+                worst = overflows.setdefault(well, [i, 0.0])
+                worst[1] = max(worst[1], volumes[well] - capacity(well))
+
+    def check_range(i, pipette, volume, what):
+        _, min_volume, max_volume, _, _ = PIPETTES[spec['pipettes'][pipette][0]]
+        if not min_volume - 1e-6 <= volume <= max_volume + 1e-6:
+            violations.append(Violation(i, 'warning', '{} {} {:.2f} uL, outside its {}-{} uL range'.format(
+                pipette, what, volume, min_volume, max_volume)))
+
+    for i, (_, pipette, action, args) in enumerate(plan):
+        if pipette is not None:
+            model = spec['pipettes'][pipette][0]
+            channels, _, max_volume, _, _ = PIPETTES[model]
+        if action == 'pick_up_tip':
+            n = args.get('n', channels)
+            tips_held[pipette] = n
+            reagent = args.get('reagent')
+            if reagent is not None and returned[reagent] >= n:
+                returned[reagent] -= n
+            else:
+                pickups[pipette].append(n)
+        elif action == 'return_tip':
+            returned[args.get('reagent')] += tips_held.pop(pipette, 1)
+        elif action == 'drop_tip':
+            tips_held.pop(pipette, None)
+        elif action == 'track_liquid':
+            for ref in _refs(args['wells']):
+                if abs(volumes[ref] - args['volume']) > 1.0:
+                    violations.append(Violation(i, 'warning', 'Level of {} {} tracked from {:.1f} uL but it holds '
+                                                '{:.1f} uL'.format(ref[0], ref[1], args['volume'], volumes[ref])))
+        elif action == 'mix':
+            location = _refs(args.get('location'))
+            ref = location[0] if location else last_dest.get(pipette)
+            check_range(i, pipette, args['volume'], 'mixes')
+            if ref is not None and args['volume'] > volumes[ref] + 1e-6:
+                violations.append(Violation(i, 'warning', '{} mixes {:.1f} uL in {} {} holding {:.1f} uL'.format(
+                    pipette, args['volume'], ref[0], ref[1], volumes[ref])))
+        elif action in ('transfer', 'distribute', 'consolidate', 'distribute_planned'):
+            if pipette not in tips_held and args.get('new_tip', 'once') != 'never':
+                pickups[pipette].append(channels)
+            n = tips_held.get(pipette, channels)
+            sources = _refs(args['source'])
+            dests = _refs(args['dest'])
+            volume, disposal = args['volume'], args.get('disposal_vol', 0)
+            if action == 'consolidate':
+                # Pipette.consolidate() aspirates from as many sources as fit in the tip before each dispense
+                steps = []
+                held = 0.0
+                for vol, source in zip(volume, sources):
+                    parts, part = _split(vol, max_volume)
+                    for _ in range(parts):
+                        if held and held + part > max_volume + 1e-9:
+                            steps.append(('dispense', held, dests[0]))
+                            held = 0.0
+                        steps.append(('aspirate', part, source))
+                        held += part
+                steps.append(('dispense', held, dests[0]))
+            elif action == 'distribute_planned':
+                steps = helpers.plan_distribute(volume, sources[0], dests, max_volume, disposal_vol=disposal,
+                                                blow_out=args.get('blow_out', False))
+            elif action == 'distribute' and len(dests) > 1:
+                steps = []
+                remaining = iter(dests)
+                for trip in _distribute_trips(volume, len(dests), max_volume, disposal):
+                    steps.append(('aspirate', volume * trip + disposal, sources[0]))
+                    steps.extend(('dispense', volume, next(remaining)) for _ in range(trip))
+            else:
+                source, = sources
+                parts, part = _split(volume, max_volume)
+                steps = []
+                for dest in dests:
+                    for _ in range(parts):
+                        steps.extend([('aspirate', part, source), ('dispense', part, dest)])
+            for kind, vol, ref in steps:
+                if kind == 'aspirate':
+                    check_range(i, pipette, vol, 'aspirates')
+                    change(i, ref, n, -vol)
+                elif kind == 'dispense':
+                    change(i, ref, n, vol)
+            # Transfers drop the tip at the end unless told not to
+            if args.get('new_tip', 'once') != 'never':
+                tips_held.pop(pipette, None)
+            last_dest[pipette] = dests[-1]
+
+    for well, (i, amount) in sorted(shortfalls.items(), key=lambda item: item[1][0]):
+        violations.append(Violation(i, 'error', '{} {} runs dry, {:.1f} uL short'.format(well[0], well[1], amount)))
+    for well, (i, amount) in sorted(overflows.items(), key=lambda item: item[1][0]):
+        violations.append(Violation(i, 'error', '{} {} overflows its {:.0f} uL by {:.1f} uL'.format(
+            well[0], well[1], capacity(well), amount)))
+    for pipette, requested in pickups.items():
+        racks = spec['pipettes'][pipette][2]
+        rack_wells = LABWARE[labware[racks[0]]][1]
+        rows = len({name[0] for name in rack_wells})
+        columns = len({name[1:] for name in rack_wells})
+        channels = PIPETTES[spec['pipettes'][pipette][0]][0]
+        if channels > 1:
+            interleave = max(1, rows // channels)
+            schedule = helpers.plan_tip_usage(requested, num_rows=rows // interleave, num_columns=columns,
+                                              interleave=interleave)
+            needed = max(rack for _, rack, _ in schedule) + 1
+        else:
+            needed = int(math.ceil(len(requested) / float(len(rack_wells))))
+        if needed > len(racks):
+            violations.append(Violation(None, 'error', '{} needs {} tip racks, {} loaded ({} tips)'.format(
+                pipette, needed, len(racks), sum(requested))))
+    violations.sort(key=lambda violation: -1 if violation.step is None else violation.step)
+    return violations
+
+
+def validate_protocol(protocol_file):
+    """
+    Checks a hand-written protocol file in one sweep over the commands it gives the simulated robot. Every well is
+    taken to start with just what the run takes out of it, so the checks are of wells that overflow or need more than
+    they hold, of negative volumes and of the run stopping part way through on an assert or on running out of tips
+
+    Returns
+    -------
+    list
+        Violation(command index or None, 'error' | 'warning', message) tuples, in command order
+    """
+    with open(protocol_file) as f:
+        code = compile(f.read(), protocol_file, 'exec')
+    violations = []
+    with simulate.simulated_opentrons() as robot:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                exec(code, {'__name__': '__main__', '__file__': protocol_file})
+        except Exception as error:
+            # The commands up to where the robot would have stopped are still checked
+            frame = traceback.extract_tb(error.__traceback__)[-1]
+            violations.append(Violation(len(robot.commands), 'error', 'Run stops at line {} ({}): {}'.format(
+                frame.lineno, frame.line, '{}: {}'.format(type(error).__name__, error) if str(error) else
+                type(error).__name__)))
+    violations.extend(Violation(None, 'warning', warning) for warning in robot.warnings)
+
+    # Net uL change of each (slot, well) so far, and its lowest and highest with the commands they were at
+    volumes = collections.defaultdict(float)
+    lowest, highest = {}, {}
+    capacities = {}
+    for i, command in enumerate(robot.commands):
+        if command.name not in ('aspirate', 'dispense') or command.well is None:
+            continue
+        if command.volume < 0:
+            violations.append(Violation(i, 'error', '{} {}s {:.2f} uL'.format(
+                command.pipette, command.name, command.volume)))
+            continue
+        volume = -command.volume if command.name == 'aspirate' else command.volume
+        for name in _channel_wells(command.labware, command.well, command.tips):
+            well = command.slot, name
+            volumes[well] += volume
+            capacities[well] = LABWARE[command.labware][1][name][4]
+            if volumes[well] < lowest.get(well, (0.0, None))[0]:
+                lowest[well] = volumes[well], i
+            if volumes[well] > highest.get(well, (0.0, None))[0]:
+                highest[well] = volumes[well], i
+    for well, capacity in capacities.items():
+        # Loaded with what it runs lowest by, a well holds that much more at its highest
+        loaded, _ = lowest.get(well, (0.0, None))
+        peak, i = highest.get(well, (0.0, None))
+        if peak - loaded <= capacity + 1e-6:
+            continue
+        if i is None:
+            violations.append(Violation(lowest[well][1], 'error', '{} {} needs {:.1f} uL loaded, more than its {:.0f} '
+                                        'uL'.format(well[0], well[1], -loaded, capacity)))
+        else:
+            violations.append(Violation(i, 'error', '{} {} overflows its {:.0f} uL by {:.1f} uL'.format(
+                well[0], well[1], capacity, peak - loaded - capacity)))
+    violations.sort(key=lambda violation: -1 if violation.step is None else violation.step)
+    return violations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=' '.join(__doc__.strip().split('\n\n')[0].split()))
+    parser.add_argument('layouts', nargs='*', help='Names of specs in layout.SPECS, JSON spec files or protocol files '
+                        '(.py), every spec and protocol by default')
+    args = parser.parse_args(argv)
+
+    status = 0
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in args.layouts or sorted(layout.SPECS) + [os.path.join(here, path) for path in PROTOCOLS]:
+        start = time.perf_counter()
+        if name.endswith('.py'):
+            violations = validate_protocol(name)
+            checked = 'protocol'
+        else:
+            spec = layout.load_spec(name)
+            plan = layout.compile_layout(spec)
+            start = time.perf_counter()
+            violations = validate_plan(spec, plan)
+            name, checked = spec['name'], '{} steps'.format(len(plan))
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for violation in violations if violation.severity == 'error')
+        print('{}: {} errors, {} warnings ({} checked in {:.1f} ms)'.format(
+            os.path.basename(name), errors, len(violations) - errors, checked, elapsed * 1000))
+        for step, severity, message in violations:
+            print('  {:<7} {:>5} {}'.format(severity, '-' if step is None else step, message))
+        status = status or (1 if errors else 0)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())